@@ -1,186 +1,728 @@
 """Main window for the GUI application. The window contains a central scrollable
-area where images can be added. The scrollable area is modeled as
-a collection of rows. Each row may have up to two images side by side. The image
-on the left will be considered the 'control', while the image on the right will
-be considered the 'test'. The user can add a new row to the list by clicking on
+table where images can be added. The table is backed by a model with one row
+per pair of images, and only the visible rows are drawn. Each row may have up
+to two images side by side. The image on the left will be considered the
+'control', while the image on the right will be considered the 'test'. The user can add a new row to the list by clicking on
 the 'Add Row' button. A new row will be added to the bottom of the list. The
 empty row will contain two blank image boxes where the user can add images.
-There will be a bottom bar for the application that contains a 'Generate Report'
+'Import Folder...' adds a row for every pair of control and test images in a
+folder, paired by file name. There will be a bottom bar for the application that contains a 'Generate Report'
 button. When the user clicks on the 'Generate Report' button, the program will
 generate histograms of the LAB values of the images and save them to a CSV file
 for further analysis. The program also generates a summary CSV file that
 contains the average LAB values of the images and the difference between the
 control and test images."""
 
-from PySide6 import QtCore, QtWidgets, QtGui
 import sys
-from utils import image_to_lab_histogram, lab_hist_weighed_average, handle_cli
+
+if __name__ == "__main__" and len(sys.argv) > 1:
+    # if any arguments were passed in, run the CLI and exit before the GUI
+    # toolkit is imported
+    import cli
+    sys.exit(cli.main())
+
+from PySide6 import QtCore, QtWidgets, QtGui
+from utils import lab_histogram_with_thumbnail, lab_hist_weighed_average, estimate_average_error, lab_regions, DEFAULT_FAST_REDUCE, THUMBNAIL_SIZE
+from histogram_cache import HistogramCache, ThumbnailCache
+from roi import RectRoi, PolygonRoi, parse_roi
+from pairing import pair_images, DEFAULT_CONTROL_PATTERN, DEFAULT_TEST_PATTERN
+import time
+import profiling
 import os
 import platform
 
-class ImageDataCell(QtWidgets.QWidget):
-    """A cell for the image data. Contains a label for the image and a button to
-    add an image. Can be classified as either a control or test image."""
+ROW_HEIGHT = 130
+
+class ImageLoadSignals(QtCore.QObject):
+    """Signals emitted by an ImageLoadTask. QRunnable is not a QObject, so the
+    signals live on this helper instead."""
+
+    finished = QtCore.Signal(int, object)
+    failed = QtCore.Signal(int, str)
+
+class ImageLoadTask(QtCore.QRunnable):
+    """Computes the LAB histogram, averages and thumbnail of an image on a
+    worker thread, decoding the image at most once for all of them. The
+    generation identifies which load request of the owning cell the result
+    belongs to, so that results of superseded loads can be discarded. With a
+    reduce factor greater than 1 the image is analyzed in the fast approximate
+    mode and the estimated error of the averages is calculated as well. With
+    an roi only the pixels within it are counted."""
+
+    def __init__(self, generation: int, image_path: str, histogram_cache: HistogramCache = None,
+            reduce: int = 1, thumbnail_cache: ThumbnailCache = None, roi=None):
+        super().__init__()
+        self.generation = generation
+        self.image_path = image_path
+        self.histogram_cache = histogram_cache
+        self.thumbnail_cache = thumbnail_cache
+        self.reduce = reduce
+        self.roi = roi
+        self.cancelled = False
+        self.signals = ImageLoadSignals()
+
+    def run(self):
+        if self.cancelled:
+            return
+        try:
+            histogram, thumbnail = lab_histogram_with_thumbnail(self.image_path, self.histogram_cache,
+                self.thumbnail_cache, reduce=self.reduce, roi=self.roi)
+            averages = lab_hist_weighed_average(histogram)
+            errors = estimate_average_error(histogram) if self.reduce > 1 else None
+        except Exception as e:
+            self.signals.failed.emit(self.generation, str(e))
+            return
+        # QImage, unlike QPixmap, may be created off the GUI thread
+        thumbnail = QtGui.QImage.fromData(thumbnail, "PNG")
+        self.signals.finished.emit(self.generation, (histogram, averages, errors, thumbnail))
+
+class RegionLoadTask(QtCore.QRunnable):
+    """Converts an image to LAB and precomputes its RegionHistograms on a
+    worker thread, for the ROI dialog."""
+
+    def __init__(self, image_path: str, reduce: int = 1):
+        super().__init__()
+        self.image_path = image_path
+        self.reduce = reduce
+        self.signals = ImageLoadSignals()
+
+    def run(self):
+        try:
+            regions = lab_regions(self.image_path, reduce=self.reduce)
+        except Exception as e:
+            self.signals.failed.emit(0, str(e))
+            return
+        self.signals.finished.emit(0, regions)
 
+class ImageDataCell(QtCore.QObject):
+    """The data of a single image of a row: its path, histogram and averages.
+    Can be classified as either a control or test image. Images are analyzed on
+    a worker thread; image_loading is emitted when a new image is picked and
+    image_loaded once its averages and thumbnail are available, or image_failed
+    if it could not be analyzed. The thumbnail arrives as a QImage and is only
+    turned into a pixmap once it is first drawn, i.e. when the row scrolls into
+    view. When a region of interest is set, the histogram and averages are
+    those of the pixels within it."""
+
+    image_loading = QtCore.Signal()
     image_loaded = QtCore.Signal(dict)
+    image_failed = QtCore.Signal(str)
 
-    def __init__(self, image_class:str = "control"):
+    def __init__(self, image_class:str = "control", histogram_cache: HistogramCache = None, thumbnail_cache: ThumbnailCache = None):
         super().__init__()
 
         self.image_class = image_class
+        self.histogram_cache = histogram_cache
+        self.thumbnail_cache = thumbnail_cache
+        self.image_path = None
         self.image_histogram = None
         self.image_averages = (None, None, None)
+        self.image_errors = None
+        self.thumbnail_image = None
+        self.thumbnail = None
+        self.roi = None
+        # reduction factor for the fast approximate mode; 1 analyzes every pixel
+        self.reduce = 1
+        self.load_task = None
+        self.load_generation = 0
 
-        self.layout = QtWidgets.QVBoxLayout()
-        self.setLayout(self.layout)
+    def is_loading(self):
+        """Returns True while the averages of the current image are still being
+        calculated."""
+        return self.load_task is not None
 
-        # add a text label to the layout indicating what class of image this represents
-        self.label = QtWidgets.QLabel(f"{image_class.capitalize()} Image:")
-        self.layout.addWidget(self.label)
+    def cancel_load(self):
+        """Cancels the pending load, if any. A load that has not started yet is
+        removed from the thread pool; the result of one that is already running
+        is discarded when it arrives, since it belongs to an older generation."""
+        if self.load_task is not None:
+            self.load_task.cancelled = True
+            try:
+                QtCore.QThreadPool.globalInstance().tryTake(self.load_task)
+            except RuntimeError:
+                # the task has already run, and the pool has deleted it
+                pass
+            self.load_task = None
+            self.load_generation += 1
 
-        self.image_path = None
-        self.image_label = self.__create_image_picker_label()
-        self.layout.addWidget(self.image_label)
+    def thumbnail_pixmap(self):
+        """Returns the thumbnail as a pixmap, or None if there is none yet. The
+        pixmap is created on first use."""
+        if self.thumbnail is None and self.thumbnail_image is not None and not self.thumbnail_image.isNull():
+            self.thumbnail = QtGui.QPixmap.fromImage(self.thumbnail_image)
+        return self.thumbnail
 
-    def __create_image_picker_label(self):
-        """Creates a label for selecting an image. When no image is selected, the label will display the SP_TitleBarContextHelpButton icon. When an image is selected, the label will display a thumbnail of the image. The user can click on the label to select an image."""
-        label = QtWidgets.QPushButton()
-        pixmapi = getattr(QtWidgets.QStyle, "SP_TitleBarContextHelpButton")
-        icon = self.style().standardIcon(pixmapi)
-        label.setIcon(icon)
-        label.setFixedSize(100, 100)
-        label.clicked.connect(self.add_image)
-        return label
+    def load_image(self, image_path):
+        """Loads the image from the specified path. The LAB histogram and
+        averages are generated on a worker thread; any load still pending for a
+        previously selected image is cancelled."""
+        self.cancel_load()
+        self.image_path = image_path
+        self.image_histogram = None
+        self.image_averages = (None, None, None)
+        self.image_errors = None
+        self.thumbnail_image = None
+        self.thumbnail = None
 
+        self.load_generation += 1
+        self.load_task = ImageLoadTask(self.load_generation, image_path, self.histogram_cache, self.reduce, self.thumbnail_cache, self.roi)
+        self.load_task.signals.finished.connect(self.on_load_finished)
+        self.load_task.signals.failed.connect(self.on_load_failed)
+        self.image_loading.emit()
+        QtCore.QThreadPool.globalInstance().start(self.load_task)
 
-    @QtCore.Slot()
-    def add_image(self):
-        image_path, _ = QtWidgets.QFileDialog.getOpenFileName(self, "Open Image", "", "Image Files (*.png *.jpg *.jpeg *.bmp)")
-        if image_path:
-            self.load_image(image_path)
+    def set_roi(self, roi, histogram=None):
+        """Sets the region of interest, or clears it if roi is None. When the
+        histogram of the region is given (e.g. by the ROI dialog, which already
+        calculated it) it is used as is; otherwise the image is analyzed again."""
+        self.roi = roi
+        if histogram is None:
+            if self.image_path:
+                self.load_image(self.image_path)
+            return
+        self.cancel_load()
+        self.image_histogram = histogram
+        self.image_averages = lab_hist_weighed_average(histogram)
+        self.image_errors = estimate_average_error(histogram) if self.reduce > 1 else None
+        self.image_loaded.emit({ "img": self.image_path, "averages": self.image_averages, "errors": self.image_errors})
 
-    def get_image_thumbnail(self, image_path):
-        """Returns a thumbnail of the image at the specified path, using the QPixmap class."""
-        image = QtGui.QPixmap(image_path)
-        return image.scaled(100, 100, QtCore.Qt.KeepAspectRatio)
+    @QtCore.Slot(int, object)
+    def on_load_finished(self, generation, result):
+        """Stores the result of a load, unless it has since been superseded."""
+        if generation != self.load_generation:
+            return
+        self.load_task = None
+        self.image_histogram, self.image_averages, self.image_errors, self.thumbnail_image = result
+        self.image_loaded.emit({ "img": self.image_path, "averages": self.image_averages, "errors": self.image_errors})
 
-    def load_image(self, image_path):
-        """Loads the image from the specified path and updates the image label.
-        Also generates the LAB histogram and averages."""
-        self.image_path = image_path
-        image = self.get_image_thumbnail(image_path)
-        #self.image_label.setPixmap(image)
-        self.image_label.setIcon(QtGui.QIcon(image_path))
-        self.image_label.setIconSize(QtCore.QSize(100,100))
-        self.image_histogram = image_to_lab_histogram(image_path)
-        self.image_averages = lab_hist_weighed_average(self.image_histogram)
-        self.image_loaded.emit({ "img": self.image_path, "averages": self.image_averages})
-
-class RowLabelCell(QtWidgets.QWidget):
-    """A cell for the row label and summary. Contains a QLineEdit widget for the
-    user to assign a label to the row. Contains a grid showing the average LAB
-    values for the control and test images and the difference between the
-    two."""
-    def __init__(self):
-        super().__init__()
+    @QtCore.Slot(int, str)
+    def on_load_failed(self, generation, message):
+        """Reports an image that could not be analyzed."""
+        if generation != self.load_generation:
+            return
+        self.load_task = None
+        self.image_loaded.emit({ "img": self.image_path, "averages": self.image_averages, "errors": None})
+        self.image_failed.emit(f"Unable to analyze {self.image_path}: {message}")
 
-        self.layout = QtWidgets.QVBoxLayout()
-        self.setLayout(self.layout)
+class ImageDataRow(QtCore.QObject):
+    """A row of the image data: a label for the data set and two
+    ImageDataCells, the control and the test image."""
 
-        self.label = QtWidgets.QLabel("Label:")
-        self.layout.addWidget(self.label)
-        self.textbox = QtWidgets.QLineEdit()
-        self.layout.addWidget(self.textbox)
-        self.layout.setAlignment(QtCore.Qt.AlignTop | QtCore.Qt.AlignLeft)
-        #self.setMaximumWidth(275)
-        self.control_averages = []
-        self.test_averages = []
-        self.summary = QtWidgets.QGridLayout()
-        self.layout.addLayout(self.summary)
-        self.update_summary()
-
-    def set_control_image_averages(self, event: dict):
-        """Sets the average LAB values for the control image."""
-        self.control_averages = event["averages"]
-        self.update_summary()
-
-    def set_test_image_averages(self, event: dict):
-        """Sets the average LAB values for the test image."""
-        self.test_averages = event["averages"]
-        self.update_summary()
-
-    def update_summary(self):
-        """Shows a simple grid with the average LAB values for the control and test images"""
-        # clear the existing summary
-        for i in reversed(range(self.summary.count())):
-            widget = self.summary.itemAt(i).widget()
-            if widget:
-                widget.deleteLater()
-        self.summary.addWidget(QtWidgets.QLabel("Control"), 0, 1)
-        self.summary.addWidget(QtWidgets.QLabel("Test"), 0, 2)
-        self.summary.addWidget(QtWidgets.QLabel("L*"), 1, 0)
-        self.summary.addWidget(QtWidgets.QLabel("a*"), 2, 0)
-        self.summary.addWidget(QtWidgets.QLabel("b*"), 3, 0)
-        for i, value in enumerate(self.control_averages):
-            self.summary.addWidget(QtWidgets.QLabel(str(value)), i+1, 1)
-        for i, value in enumerate(self.test_averages):
-            self.summary.addWidget(QtWidgets.QLabel(str(value)), i+1, 2)
-
-
-class ImageDataRow(QtWidgets.QWidget):
-    """A row for the image data. Contains three cells; one for assigning a label to the data set and two ImageDataCells. """
-
-    def __init__(self):
+    def __init__(self, histogram_cache: HistogramCache = None, thumbnail_cache: ThumbnailCache = None):
         super().__init__()
+        self.label = ""
+        self.control_image_cell = ImageDataCell("control", histogram_cache, thumbnail_cache)
+        self.test_image_cell = ImageDataCell("test", histogram_cache, thumbnail_cache)
 
-        self.layout = QtWidgets.QHBoxLayout()
-        self.setLayout(self.layout)
+    def cells(self):
+        """Returns the control and test image cells."""
+        return self.control_image_cell, self.test_image_cell
 
-        self.label = RowLabelCell()
-        self.layout.addWidget(self.label)
-
-        self.control_image_cell = ImageDataCell("control")
-        self.control_image_cell.image_loaded.connect(self.label.set_control_image_averages)
-        self.layout.addWidget(self.control_image_cell)
-
-        self.test_image_cell = ImageDataCell("test")
-        self.test_image_cell.image_loaded.connect(self.label.set_test_image_averages)
-        self.layout.addWidget(self.test_image_cell)
-
-        self.setMaximumHeight(150)
-
-        self.add_delete_button()
-        self.layout.addWidget(self.delete_button)
-        self.layout.setAlignment(QtCore.Qt.AlignBottom)
-
-    def add_delete_button(self):
-        """Adds a delete button to the row. When clicked, the row will be deleted."""
-        self.delete_button = QtWidgets.QPushButton()
-        pixmapi = getattr(QtWidgets.QStyle, "SP_TrashIcon")
-        icon = self.style().standardIcon(pixmapi)
-        self.delete_button.setIcon(icon)
-        #self.delete_button.setFixedSize(2*icon.availableSizes()[0])
-        self.delete_button.setFixedSize(25,25)
-        self.delete_button.setStyleSheet("background-color: red")
-        self.delete_button.clicked.connect(self.delete_row)
-    
-    def delete_row(self):
-        """Deletes the row from the list of rows."""
-        self.deleteLater()
+    def cancel_loads(self):
+        """Cancels any pending loads of the row's images."""
+        self.control_image_cell.cancel_load()
+        self.test_image_cell.cancel_load()
 
     def is_complete(self):
         """Returns True if both the control and test images have been added."""
         return self.control_image_cell.image_path and self.test_image_cell.image_path
-    
+
+    def is_loading(self):
+        """Returns True if either image is still being analyzed."""
+        return self.control_image_cell.is_loading() or self.test_image_cell.is_loading()
+
+    def summary(self):
+        """Returns (channel, control, test) text for each LAB channel. Averages
+        that are still being calculated are shown as an ellipsis, approximate
+        averages from the fast mode with their estimated error."""
+        columns = []
+        for cell in self.cells():
+            if cell.is_loading():
+                columns.append(["..."] * 3)
+            elif cell.image_averages[0] is None:
+                columns.append([""] * 3)
+            elif cell.image_errors:
+                columns.append([f"{v} ±{e}" for v, e in zip(cell.image_averages, cell.image_errors)])
+            else:
+                columns.append([str(v) for v in cell.image_averages])
+        return [(channel, columns[0][i], columns[1][i]) for i, channel in enumerate(("L*", "a*", "b*"))]
+
+class ImageDataModel(QtCore.QAbstractTableModel):
+    """Table model of the image data rows. Each row has a label column showing
+    the row label and a summary of the average LAB values, a column for each of
+    the control and test images, and a column for deleting the row. Thumbnail
+    pixmaps are created only when the view asks for them, which it does for
+    visible rows only."""
+
+    LABEL_COLUMN, CONTROL_COLUMN, TEST_COLUMN, DELETE_COLUMN = range(4)
+    HEADERS = ["Label", "Control Image", "Test Image", ""]
+
+    # role under which the ImageDataRow of an index is returned
+    RowRole = QtCore.Qt.UserRole + 1
+
+    load_failed = QtCore.Signal(str)
+
+    def __init__(self, histogram_cache: HistogramCache = None, thumbnail_cache: ThumbnailCache = None, parent=None):
+        super().__init__(parent)
+        self.histogram_cache = histogram_cache
+        self.thumbnail_cache = thumbnail_cache
+        self.image_rows = []
+        self.reduce = 1
+        style = QtWidgets.QApplication.style()
+        self.placeholder_icon = style.standardIcon(QtWidgets.QStyle.SP_TitleBarContextHelpButton)
+        self.delete_icon = style.standardIcon(QtWidgets.QStyle.SP_TrashIcon).pixmap(24, 24)
+
+    def rowCount(self, parent=QtCore.QModelIndex()):
+        return 0 if parent.isValid() else len(self.image_rows)
+
+    def columnCount(self, parent=QtCore.QModelIndex()):
+        return 0 if parent.isValid() else len(self.HEADERS)
+
+    def headerData(self, section, orientation, role=QtCore.Qt.DisplayRole):
+        if orientation == QtCore.Qt.Horizontal and role == QtCore.Qt.DisplayRole:
+            return self.HEADERS[section]
+        return None
+
+    def flags(self, index):
+        flags = QtCore.Qt.ItemIsEnabled | QtCore.Qt.ItemIsSelectable
+        if index.column() == self.LABEL_COLUMN:
+            flags |= QtCore.Qt.ItemIsEditable
+        return flags
+
+    def cell(self, index):
+        """Returns the ImageDataCell of an image column index."""
+        row = self.image_rows[index.row()]
+        return row.control_image_cell if index.column() == self.CONTROL_COLUMN else row.test_image_cell
+
+    def data(self, index, role=QtCore.Qt.DisplayRole):
+        if not index.isValid():
+            return None
+        row = self.image_rows[index.row()]
+        column = index.column()
+        if role == self.RowRole:
+            return row
+        if column == self.LABEL_COLUMN:
+            if role in (QtCore.Qt.DisplayRole, QtCore.Qt.EditRole):
+                return row.label
+        elif column in (self.CONTROL_COLUMN, self.TEST_COLUMN):
+            cell = self.cell(index)
+            if role == QtCore.Qt.DisplayRole:
+                if cell.is_loading():
+                    return "Analyzing..."
+                return f"{cell.image_class.capitalize()} Image" + (" (ROI)" if cell.roi is not None else "")
+            if role == QtCore.Qt.DecorationRole:
+                # only reached for rows the view is showing
+                thumbnail = cell.thumbnail_pixmap()
+                return thumbnail if thumbnail is not None else self.placeholder_icon
+            if role == QtCore.Qt.ToolTipRole:
+                if not cell.image_path:
+                    return "Click to select an image"
+                return cell.image_path + (f"\nRegion: {cell.roi.spec()}" if cell.roi is not None else "")
+        elif column == self.DELETE_COLUMN:
+            if role == QtCore.Qt.DecorationRole:
+                return self.delete_icon
+            if role == QtCore.Qt.ToolTipRole:
+                return "Delete row"
+        return None
+
+    def setData(self, index, value, role=QtCore.Qt.EditRole):
+        if index.isValid() and index.column() == self.LABEL_COLUMN and role == QtCore.Qt.EditRole:
+            self.image_rows[index.row()].label = value
+            self.dataChanged.emit(index, index, [role])
+            return True
+        return False
+
+    def add_row(self):
+        """Appends an empty row. Returns the new ImageDataRow."""
+        return self.add_rows([""])[0]
+
+    def add_rows(self, labels: list):
+        """Appends a row with each of the labels in a single insertion, which
+        the view handles far faster than one insertion per row. Returns the
+        new ImageDataRows."""
+        rows = []
+        for label in labels:
+            row = ImageDataRow(self.histogram_cache, self.thumbnail_cache)
+            row.label = label
+            for column, cell in zip((self.CONTROL_COLUMN, self.TEST_COLUMN), row.cells()):
+                cell.reduce = self.reduce
+                changed = lambda row=row, column=column: self.row_changed(row, column)
+                cell.image_loading.connect(changed)
+                cell.image_loaded.connect(changed)
+                cell.image_failed.connect(self.load_failed)
+            rows.append(row)
+        if rows:
+            position = len(self.image_rows)
+            self.beginInsertRows(QtCore.QModelIndex(), position, position + len(rows) - 1)
+            self.image_rows.extend(rows)
+            self.endInsertRows()
+        return rows
+
+    def remove_row(self, position: int):
+        """Removes the row at the position, cancelling any pending loads."""
+        self.beginRemoveRows(QtCore.QModelIndex(), position, position)
+        row = self.image_rows.pop(position)
+        self.endRemoveRows()
+        row.cancel_loads()
+
+    def cancel_loads(self, rows: list):
+        """Cancels the pending loads of the rows and refreshes them. Their
+        images stay selected, without averages, and are analyzed again when
+        picked again."""
+        for row in rows:
+            row.cancel_loads()
+        if self.image_rows:
+            self.dataChanged.emit(self.index(0, self.LABEL_COLUMN), self.index(len(self.image_rows) - 1, self.TEST_COLUMN))
+
+    def row_changed(self, row: ImageDataRow, column: int):
+        """Refreshes the image cell and the summary of a row whose image data
+        changed. Rows that have since been removed are ignored."""
+        try:
+            position = self.image_rows.index(row)
+        except ValueError:
+            return
+        self.dataChanged.emit(self.index(position, self.LABEL_COLUMN), self.index(position, self.LABEL_COLUMN))
+        self.dataChanged.emit(self.index(position, column), self.index(position, column))
+
+    def set_reduce(self, reduce: int):
+        """Sets the reduction factor for images loaded from now on."""
+        self.reduce = reduce
+        for row in self.image_rows:
+            for cell in row.cells():
+                cell.reduce = reduce
+
+class RowLabelDelegate(QtWidgets.QStyledItemDelegate):
+    """Draws the label column: the row label above a small grid of the average
+    LAB values of the control and test images. Editing the label uses a line
+    edit at the top of the cell."""
+
+    PADDING = 4
+
+    def paint(self, painter, option, index):
+        row = index.data(ImageDataModel.RowRole)
+        style = option.widget.style() if option.widget else QtWidgets.QApplication.style()
+        style.drawPrimitive(QtWidgets.QStyle.PE_PanelItemViewItem, option, painter, option.widget)
+        painter.save()
+        rect = option.rect.adjusted(self.PADDING, self.PADDING, -self.PADDING, -self.PADDING)
+        line_height = option.fontMetrics.height() + 2
+        painter.drawText(QtCore.QRect(rect.left(), rect.top(), rect.width(), line_height),
+            QtCore.Qt.AlignLeft | QtCore.Qt.AlignVCenter, "Label: " + (row.label or ""))
+        # three columns: channel name, control average, test average
+        widths = [rect.width() * 0.2, rect.width() * 0.4, rect.width() * 0.4]
+        lines = [("", "Control", "Test")] + row.summary()
+        for i, line in enumerate(lines):
+            top = rect.top() + (i + 1) * line_height + self.PADDING
+            left = rect.left()
+            for width, text in zip(widths, line):
+                painter.drawText(QtCore.QRectF(left, top, width, line_height), QtCore.Qt.AlignLeft | QtCore.Qt.AlignVCenter, text)
+                left += width
+        painter.restore()
+
+    def updateEditorGeometry(self, editor, option, index):
+        height = editor.sizeHint().height()
+        editor.setGeometry(option.rect.left(), option.rect.top(), option.rect.width(), height)
+
+class ImageCellDelegate(QtWidgets.QStyledItemDelegate):
+    """Draws an image column: the thumbnail above the image class, or
+    'Analyzing...' while the image is being analyzed."""
+
+    def initStyleOption(self, option, index):
+        super().initStyleOption(option, index)
+        option.decorationPosition = QtWidgets.QStyleOptionViewItem.Top
+        option.decorationAlignment = QtCore.Qt.AlignHCenter | QtCore.Qt.AlignTop
+        option.decorationSize = QtCore.QSize(THUMBNAIL_SIZE, THUMBNAIL_SIZE)
+        option.displayAlignment = QtCore.Qt.AlignHCenter | QtCore.Qt.AlignBottom
+
+class RoiCanvas(QtWidgets.QWidget):
+    """Shows an image scaled to fit and lets the user drag out a rectangular
+    region on it. Coordinates are reported in pixels of the image file."""
+
+    roi_changed = QtCore.Signal(object)
+
+    def __init__(self, image_path: str, max_size: QtCore.QSize):
+        super().__init__()
+        reader = QtGui.QImageReader(image_path)
+        self.source_size = reader.size()
+        if self.source_size.isValid():
+            reader.setScaledSize(self.source_size.scaled(max_size, QtCore.Qt.KeepAspectRatio))
+        self.pixmap = QtGui.QPixmap.fromImage(reader.read())
+        self.scale = self.pixmap.width() / max(1, self.source_size.width())
+        self.setFixedSize(self.pixmap.size())
+        self.roi = None
+        self.drag_start = None
+
+    def set_roi(self, roi):
+        self.roi = roi
+        self.update()
+
+    def to_image(self, point):
+        return (min(max(point.x(), 0), self.width()) / self.scale, min(max(point.y(), 0), self.height()) / self.scale)
+
+    def mousePressEvent(self, event):
+        self.drag_start = self.to_image(event.position())
+
+    def mouseMoveEvent(self, event):
+        if self.drag_start is None:
+            return
+        (x0, y0), (x1, y1) = self.drag_start, self.to_image(event.position())
+        if abs(x1 - x0) >= 1 and abs(y1 - y0) >= 1:
+            self.set_roi(RectRoi(round(min(x0, x1)), round(min(y0, y1)), round(abs(x1 - x0)) or 1, round(abs(y1 - y0)) or 1))
+            self.roi_changed.emit(self.roi)
+
+    def mouseReleaseEvent(self, event):
+        self.drag_start = None
+
+    def paintEvent(self, event):
+        painter = QtGui.QPainter(self)
+        painter.drawPixmap(0, 0, self.pixmap)
+        painter.setPen(QtGui.QPen(QtGui.QColor("yellow"), 2))
+        if isinstance(self.roi, RectRoi):
+            painter.drawRect(QtCore.QRectF(self.roi.x * self.scale, self.roi.y * self.scale,
+                self.roi.width * self.scale, self.roi.height * self.scale))
+        elif isinstance(self.roi, PolygonRoi):
+            painter.drawPolygon(QtGui.QPolygonF([QtCore.QPointF(x * self.scale, y * self.scale) for x, y in self.roi.points]))
+        painter.end()
+
+class RoiDialog(QtWidgets.QDialog):
+    """Dialog for selecting the region of interest of an image cell. The image
+    is converted to LAB once, on a worker thread, when the dialog opens; after
+    that the averages of the region are recalculated from the precomputed
+    RegionHistograms as the region is dragged out or edited. A region may also
+    be typed in as rect:X,Y,WIDTH,HEIGHT, poly:X1,Y1,X2,Y2,... or mask:PATH."""
+
+    def __init__(self, cell: ImageDataCell, parent=None):
+        super().__init__(parent)
+        self.setWindowTitle("Select Region")
+        self.cell = cell
+        self.regions = None
+        self.roi = cell.roi
+        self.histogram = None
+
+        layout = QtWidgets.QVBoxLayout()
+        self.setLayout(layout)
+        self.canvas = RoiCanvas(cell.image_path, QtCore.QSize(640, 480))
+        self.canvas.set_roi(self.roi)
+        self.canvas.roi_changed.connect(self.on_canvas_roi_changed)
+        layout.addWidget(self.canvas)
+
+        self.spec_edit = QtWidgets.QLineEdit(self.roi.spec() if self.roi is not None else "")
+        self.spec_edit.setPlaceholderText("Drag out a rectangle, or enter rect:X,Y,WIDTH,HEIGHT, poly:X1,Y1,X2,Y2,... or mask:PATH")
+        self.spec_edit.editingFinished.connect(self.on_spec_edited)
+        layout.addWidget(self.spec_edit)
+
+        self.averages_label = QtWidgets.QLabel("Preparing the image...")
+        layout.addWidget(self.averages_label)
+
+        buttons = QtWidgets.QDialogButtonBox(QtWidgets.QDialogButtonBox.Ok | QtWidgets.QDialogButtonBox.Cancel)
+        self.clear_button = buttons.addButton("Clear Region", QtWidgets.QDialogButtonBox.ResetRole)
+        self.clear_button.clicked.connect(self.clear_roi)
+        buttons.accepted.connect(self.accept)
+        buttons.rejected.connect(self.reject)
+        self.ok_button = buttons.button(QtWidgets.QDialogButtonBox.Ok)
+        self.ok_button.setDisabled(True)
+        layout.addWidget(buttons)
+
+        task = RegionLoadTask(cell.image_path, cell.reduce)
+        task.signals.finished.connect(self.on_regions_loaded)
+        task.signals.failed.connect(lambda _, message: self.averages_label.setText(f"Unable to analyze the image: {message}"))
+        QtCore.QThreadPool.globalInstance().start(task)
+
+    @QtCore.Slot(int, object)
+    def on_regions_loaded(self, _, regions):
+        self.regions = regions
+        self.update_averages()
+
+    @QtCore.Slot(object)
+    def on_canvas_roi_changed(self, roi):
+        self.roi = roi
+        self.spec_edit.setText(roi.spec())
+        self.update_averages()
+
+    @QtCore.Slot()
+    def on_spec_edited(self):
+        text = self.spec_edit.text().strip()
+        if not text:
+            return
+        try:
+            self.roi = parse_roi(text)
+        except ValueError as e:
+            self.averages_label.setText(str(e))
+            return
+        self.canvas.set_roi(self.roi)
+        self.update_averages()
+
+    @QtCore.Slot()
+    def clear_roi(self):
+        self.roi = None
+        self.histogram = None
+        self.spec_edit.clear()
+        self.canvas.set_roi(None)
+        self.update_averages()
+
+    def update_averages(self):
+        """Shows the averages of the current region, calculated from the
+        precomputed RegionHistograms."""
+        if self.regions is None:
+            return
+        start = time.perf_counter()
+        try:
+            self.histogram = self.regions.histogram(self.roi)
+        except (ValueError, OSError) as e:
+            self.histogram = None
+            self.averages_label.setText(str(e))
+            self.ok_button.setDisabled(True)
+            return
+        elapsed = (time.perf_counter() - start) * 1000
+        l, a, b = lab_hist_weighed_average(self.histogram)
+        region = "Whole image" if self.roi is None else f"{int(self.histogram.pixel_count()[0])} pixels"
+        self.averages_label.setText(f"{region}: L* {l}  a* {a}  b* {b}  ({elapsed:.1f} ms)")
+        self.ok_button.setDisabled(False)
+
+class ImportFolderDialog(QtWidgets.QDialog):
+    """Dialog for importing a folder of image pairs. Control and test images
+    are told apart and paired by file name patterns (see the pairing module);
+    the pairs found are counted as the folder or the patterns are edited."""
+
+    def __init__(self, folder: str = "", control_pattern: str = DEFAULT_CONTROL_PATTERN,
+            test_pattern: str = DEFAULT_TEST_PATTERN, parent=None):
+        super().__init__(parent)
+        self.setWindowTitle("Import Folder")
+        self.pairs = []
+        self.skipped = []
+
+        layout = QtWidgets.QFormLayout()
+        self.setLayout(layout)
+        folder_layout = QtWidgets.QHBoxLayout()
+        self.folder_edit = QtWidgets.QLineEdit(folder)
+        self.folder_edit.editingFinished.connect(self.update_pairs)
+        folder_layout.addWidget(self.folder_edit)
+        browse_button = QtWidgets.QPushButton("Browse...")
+        browse_button.clicked.connect(self.browse)
+        folder_layout.addWidget(browse_button)
+        layout.addRow("Folder:", folder_layout)
+
+        self.control_edit = QtWidgets.QLineEdit(control_pattern)
+        self.test_edit = QtWidgets.QLineEdit(test_pattern)
+        for edit in (self.control_edit, self.test_edit):
+            edit.setToolTip("File name pattern, without the extension: * matches any text and ? a single character. "
+                "Matching is case-insensitive. Control and test images whose names are otherwise the same are paired.")
+            edit.textChanged.connect(self.update_pairs)
+        layout.addRow("Control images:", self.control_edit)
+        layout.addRow("Test images:", self.test_edit)
+
+        self.pairs_label = QtWidgets.QLabel()
+        self.pairs_label.setWordWrap(True)
+        layout.addRow(self.pairs_label)
+
+        buttons = QtWidgets.QDialogButtonBox(QtWidgets.QDialogButtonBox.Ok | QtWidgets.QDialogButtonBox.Cancel)
+        buttons.accepted.connect(self.accept)
+        buttons.rejected.connect(self.reject)
+        self.ok_button = buttons.button(QtWidgets.QDialogButtonBox.Ok)
+        self.ok_button.setText("Import")
+        layout.addRow(buttons)
+        self.update_pairs()
+
+    def folder(self):
+        return self.folder_edit.text().strip()
+
+    def patterns(self):
+        return self.control_edit.text().strip(), self.test_edit.text().strip()
+
+    @QtCore.Slot()
+    def browse(self):
+        folder = QtWidgets.QFileDialog.getExistingDirectory(self, "Import Folder", self.folder())
+        if folder:
+            self.folder_edit.setText(folder)
+            self.update_pairs()
+
+    @QtCore.Slot()
+    def update_pairs(self):
+        """Pairs the images of the folder with the current patterns and shows
+        how many pairs were found."""
+        self.pairs, self.skipped = [], []
+        if not os.path.isdir(self.folder()):
+            self.pairs_label.setText("Select a folder of control and test images.")
+        else:
+            try:
+                self.pairs, self.skipped = pair_images(self.folder(), *self.patterns())
+            except (ValueError, OSError) as e:
+                self.pairs_label.setText(str(e))
+            else:
+                incomplete = sum(1 for _, control, test in self.pairs if control is None or test is None)
+                text = f"{len(self.pairs) - incomplete} pair(s) found"
+                if incomplete:
+                    text += f", {incomplete} image(s) without a counterpart"
+                if self.skipped:
+                    text += f", {len(self.skipped)} ambiguous image(s) skipped"
+                self.pairs_label.setText(text + ".")
+        self.ok_button.setDisabled(not self.pairs)
+
+class FolderImport(QtCore.QObject):
+    """Tracks the analysis of the images of a folder import. The images are
+    analyzed concurrently by the cells themselves, on the thread pool;
+    progress is emitted with the number of images done and the total as each
+    result arrives, and finished once every image is done. Rows removed in the
+    meantime no longer count."""
+
+    progress = QtCore.Signal(int, int)
+    finished = QtCore.Signal()
+
+    def __init__(self, model: ImageDataModel, rows: list, parent=None):
+        super().__init__(parent)
+        self.model = model
+        self.rows = rows
+        self.failures = []
+        self.connected_cells = self.cells()
+        # queued, since a cell that failed emits image_failed, which adds to
+        # the failures, after image_loaded, and the cells of a removed row are
+        # cancelled only after the model has emitted rowsRemoved
+        for cell in self.connected_cells:
+            cell.image_loaded.connect(self.update, QtCore.Qt.QueuedConnection)
+        model.rowsRemoved.connect(self.update, QtCore.Qt.QueuedConnection)
+
+    def cells(self):
+        return [cell for row in self.rows for cell in row.cells() if cell.image_path]
+
+    def start(self):
+        """Emits the initial progress. The loads of the cells must have been
+        started already."""
+        self.update()
+
+    @QtCore.Slot()
+    def update(self):
+        if self.rows is None:
+            return
+        self.rows = [row for row in self.rows if row in self.model.image_rows]
+        cells = self.cells()
+        done = sum(1 for cell in cells if not cell.is_loading())
+        self.progress.emit(done, len(cells))
+        if done == len(cells):
+            self.close()
+            self.finished.emit()
+
+    def cancel(self):
+        """Cancels the analysis of the images that are not done yet."""
+        if self.rows is not None:
+            self.model.cancel_loads(self.rows)
+            self.update()
+
+    def close(self):
+        for cell in self.connected_cells:
+            cell.image_loaded.disconnect(self.update)
+        self.model.rowsRemoved.disconnect(self.update)
+        self.rows = None
+
 class ImageColorClassifier(QtWidgets.QWidget):
     """Main window for the GUI application. The window contains a central scrollable
-    area where images can be added. The scrollable area is modeled as
-    a collection of rows. Each row may have up to two images side by side. The image
-    on the left will be considered the 'control', while the image on the right will
-    be considered the 'test'. The user can add a new row to the list by clicking on
+    table where images can be added. The table is backed by an ImageDataModel
+    with one row per pair of images, and only the visible rows are drawn. Each
+    row may have up to two images side by side. The image on the left will be
+    considered the 'control', while the image on the right will be considered
+    the 'test'. The user can add a new row to the list by clicking on
     the 'Add Row' button. A new row will be added to the bottom of the list. The
     empty row will contain two blank image boxes where the user can add images.
-    There will be a bottom bar for the application that contains a 'Generate Report'
+    'Import Folder...' adds a row for every pair of control and test images in
+    a folder, paired by file name. There will be a bottom bar for the application that contains a 'Generate Report'
     button. When the user clicks on the 'Generate Report' button, the program will
     generate histograms of the LAB values of the images and save them to a CSV file
     for further analysis. The program also generates a summary CSV file that
@@ -197,9 +739,19 @@ class ImageColorClassifier(QtWidgets.QWidget):
         self.resize(600, 600)
         self.setFixedWidth(600)
 
+        # shared by every image cell, so reopening an image that has already
+        # been analyzed does not decode it again
+        self.histogram_cache = HistogramCache()
+        # thumbnails are keyed by file contents too, so a study that is opened
+        # again shows its images without decoding them
+        self.thumbnail_cache = ThumbnailCache()
+
         self.layout = QtWidgets.QVBoxLayout()
         self.setLayout(self.layout)
 
+        self.model = ImageDataModel(self.histogram_cache, self.thumbnail_cache, self)
+        self.model.load_failed.connect(self.show_load_error)
+        self.model.rowsRemoved.connect(self.check_generate_report_should_disable)
         self.add_scrollable_rows()
 
         # Create a horizontal layout for the buttons
@@ -209,45 +761,198 @@ class ImageColorClassifier(QtWidgets.QWidget):
         self.add_row_button.clicked.connect(self.add_row)
         button_layout.addWidget(self.add_row_button)
 
+        self.import_folder_button = QtWidgets.QPushButton("Import Folder...")
+        self.import_folder_button.setToolTip("Add a row for every pair of control and test images in a folder")
+        self.import_folder_button.clicked.connect(self.import_folder)
+        button_layout.addWidget(self.import_folder_button)
+
         self.generate_report_button = QtWidgets.QPushButton("Generate Report")
         self.generate_report_button.clicked.connect(self.generate_report)
         button_layout.addWidget(self.generate_report_button)
+
+        self.fast_mode_checkbox = QtWidgets.QCheckBox("Fast mode")
+        self.fast_mode_checkbox.setToolTip("Analyze images loaded from now on at reduced resolution. "
+            "The averages are approximate and shown with their estimated error.")
+        self.fast_mode_checkbox.toggled.connect(self.set_fast_mode)
+        button_layout.addWidget(self.fast_mode_checkbox)
         
         # Add the button layout to the main layout
         self.layout.addLayout(button_layout)
 
+        # shown while the images of a folder import are being analyzed
+        import_layout = QtWidgets.QHBoxLayout()
+        self.import_progress = QtWidgets.QProgressBar()
+        self.import_progress.setFormat("%v of %m images analyzed")
+        import_layout.addWidget(self.import_progress)
+        self.cancel_import_button = QtWidgets.QPushButton("Cancel")
+        self.cancel_import_button.clicked.connect(self.cancel_import)
+        import_layout.addWidget(self.cancel_import_button)
+        self.import_bar = QtWidgets.QWidget()
+        self.import_bar.setLayout(import_layout)
+        import_layout.setContentsMargins(0, 0, 0, 0)
+        self.import_bar.hide()
+        self.layout.addWidget(self.import_bar)
+        self.folder_import = None
+        self.import_settings = ("", DEFAULT_CONTROL_PATTERN, DEFAULT_TEST_PATTERN)
+
         self.add_row()
 
     def add_scrollable_rows(self):
-        """Adds a scrollable area to the window where rows of image data can be
-        added."""
-        self.scroll_area = QtWidgets.QScrollArea()
-        self.scroll_area.setWidgetResizable(True)
-        self.scroll_area.setVerticalScrollBarPolicy(QtCore.Qt.ScrollBarAsNeeded)
-        self.scroll_area.setHorizontalScrollBarPolicy(QtCore.Qt.ScrollBarAsNeeded)
-        self.scroll_area_widget = QtWidgets.QWidget()
-        self.scroll_area_layout = QtWidgets.QVBoxLayout()
-        self.scroll_area_widget.setLayout(self.scroll_area_layout)
-        self.scroll_area.setWidget(self.scroll_area_widget)
-        self.layout.addWidget(self.scroll_area)
+        """Adds a scrollable table to the window where rows of image data can be
+        added. Every row has the same height, so the view only lays out and
+        draws the rows that are visible."""
+        self.table = QtWidgets.QTableView()
+        self.table.setModel(self.model)
+        self.table.setItemDelegateForColumn(ImageDataModel.LABEL_COLUMN, RowLabelDelegate(self.table))
+        self.table.setItemDelegateForColumn(ImageDataModel.CONTROL_COLUMN, ImageCellDelegate(self.table))
+        self.table.setItemDelegateForColumn(ImageDataModel.TEST_COLUMN, ImageCellDelegate(self.table))
+        self.table.setIconSize(QtCore.QSize(THUMBNAIL_SIZE, THUMBNAIL_SIZE))
+        self.table.setSelectionMode(QtWidgets.QAbstractItemView.NoSelection)
+        self.table.setEditTriggers(QtWidgets.QAbstractItemView.DoubleClicked | QtWidgets.QAbstractItemView.EditKeyPressed)
+        self.table.setVerticalScrollMode(QtWidgets.QAbstractItemView.ScrollPerPixel)
+        self.table.verticalHeader().hide()
+        self.table.verticalHeader().setSectionResizeMode(QtWidgets.QHeaderView.Fixed)
+        self.table.verticalHeader().setDefaultSectionSize(ROW_HEIGHT)
+        header = self.table.horizontalHeader()
+        header.setSectionResizeMode(ImageDataModel.LABEL_COLUMN, QtWidgets.QHeaderView.Stretch)
+        for column in (ImageDataModel.CONTROL_COLUMN, ImageDataModel.TEST_COLUMN):
+            header.setSectionResizeMode(column, QtWidgets.QHeaderView.Fixed)
+            header.resizeSection(column, THUMBNAIL_SIZE + 20)
+        header.setSectionResizeMode(ImageDataModel.DELETE_COLUMN, QtWidgets.QHeaderView.Fixed)
+        header.resizeSection(ImageDataModel.DELETE_COLUMN, 40)
+        self.table.clicked.connect(self.on_cell_clicked)
+        self.table.setContextMenuPolicy(QtCore.Qt.CustomContextMenu)
+        self.table.customContextMenuRequested.connect(self.show_cell_menu)
+        self.layout.addWidget(self.table)
+
+    @QtCore.Slot(QtCore.QModelIndex)
+    def on_cell_clicked(self, index):
+        """Clicking an image cell picks an image for it; clicking the delete
+        column deletes the row."""
+        if index.column() in (ImageDataModel.CONTROL_COLUMN, ImageDataModel.TEST_COLUMN):
+            image_path, _ = QtWidgets.QFileDialog.getOpenFileName(self, "Open Image", "", "Image Files (*.png *.jpg *.jpeg *.bmp)")
+            if image_path:
+                self.model.cell(index).load_image(image_path)
+        elif index.column() == ImageDataModel.DELETE_COLUMN:
+            self.model.remove_row(index.row())
+
+    @QtCore.Slot(QtCore.QPoint)
+    def show_cell_menu(self, position):
+        """Shows the menu of an image cell, for selecting or clearing the
+        region of interest of its image."""
+        index = self.table.indexAt(position)
+        if index.column() not in (ImageDataModel.CONTROL_COLUMN, ImageDataModel.TEST_COLUMN):
+            return
+        cell = self.model.cell(index)
+        if not cell.image_path:
+            return
+        menu = QtWidgets.QMenu(self)
+        select_action = menu.addAction("Select Region...")
+        clear_action = menu.addAction("Clear Region")
+        clear_action.setEnabled(cell.roi is not None)
+        action = menu.exec(self.table.viewport().mapToGlobal(position))
+        if action == select_action:
+            self.select_region(cell)
+        elif action == clear_action:
+            cell.set_roi(None)
+
+    def select_region(self, cell: ImageDataCell):
+        """Opens the ROI dialog for the cell and applies the selected region."""
+        dialog = RoiDialog(cell, self)
+        if dialog.exec() == QtWidgets.QDialog.Accepted:
+            cell.set_roi(dialog.roi, dialog.histogram)
+
+    @QtCore.Slot(str)
+    def show_load_error(self, message):
+        """Reports an image that could not be analyzed. Errors during a folder
+        import are reported together once it finishes."""
+        if self.folder_import is not None:
+            self.folder_import.failures.append(message)
+            return
+        QtWidgets.QMessageBox.warning(self, "Error", message)
 
     def check_generate_report_should_disable(self):
         """Whenever a row is removed, check to see if we have any rows. If there
         are no rows, disable the generate report button"""
-        rows = self.rows()
-        if len(rows) == 0:
+        if self.model.rowCount() == 0:
             self.generate_report_button.setDisabled(True)
 
     def rows(self):
-        """Returns the child widgets of the scroll area"""
-        return self.scroll_area_widget.findChildren(ImageDataRow)
+        """Returns the ImageDataRows of the model"""
+        return self.model.image_rows
+
+    def reduce(self):
+        """Returns the reduction factor images are currently analyzed with."""
+        return DEFAULT_FAST_REDUCE if self.fast_mode_checkbox.isChecked() else 1
+
+    @QtCore.Slot(bool)
+    def set_fast_mode(self, checked):
+        """Switches the fast approximate mode on or off for images loaded from
+        now on. Images that have already been analyzed are left as they are."""
+        self.model.set_reduce(self.reduce())
 
     @QtCore.Slot()
     def add_row(self):
-        row = ImageDataRow()
-        row.destroyed.connect(self.check_generate_report_should_disable)
-        self.scroll_area_layout.addWidget(row)
+        row = self.model.add_row()
         self.generate_report_button.setDisabled(False)
+        return row
+
+    @QtCore.Slot()
+    def import_folder(self):
+        """Asks for a folder and the file name patterns of its control and test
+        images, then adds a row for every pair found, labelled with the part of
+        the file names the images share. Empty rows are replaced. The images
+        are analyzed concurrently; the rows fill in as results arrive, while a
+        progress bar tracks the import and can cancel it."""
+        if self.folder_import is not None:
+            return
+        dialog = ImportFolderDialog(*self.import_settings, parent=self)
+        if dialog.exec() != QtWidgets.QDialog.Accepted or not dialog.pairs:
+            return
+        self.import_settings = (dialog.folder(), *dialog.patterns())
+        for position in reversed(range(self.model.rowCount())):
+            row = self.rows()[position]
+            if not row.label and not row.control_image_cell.image_path and not row.test_image_cell.image_path:
+                self.model.remove_row(position)
+        rows = self.model.add_rows([label for label, _, _ in dialog.pairs])
+        self.generate_report_button.setDisabled(False)
+        # started in row order, so the top rows fill in first. Results are
+        # delivered through the event loop, so none arrives before the import
+        # below is tracking them.
+        for row, (_, control, test) in zip(rows, dialog.pairs):
+            for cell, image_path in zip(row.cells(), (control, test)):
+                if image_path:
+                    cell.load_image(image_path)
+        self.folder_import = FolderImport(self.model, rows, self)
+        self.folder_import.progress.connect(self.on_import_progress)
+        self.folder_import.finished.connect(self.on_import_finished)
+        self.import_folder_button.setDisabled(True)
+        self.import_bar.show()
+        self.folder_import.start()
+
+    @QtCore.Slot(int, int)
+    def on_import_progress(self, done, total):
+        self.import_progress.setRange(0, max(total, 1))
+        self.import_progress.setValue(done)
+
+    @QtCore.Slot()
+    def on_import_finished(self):
+        """Hides the progress bar and reports the images that could not be
+        analyzed, if any."""
+        failures = self.folder_import.failures
+        self.folder_import = None
+        self.import_bar.hide()
+        self.import_folder_button.setDisabled(False)
+        if failures:
+            details = "\n".join(failures[:10]) + (f"\n... and {len(failures) - 10} more" if len(failures) > 10 else "")
+            QtWidgets.QMessageBox.warning(self, "Error", f"Unable to analyze {len(failures)} image(s):\n{details}")
+
+    @QtCore.Slot()
+    def cancel_import(self):
+        """Cancels the analysis of the imported images that are not done yet.
+        Their rows are kept; images are analyzed again when picked again."""
+        if self.folder_import is not None:
+            self.folder_import.cancel()
 
     @QtCore.Slot()
     def generate_report(self):
@@ -256,7 +961,13 @@ class ImageColorClassifier(QtWidgets.QWidget):
         images. The report will be saved to a CSV file of the user's choice.
         Each row in the CSV file will contain the following columns: row_label,
         control_L, control_a, control_b, test_L, test_a, test_b, delta_L,
-        delta_a, delta_b."""
+        delta_a, delta_b. Images that are still being analyzed would be missing
+        from the report, so the report is not generated until they finish."""
+        pending = [row for row in self.rows() if row.is_loading()]
+        if pending:
+            QtWidgets.QMessageBox.information(self, "Analysis in progress",
+                f"{len(pending)} row(s) are still being analyzed. Generate the report once they have finished.")
+            return
         csv_output = self.build_csv_data()
         output_file, _ = QtWidgets.QFileDialog.getSaveFileName(self, "Save Report", "", "CSV Files (*.csv)")
         if output_file:
@@ -266,6 +977,9 @@ class ImageColorClassifier(QtWidgets.QWidget):
                 f.write("row_label,control_L,control_a,control_b,test_L,test_a,test_b,delta_L,delta_a,delta_b\n")
                 for row in csv_output:
                     f.write(",".join([str(x) for x in row]) + "\n")
+            # when profiling is turned on, the timings of every image loaded so
+            # far are written next to the report
+            profiling.write_report(os.path.splitext(output_file)[0])
         self.run_open_folder_dialog(output_file)
 
     def build_csv_data(self):
@@ -277,7 +991,7 @@ class ImageColorClassifier(QtWidgets.QWidget):
         for i in range(len(rows)):
             row = rows[i]
             #if row.is_complete():
-            row_label = row.label.textbox.text()
+            row_label = row.label
             if not row_label:
                 row_label = f"Row {i+1}"
             control_L, control_a, control_b = row.control_image_cell.image_averages
@@ -315,10 +1029,9 @@ class ImageColorClassifier(QtWidgets.QWidget):
 
 
 if __name__ == "__main__":
-    # if any arguments were passed in, call the CLI handler
-    if len(sys.argv) > 1:
-        handle_cli()
     app = QtWidgets.QApplication([])
     window = ImageColorClassifier()
+    app.aboutToQuit.connect(window.histogram_cache.save_stats)
+    app.aboutToQuit.connect(window.thumbnail_cache.save_stats)
     window.show()
     app.exec()
\ No newline at end of file
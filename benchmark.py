@@ -0,0 +1,361 @@
+"""Benchmark suite for the histogram and reporting hot paths. Generates a set of
+synthetic images of several sizes and formats, then times each stage of the
+analysis: image_to_lab_histogram (with both conversion engines),
+image_to_rgb_histogram, lab_hist_weighed_average, ROI histograms from
+precomputed RegionHistograms, the raw histogram CSV output, the GUI's build_csv_data and the startup time of the
+headless CLI. Every benchmark runs in a fresh process so that its peak memory
+can be measured on its own.
+
+For each benchmark the throughput, latency percentiles and peak memory are
+reported. Results can be saved as a baseline and later runs compared against
+it; the exit status is non-zero when a benchmark has regressed by more than the
+tolerance.
+
+    python benchmark.py --save-baseline baseline.json
+    python benchmark.py --baseline baseline.json
+"""
+
+from argparse import ArgumentParser
+from concurrent.futures import ProcessPoolExecutor
+import itertools
+import json
+import multiprocessing
+import os
+import platform
+import sys
+import tempfile
+import time
+import tracemalloc
+
+# (name, width, height) of the synthetic images
+SIZES = {
+    "small": (640, 480),
+    "medium": (2000, 1500),
+    "large": (4000, 3000),
+}
+
+# (name, file extension, PIL mode, save options) of the synthetic images.
+# PIL cannot write 48-bit RGB files, so the 16-bit case is a 16-bit grayscale PNG.
+FORMATS = {
+    "png": (".png", "RGB", {}),
+    "jpeg": (".jpg", "RGB", {"quality": 90}),
+    "bmp": (".bmp", "RGB", {}),
+    "png16": (".png", "I;16", {}),
+}
+
+SEED = 12345
+
+# modules the headless CLI must not import at startup. The startup benchmark
+# fails when any of them is loaded.
+CLI_STARTUP_EXCLUDED = ("PySide6", "PIL", "concurrent.futures.process")
+
+# runs the CLI given as the first argument with the remaining arguments, then
+# lists the modules that were loaded on stderr
+CLI_STARTUP_PROBE = """
+import os, runpy, sys
+sys.argv = sys.argv[1:]
+# run_path does not put the script's folder on sys.path as running it does
+sys.path.insert(0, os.path.dirname(sys.argv[0]))
+try:
+    runpy.run_path(sys.argv[0], run_name="__main__")
+except SystemExit:
+    pass
+print(" ".join(sys.modules), file=sys.stderr)
+"""
+
+# a benchmark has regressed when its median latency or peak memory grows by
+# more than this fraction of the baseline
+DEFAULT_TOLERANCE = 0.10
+
+def synthetic_image(width: int, height: int, mode: str):
+    """Returns a deterministic image resembling a photograph: smooth gradients
+    with some blurred noise, so that it compresses like a real photo rather than
+    like pure noise."""
+    from PIL import Image
+    import numpy as np
+    rng = np.random.default_rng(SEED)
+    y, x = np.mgrid[0:height, 0:width].astype(np.float32)
+    noise = rng.normal(0, 12, (height, width, 3)).astype(np.float32)
+    # cheap blur of the noise by averaging with shifted copies
+    noise = (noise + np.roll(noise, 1, 0) + np.roll(noise, 1, 1) + np.roll(noise, (1, 1), (0, 1))) / 4
+    base = np.stack([
+        180 - 60 * y / height + 20 * np.sin(x / width * 6),
+        120 + 40 * x / width,
+        100 + 30 * np.cos(y / height * 4),
+    ], axis=-1)
+    rgb = np.clip(base + noise, 0, 255).astype(np.uint8)
+    if mode == "I;16":
+        gray = rgb.astype(np.uint32).mean(axis=-1) * 257
+        return Image.fromarray(gray.astype(np.uint16))
+    return Image.fromarray(rgb, "RGB")
+
+def generate_images(folder: str, sizes: list, formats: list) -> dict:
+    """Writes the synthetic images to the folder. Returns their paths keyed by
+    (size, format)."""
+    paths = {}
+    for size in sizes:
+        width, height = SIZES[size]
+        images = {}
+        for fmt in formats:
+            ext, mode, options = FORMATS[fmt]
+            if mode not in images:
+                images[mode] = synthetic_image(width, height, mode)
+            path = os.path.join(folder, f"{size}_{fmt}{ext}")
+            images[mode].save(path, **options)
+            paths[(size, fmt)] = path
+    return paths
+
+def percentile(samples: list, q: float) -> float:
+    """Returns the q-th percentile (0-100) of the samples, by nearest rank."""
+    ordered = sorted(samples)
+    rank = max(0, min(len(ordered) - 1, int(round(q / 100 * len(ordered) + 0.5)) - 1))
+    return ordered[rank]
+
+def __proc_status(field: str):
+    """Returns a memory figure from /proc/self/status in bytes, or None when
+    it is not available."""
+    try:
+        with open("/proc/self/status") as f:
+            for line in f:
+                if line.startswith(field + ":"):
+                    return int(line.split()[1]) * 1024
+    except OSError:
+        pass
+    return None
+
+def reset_peak_rss():
+    """Resets the peak resident set size of the current process, where the
+    platform allows it (Linux), so that the next reading covers only what runs
+    in between."""
+    try:
+        with open("/proc/self/clear_refs", 'w') as f:
+            f.write("5")
+    except OSError:
+        pass
+
+def peak_rss_bytes():
+    """Returns the peak resident set size of the current process, or None
+    where the platform does not report it."""
+    # On Linux ru_maxrss survives exec, so a spawned process would report the
+    # peak of its parent; VmHWM belongs to the process itself
+    peak = __proc_status("VmHWM")
+    if peak is not None:
+        return peak
+    try:
+        import resource
+    except ImportError:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Linux reports kilobytes, macOS bytes
+    return peak if platform.system() == "Darwin" else peak * 1024
+
+def __setup_stage(stage: str, args: dict):
+    """Prepares a benchmark in the worker process. Returns the function to time
+    and the number of pixels it handles per call (0 when not applicable)."""
+    import utils
+    if stage == "image_to_lab_histogram":
+        engine = args.get("engine", "lcms")
+        utils._init_batch_worker(engine)
+        return lambda: utils.image_to_lab_histogram(args["image"], engine=engine), args["pixels"]
+    if stage == "image_to_rgb_histogram":
+        return lambda: utils.image_to_rgb_histogram(args["image"]), args["pixels"]
+    if stage == "lab_hist_weighed_average":
+        hist = utils.image_to_lab_histogram(args["image"])
+        return lambda: utils.lab_hist_weighed_average(hist), 0
+    if stage == "roi_histogram":
+        from roi import RectRoi, PolygonRoi
+        regions = utils.lab_regions(args["image"])
+        width, height = regions.size
+        # the region moves by a few pixels on every call, as when dragging it
+        offsets = itertools.cycle(range(0, width // 4, 7))
+        if args["shape"] == "rect":
+            make_roi = lambda dx: RectRoi(width // 8 + dx, height // 8, width // 2, height // 2)
+        else:
+            make_roi = lambda dx: PolygonRoi([(width // 8 + dx, height // 8), (width * 5 // 8 + dx, height // 4), (width // 3 + dx, height * 3 // 4)])
+        return lambda: regions.histogram(make_roi(next(offsets))), 0
+    if stage == "cli_startup":
+        import subprocess
+        command = [os.path.join(os.path.dirname(os.path.abspath(__file__)), "cli.py"), *args["argv"]]
+        probe = subprocess.run([sys.executable, "-c", CLI_STARTUP_PROBE, *command], capture_output=True, text=True, check=True)
+        loaded = [m for m in CLI_STARTUP_EXCLUDED if m in probe.stderr.split()]
+        if loaded:
+            raise RuntimeError(f"the CLI imports {', '.join(loaded)} at startup")
+        return lambda: subprocess.run([sys.executable, *command], stdout=subprocess.DEVNULL, check=True), 0
+    if stage == "generate_raw_output":
+        hist = utils.image_to_lab_histogram(args["image"])
+        generate_raw_output = getattr(utils, "__generate_raw_output")
+        output = os.path.join(args["folder"], "raw_output")
+        post = [hist] * args["post_images"]
+        raw_format = args.get("raw_format", "csv")
+        return lambda: generate_raw_output(hist, hist, post, post, output, raw_format), 0
+    if stage == "build_csv_data":
+        os.environ.setdefault("QT_QPA_PLATFORM", "offscreen")
+        from PySide6 import QtWidgets
+        import ImageColorClassifier
+        app = QtWidgets.QApplication.instance() or QtWidgets.QApplication([])
+        window = ImageColorClassifier.ImageColorClassifier()
+        for _ in range(args["rows"] - 1):
+            window.add_row()
+        for row in window.rows():
+            for cell in (row.control_image_cell, row.test_image_cell):
+                cell.image_path = args["image"]
+                cell.image_averages = (55.5, 10.25, 4.75)
+        # keep the application alive for as long as the window is in use
+        window.app = app
+        return window.build_csv_data, 0
+    raise ValueError(f"unknown stage {stage}")
+
+def run_benchmark(stage: str, args: dict, repeat: int, warmup: int) -> dict:
+    """Runs a single benchmark. Called in a fresh worker process."""
+    run, pixels = __setup_stage(stage, args)
+    for _ in range(warmup):
+        run()
+    reset_peak_rss()
+    rss_before = __proc_status("VmRSS") or peak_rss_bytes()
+    samples = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        run()
+        samples.append(time.perf_counter() - start)
+    rss_after = peak_rss_bytes()
+    # tracing slows down allocations several times over, so the peak Python
+    # memory comes from a separate untimed pass
+    tracemalloc.start()
+    run()
+    _, traced_peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    total = sum(samples)
+    result = {
+        "iterations": repeat,
+        "ops_per_s": repeat / total,
+        "p50_ms": percentile(samples, 50) * 1000,
+        "p90_ms": percentile(samples, 90) * 1000,
+        "p99_ms": percentile(samples, 99) * 1000,
+        "peak_python_mb": traced_peak / 2**20,
+        "peak_rss_mb": rss_after / 2**20 if rss_after is not None else None,
+        "peak_rss_growth_mb": (rss_after - rss_before) / 2**20 if rss_after is not None else None,
+    }
+    if pixels:
+        result["megapixels_per_s"] = pixels * repeat / total / 1e6
+    return result
+
+def benchmark_cases(paths: dict, folder: str, sizes: list, formats: list) -> list:
+    """Returns (name, stage, args) for every benchmark to run."""
+    cases = []
+    for size in sizes:
+        width, height = SIZES[size]
+        for fmt in formats:
+            args = {"image": paths[(size, fmt)], "pixels": width * height}
+            cases.append((f"image_to_lab_histogram[{size}-{fmt}]", "image_to_lab_histogram", args))
+            cases.append((f"image_to_rgb_histogram[{size}-{fmt}]", "image_to_rgb_histogram", args))
+        args = {"image": paths[(size, formats[0])], "pixels": width * height, "engine": "lut"}
+        cases.append((f"image_to_lab_histogram[{size}-{formats[0]}-lut]", "image_to_lab_histogram", args))
+        for shape in ("rect", "poly"):
+            cases.append((f"roi_histogram[{size}-{shape}]", "roi_histogram", {"image": paths[(size, formats[0])], "shape": shape}))
+    image = paths[(sizes[0], formats[0])]
+    cases.append(("lab_hist_weighed_average", "lab_hist_weighed_average", {"image": image}))
+    cases.append(("generate_raw_output[2x10-post]", "generate_raw_output", {"image": image, "folder": folder, "post_images": 10}))
+    cases.append(("generate_raw_output[2x10-post-npz]", "generate_raw_output", {"image": image, "folder": folder, "post_images": 10, "raw_format": "npz"}))
+    cases.append(("build_csv_data[200-rows]", "build_csv_data", {"image": image, "rows": 200}))
+    cases.append(("cli_startup[help]", "cli_startup", {"argv": ["--help"]}))
+    return cases
+
+def run_suite(sizes: list, formats: list, repeat: int, warmup: int, only: str = None) -> tuple:
+    """Runs every benchmark, each in a fresh process. Benchmarks whose
+    dependencies are unavailable (e.g. PySide6 for build_csv_data) are skipped.
+    Returns (results, failures): a benchmark that fails is reported and listed
+    in failures, and the other benchmarks still run."""
+    results, failures = {}, []
+    context = multiprocessing.get_context("spawn")
+    with tempfile.TemporaryDirectory() as folder:
+        paths = generate_images(folder, sizes, formats)
+        for name, stage, args in benchmark_cases(paths, folder, sizes, formats):
+            if only and only not in name:
+                continue
+            with ProcessPoolExecutor(max_workers=1, mp_context=context) as pool:
+                try:
+                    results[name] = pool.submit(run_benchmark, stage, args, repeat, warmup).result()
+                except ImportError as e:
+                    print(f"skipping {name}: {e}", file=sys.stderr)
+                    continue
+                except Exception as e:
+                    print(f"FAILED {name}: {type(e).__name__}: {e}", file=sys.stderr)
+                    failures.append(name)
+                    continue
+            print(format_result(name, results[name]))
+    return results, failures
+
+def format_result(name: str, result: dict) -> str:
+    """Returns a single line summary of a benchmark result."""
+    line = f"{name:48} p50 {result['p50_ms']:9.2f}ms  p90 {result['p90_ms']:9.2f}ms  p99 {result['p99_ms']:9.2f}ms"
+    if "megapixels_per_s" in result:
+        line += f"  {result['megapixels_per_s']:7.1f} MP/s"
+    else:
+        line += f"  {result['ops_per_s']:9.1f} op/s"
+    if result["peak_rss_mb"] is not None:
+        line += f"  rss {result['peak_rss_mb']:7.1f}MB"
+    return line
+
+def compare(results: dict, baseline: dict, tolerance: float) -> list:
+    """Returns a description of each benchmark that regressed against the
+    baseline: a median latency or peak memory more than the tolerance above the
+    baseline's."""
+    regressions = []
+    for name, result in results.items():
+        base = baseline.get(name)
+        if base is None:
+            continue
+        for metric in ("p50_ms", "peak_rss_mb", "peak_python_mb"):
+            if result.get(metric) is None or not base.get(metric):
+                continue
+            change = result[metric] / base[metric] - 1
+            if change > tolerance:
+                regressions.append(f"{name}: {metric} {base[metric]:.2f} -> {result[metric]:.2f} (+{change:.0%})")
+    return regressions
+
+def main():
+    parser = ArgumentParser(description="Benchmarks the histogram and reporting hot paths on synthetic images.")
+    parser.add_argument("--sizes", nargs="+", choices=list(SIZES), default=list(SIZES),
+        help="Image sizes to benchmark (default: all)")
+    parser.add_argument("--formats", nargs="+", choices=list(FORMATS), default=list(FORMATS),
+        help="Image formats to benchmark (default: all)")
+    parser.add_argument("--repeat", type=int, default=10,
+        help="Number of timed iterations of each benchmark (default: 10)")
+    parser.add_argument("--warmup", type=int, default=1,
+        help="Number of untimed iterations before timing (default: 1)")
+    parser.add_argument("--only",
+        help="Only run the benchmarks whose name contains this text")
+    parser.add_argument("--output",
+        help="Write the results to this JSON file")
+    parser.add_argument("--save-baseline", metavar="FILE",
+        help="Write the results to FILE for use with --baseline")
+    parser.add_argument("--baseline", metavar="FILE",
+        help="Compare the results against a baseline written by --save-baseline")
+    parser.add_argument("--tolerance", type=float, default=DEFAULT_TOLERANCE,
+        help=f"Fraction by which a benchmark may be slower or use more memory than the baseline before it counts as a regression (default: {DEFAULT_TOLERANCE})")
+    args = parser.parse_args()
+
+    results, failures = run_suite(args.sizes, args.formats, args.repeat, args.warmup, args.only)
+    report = {
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "results": results,
+    }
+    for path in (args.output, args.save_baseline):
+        if path:
+            with open(path, 'w') as f:
+                json.dump(report, f, indent=2)
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)["results"]
+        regressions = compare(results, baseline, args.tolerance)
+        for regression in regressions:
+            print(f"REGRESSION {regression}")
+        if regressions:
+            sys.exit(1)
+        print(f"No regressions against {args.baseline}")
+    if failures:
+        sys.exit(f"{len(failures)} benchmark(s) failed: {', '.join(failures)}")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,22 @@
+"""Headless entry point of the CLI. Unlike ImageColorClassifier.py it never
+imports the GUI toolkit, so scheduled jobs and hosts without a display start
+quickly and do not need PySide6 installed at all. Accepts the same arguments,
+see utils.handle_cli."""
+
+import sys
+
+def main(argv: list = None) -> int:
+    """Runs the CLI with the arguments (sys.argv by default) and returns the
+    exit status."""
+    if getattr(sys, "frozen", False):
+        # required for the CLI's worker processes when running as a frozen
+        # pyinstaller executable. multiprocessing is slow to import, so this
+        # is skipped otherwise.
+        import multiprocessing
+        multiprocessing.freeze_support()
+    from utils import handle_cli
+    handle_cli(argv)
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
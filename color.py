@@ -0,0 +1,215 @@
+"""Color management of the conversion to LAB. Images are converted from the ICC
+profile embedded in them, e.g. Adobe RGB or Display P3 from some cameras, or
+from sRGB when they have none. LittleCMS always produces LAB relative to the
+D50 white of the ICC connection space; for other illuminants the result is
+chromatically adapted (Bradford) to the illuminant's white. Building a
+transform is expensive, so the compiled transforms are kept in a bounded cache
+keyed by a hash of the profile, the rendering intent and the white point, and
+a batch of photos from a handful of cameras only builds a handful of
+transforms."""
+
+from collections import OrderedDict
+import hashlib
+import io
+import threading
+import numpy as np
+import profiling
+
+# White points (XYZ, Y = 1) of the named illuminants. Other illuminants are
+# given by color temperature and lie on the CIE daylight locus.
+ILLUMINANTS = {
+    "D50": (0.9642, 1.0, 0.8249),
+    "D55": (0.9568, 1.0, 0.9214),
+    "D65": (0.9504, 1.0, 1.0888),
+    "D75": (0.9497, 1.0, 1.2264),
+}
+# the white of the ICC connection space, which needs no adaptation
+DEFAULT_ILLUMINANT = "D50"
+
+# The CIE daylight locus is only defined within this range
+ILLUMINANT_RANGE = (4000, 25000)
+
+RENDERING_INTENTS = {"perceptual": 0, "relative": 1, "saturation": 2, "absolute": 3}
+DEFAULT_INTENT = "perceptual"
+
+# Modes images are converted to before applying a transform from a profile of
+# each color space. Profiles of other color spaces are ignored.
+PROFILE_MODES = {"RGB ": "RGB", "GRAY": "L", "CMYK": "CMYK"}
+
+# Maximum number of compiled transforms kept per process
+TRANSFORM_CACHE_SIZE = 16
+
+BRADFORD = np.array([
+    [0.8951, 0.2664, -0.1614],
+    [-0.7502, 1.7135, 0.0367],
+    [0.0389, -0.0685, 1.0296],
+])
+
+_transforms = OrderedDict()
+_lock = threading.Lock()
+
+class LabTransform:
+    """A compiled transform to LAB, along with the mode images have to be
+    converted to before it is applied, the name identifying it (e.g.
+    sRGB->LAB;D50 or icc:<hash>->LAB;D65) and, for illuminants other than
+    D50, the adaptation table mapping its output to the illuminant's white
+    (see adaptation_table)."""
+
+    __slots__ = ("transform", "mode", "name", "adaptation")
+
+    def __init__(self, transform, mode: str, name: str, adaptation: np.ndarray = None):
+        self.transform = transform
+        self.mode = mode
+        self.name = name
+        self.adaptation = adaptation
+
+    def __repr__(self):
+        return f"LabTransform({self.name!r}, mode={self.mode!r})"
+
+class ColorSettings:
+    """How images are converted to LAB: the illuminant whose white the LAB
+    values are relative to, the rendering intent, and whether the ICC
+    profiles embedded in the images are used. Images without a profile, or
+    all images when embedded is False, are assumed to be sRGB."""
+
+    def __init__(self, illuminant: str = DEFAULT_ILLUMINANT, intent: str = DEFAULT_INTENT, embedded: bool = True):
+        if intent not in RENDERING_INTENTS:
+            raise ValueError(f"unknown rendering intent {intent!r}; expected {', '.join(RENDERING_INTENTS)}")
+        self.illuminant = parse_illuminant(illuminant)
+        self.intent = intent
+        self.embedded = embedded
+
+    def __repr__(self):
+        return f"ColorSettings(illuminant={self.illuminant!r}, intent={self.intent!r}, embedded={self.embedded})"
+
+    def params(self) -> str:
+        """Returns the parameters identifying the settings in cache keys. The
+        profiles themselves are part of the image files, so their hash is
+        already part of the key."""
+        params = f"{'ICC' if self.embedded else 'sRGB'}->LAB;{self.illuminant}"
+        if self.intent != DEFAULT_INTENT:
+            params += f";intent={self.intent}"
+        return params
+
+    def srgb_transform(self) -> LabTransform:
+        """Returns the transform of images without an embedded profile."""
+        return get_transform(None, self.illuminant, self.intent)
+
+    def transform_for(self, image) -> LabTransform:
+        """Returns the transform converting the opened image to LAB."""
+        icc_profile = image.info.get("icc_profile") if self.embedded else None
+        return get_transform(icc_profile or None, self.illuminant, self.intent)
+
+def parse_illuminant(spec: str) -> str:
+    """Parses an illuminant given by name (D50, D55, D65 or D75) or as a color
+    temperature in kelvin (e.g. 5000 or 5000K). Returns its name, e.g. D65 or
+    5000K. Raises ValueError if the specification is not valid."""
+    spec = str(spec).strip().upper()
+    if spec in ILLUMINANTS:
+        return spec
+    try:
+        temperature = int(spec[:-1] if spec.endswith("K") else spec)
+    except ValueError:
+        raise ValueError(f"invalid illuminant {spec!r}; expected {', '.join(ILLUMINANTS)} or a color temperature")
+    if not ILLUMINANT_RANGE[0] <= temperature <= ILLUMINANT_RANGE[1]:
+        raise ValueError(f"color temperature {temperature}K is outside {ILLUMINANT_RANGE[0]}-{ILLUMINANT_RANGE[1]}K")
+    return f"{temperature}K"
+
+def white_point(illuminant: str) -> np.ndarray:
+    """Returns the XYZ white point (Y = 1) of an illuminant returned by
+    parse_illuminant."""
+    if illuminant in ILLUMINANTS:
+        return np.array(ILLUMINANTS[illuminant])
+    t = int(illuminant[:-1])
+    if t <= 7000:
+        x = -4.6070e9 / t**3 + 2.9678e6 / t**2 + 0.09911e3 / t + 0.244063
+    else:
+        x = -2.0064e9 / t**3 + 1.9018e6 / t**2 + 0.24748e3 / t + 0.237040
+    y = -3.0 * x * x + 2.87 * x - 0.275
+    return np.array([x / y, 1.0, (1 - x - y) / y])
+
+DEFAULT_COLOR = ColorSettings()
+
+def __lab_f(t: np.ndarray) -> np.ndarray:
+    d = 6 / 29
+    return np.where(t > d**3, np.cbrt(t), t / (3 * d * d) + 4 / 29)
+
+def __lab_f_inv(t: np.ndarray) -> np.ndarray:
+    d = 6 / 29
+    return np.where(t > d, t**3, 3 * d * d * (t - 4 / 29))
+
+def __fill_adaptation(table: np.ndarray, illuminant: str, block: int = 1 << 20):
+    """Fills the adaptation table of the illuminant, see adaptation_table."""
+    source, target = white_point(DEFAULT_ILLUMINANT), white_point(illuminant)
+    cone = np.diag((BRADFORD @ target) / (BRADFORD @ source))
+    # from XYZ relative to the D50 white to XYZ relative to the target white
+    adapt = np.diag(1 / target) @ np.linalg.inv(BRADFORD) @ cone @ BRADFORD @ np.diag(source)
+    for start in range(0, len(table), block):
+        index = np.arange(start, start + block, dtype=np.uint32)
+        L = (index & 0xFF) / 2.55
+        # a* and b* are stored as signed bytes
+        a = ((index >> 8) & 0xFF).astype(np.uint8).view(np.int8)
+        b = ((index >> 16) & 0xFF).astype(np.uint8).view(np.int8)
+        fy = (L + 16) / 116
+        xyz = np.stack([__lab_f_inv(fy + a / 500), __lab_f_inv(fy), __lab_f_inv(fy - b / 200)])
+        fx, fy, fz = __lab_f(adapt @ xyz)
+        L = np.clip(np.rint((116 * fy - 16) * 2.55), 0, 255).astype(np.uint32)
+        a = np.clip(np.rint(500 * (fx - fy)) + 128, 0, 255).astype(np.uint32)
+        b = np.clip(np.rint(200 * (fy - fz)) + 128, 0, 255).astype(np.uint32)
+        table[start:start + block] = L | (a << 8) | (b << 16)
+
+def adaptation_table(illuminant: str) -> np.ndarray:
+    """Returns the table adapting LAB values relative to D50, as LittleCMS
+    produces them, to the white of the illuminant. It is indexed by a LAB
+    pixel as PIL stores it (L + a * 256 + b * 65536, with a* and b* as signed
+    bytes), and holds the adapted histogram bins packed the same way as the
+    entries of a lab_lut table. Like those, it is built once per machine and
+    memory-mapped from the cache directory. Returns None for D50."""
+    if illuminant == DEFAULT_ILLUMINANT:
+        return None
+    import lab_lut
+    path = lab_lut.lut_path(f"LAB;D50->{illuminant}", prefix="lab_adapt")
+    return lab_lut.load_table(path, lambda table: __fill_adaptation(table, illuminant), "build_adaptation")
+
+def __source_profile(icc_profile: bytes) -> tuple:
+    """Returns the opened source profile and the mode images are converted to
+    for it, or (None, None) when the profile cannot be used."""
+    from PIL import ImageCms
+    try:
+        profile = ImageCms.ImageCmsProfile(io.BytesIO(icc_profile))
+    except (OSError, ImageCms.PyCMSError):
+        return None, None
+    mode = PROFILE_MODES.get(profile.profile.xcolor_space)
+    return (profile, mode) if mode else (None, None)
+
+def get_transform(icc_profile: bytes = None, illuminant: str = DEFAULT_ILLUMINANT, intent: str = DEFAULT_INTENT) -> LabTransform:
+    """Returns the transform from the ICC profile, or from sRGB when none is
+    given, to LAB relative to the illuminant's white. Transforms are built the
+    first time they are requested in the current process and cached, up to
+    TRANSFORM_CACHE_SIZE of them, the least recently used being dropped
+    first. A profile that cannot be read, or that is not of an RGB, gray or
+    CMYK color space, is ignored and sRGB is used instead."""
+    digest = hashlib.sha256(icc_profile).hexdigest() if icc_profile else None
+    key = (digest, illuminant, intent)
+    with _lock:
+        lab_transform = _transforms.get(key)
+        if lab_transform is not None:
+            _transforms.move_to_end(key)
+            return lab_transform
+    from PIL import ImageCms
+    with profiling.stage("build_transform"):
+        source, mode = __source_profile(icc_profile) if icc_profile else (None, None)
+        if source is None:
+            source, mode, digest = ImageCms.createProfile('sRGB'), "RGB", None
+        transform = ImageCms.buildTransformFromOpenProfiles(source, ImageCms.createProfile('LAB'), mode, "LAB",
+            renderingIntent=RENDERING_INTENTS[intent])
+        adaptation = adaptation_table(illuminant)
+    name = f"{'icc:' + digest[:16] if digest else 'sRGB'}->LAB;{illuminant}"
+    if intent != DEFAULT_INTENT:
+        name += f";intent={intent}"
+    lab_transform = LabTransform(transform, mode, name, adaptation)
+    with _lock:
+        _transforms[key] = lab_transform
+        while len(_transforms) > TRANSFORM_CACHE_SIZE:
+            _transforms.popitem(last=False)
+    return lab_transform
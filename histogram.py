@@ -0,0 +1,139 @@
+"""Compact histogram types used throughout the application. A histogram holds
+the 256 bins of every channel of an image in a single unsigned 64-bit NumPy
+array, so that statistics can be computed with vectorized operations and
+histograms of many images can be added together cheaply."""
+
+import numpy as np
+
+BINS = 256
+
+# L* is stored in the 0-255 range for values of 0-100, while a* and b* are
+# stored offset by 128. Bin values are converted to L*a*b* units by dividing by
+# LAB_DIVISOR and then adding LAB_OFFSET.
+LAB_DIVISOR = np.array([2.55, 1.0, 1.0])
+LAB_OFFSET = np.array([0.0, -128.0, -128.0])
+
+class Histogram:
+    """Per-channel histogram of an image, stored as a (channels, bins) array of
+    unsigned 64-bit counts. Indexing returns the bins of a single channel, so a
+    Histogram may be used wherever a list of per-channel lists was expected."""
+
+    __slots__ = ("counts",)
+
+    def __init__(self, counts):
+        counts = np.asarray(counts)
+        if counts.ndim != 2:
+            raise ValueError(f"expected a (channels, bins) array, got shape {counts.shape}")
+        self.counts = np.ascontiguousarray(counts, dtype=np.uint64)
+
+    @classmethod
+    def from_flat(cls, flat, channels: int = 3):
+        """Creates a histogram from the concatenated per-channel bins returned by
+        PIL's Image.histogram() for multi-band images."""
+        return cls(np.asarray(flat, dtype=np.uint64).reshape(channels, -1))
+
+    @classmethod
+    def zeros(cls, channels: int = 3, bins: int = BINS):
+        """Creates an empty histogram."""
+        return cls(np.zeros((channels, bins), dtype=np.uint64))
+
+    @classmethod
+    def merge(cls, histograms):
+        """Returns the sum of the histograms, e.g. the combined histogram of a
+        cohort of images."""
+        histograms = list(histograms)
+        if not histograms:
+            raise ValueError("at least one histogram is required")
+        return cls(np.sum([as_histogram(h).counts for h in histograms], axis=0, dtype=np.uint64))
+
+    def __len__(self):
+        return self.counts.shape[0]
+
+    def __getitem__(self, channel):
+        return self.counts[channel]
+
+    def __iter__(self):
+        return iter(self.counts)
+
+    def __add__(self, other):
+        return type(self)(self.counts + as_histogram(other).counts)
+
+    def __iadd__(self, other):
+        self.counts += as_histogram(other).counts
+        return self
+
+    def __eq__(self, other):
+        if not isinstance(other, Histogram):
+            return NotImplemented
+        return np.array_equal(self.counts, other.counts)
+
+    def __repr__(self):
+        return f"{type(self).__name__}(channels={len(self)}, pixels={self.pixel_count().tolist()})"
+
+    def __reduce__(self):
+        return (type(self), (self.counts,))
+
+    def tolist(self) -> list:
+        """Returns the histogram as a list of per-channel lists of ints."""
+        return self.counts.tolist()
+
+    def pixel_count(self) -> np.ndarray:
+        """Returns the number of pixels counted in each channel."""
+        return self.counts.sum(axis=1)
+
+    def mean(self) -> np.ndarray:
+        """Returns the mean bin value of each channel."""
+        bins = np.arange(self.counts.shape[1], dtype=np.uint64)
+        # the weighted sums are exact integers; convert to float only to divide
+        weighted_sum = (self.counts * bins).sum(axis=1)
+        return weighted_sum.astype(np.float64) / self.pixel_count().astype(np.float64)
+
+    def std(self) -> np.ndarray:
+        """Returns the (population) standard deviation of each channel."""
+        bins = np.arange(self.counts.shape[1], dtype=np.float64)
+        deviations = (bins[np.newaxis, :] - self.mean()[:, np.newaxis]) ** 2
+        variance = (self.counts * deviations).sum(axis=1) / self.pixel_count()
+        return np.sqrt(variance)
+
+    def percentile(self, q) -> np.ndarray:
+        """Returns the q-th percentile (0-100) of each channel: the lowest bin
+        at which the cumulative count reaches q percent of the pixels."""
+        cumulative = np.cumsum(self.counts, axis=1)
+        # the 0th percentile is the lowest populated bin
+        thresholds = np.maximum(np.ceil(cumulative[:, -1] * (q / 100.0)), 1)
+        return (cumulative < thresholds[:, np.newaxis]).sum(axis=1).astype(np.float64)
+
+    def median(self) -> np.ndarray:
+        """Returns the median bin value of each channel."""
+        return self.percentile(50)
+
+class LabHistogram(Histogram):
+    """Histogram of an image in the CIELAB color space, with statistics
+    expressed in L*a*b* units rather than bin indexes."""
+
+    __slots__ = ()
+
+    def lab_mean(self) -> np.ndarray:
+        """Returns the mean L*, a* and b* values."""
+        return self.mean() / LAB_DIVISOR + LAB_OFFSET
+
+    def lab_std(self) -> np.ndarray:
+        """Returns the standard deviation of L*, a* and b*."""
+        return self.std() / LAB_DIVISOR
+
+    def lab_percentile(self, q) -> np.ndarray:
+        """Returns the q-th percentile (0-100) of L*, a* and b*."""
+        return self.percentile(q) / LAB_DIVISOR + LAB_OFFSET
+
+    def lab_median(self) -> np.ndarray:
+        """Returns the median L*, a* and b* values."""
+        return self.lab_percentile(50)
+
+def as_histogram(hist, cls=Histogram) -> Histogram:
+    """Returns hist as an instance of cls, converting lists of per-channel bins
+    and other histogram types."""
+    if isinstance(hist, cls):
+        return hist
+    if isinstance(hist, Histogram):
+        return cls(hist.counts)
+    return cls(hist)
@@ -0,0 +1,232 @@
+"""Persistent, content-addressed cache of image histograms. Entries are keyed by
+a hash of the image file contents together with the parameters of the color
+transform that produced them, so renaming or copying an image still hits the
+cache while editing it (or changing how it is analyzed) does not. The cache
+directory is bounded in size; the least recently used entries are evicted first.
+The lookup tables of the lut engine (see lab_lut) are kept in the same
+directory and count toward its size. The GUI's image thumbnails are cached the
+same way by ThumbnailCache.
+"""
+
+from histogram import as_histogram
+import hashlib
+import json
+import numpy as np
+import os
+import platform
+import threading
+
+# 512MB holds a few of the 64MB lookup tables of the lut engine along with
+# tens of thousands of LAB histograms
+DEFAULT_MAX_BYTES = 512 * 1024 * 1024
+
+STATS_FILE = "stats.json"
+
+# files of the cache directory in use by this process, which are never evicted
+_pinned = set()
+
+def pin(path: str):
+    """Keeps the file in the cache directory from being evicted by this
+    process, e.g. a lookup table it has memory-mapped."""
+    _pinned.add(os.path.abspath(path))
+
+def default_cache_dir() -> str:
+    """Returns the directory used for the cache when none is specified. The
+    IMAGE_COLOR_CLASSIFIER_CACHE environment variable takes precedence over the
+    platform's usual per-user cache location."""
+    override = os.environ.get("IMAGE_COLOR_CLASSIFIER_CACHE")
+    if override:
+        return override
+    if platform.system() == "Windows":
+        base = os.environ.get("LOCALAPPDATA", os.path.expanduser("~"))
+        return os.path.join(base, "ImageColorClassifier", "cache")
+    base = os.environ.get("XDG_CACHE_HOME", os.path.join(os.path.expanduser("~"), ".cache"))
+    return os.path.join(base, "image_color_classifier")
+
+def set_default_cache_dir(cache_dir: str):
+    """Makes the directory the default cache directory of this process and
+    any worker processes it starts afterwards, so that the lookup tables of
+    the lut engine are kept with the histograms of a cache in that
+    directory."""
+    os.environ["IMAGE_COLOR_CLASSIFIER_CACHE"] = cache_dir
+
+def file_digest(path: str, chunk_size: int = 1024 * 1024) -> str:
+    """Returns the SHA-256 hex digest of the contents of the file."""
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(chunk_size), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+class HistogramCache:
+    """A size-bounded directory of histograms. Each entry is a single file
+    holding the 256 bins of every channel as unsigned 64-bit integers. The
+    modification time of an entry is refreshed whenever it is read, which gives
+    the least-recently-used order for eviction. The lookup tables in the
+    directory count toward its size and are evicted along with the entries."""
+
+    entry_suffix = ".hist"
+    # other files counted and evicted with the entries
+    extra_suffixes = (".lut",)
+
+    def __init__(self, cache_dir: str = None, max_bytes: int = DEFAULT_MAX_BYTES):
+        self.cache_dir = cache_dir or default_cache_dir()
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._size = None
+        self._lock = threading.Lock()
+        os.makedirs(self.cache_dir, exist_ok=True)
+
+    def key(self, image_path: str, params: str, digest: str = None) -> str:
+        """Returns the cache key for the image analyzed with the specified
+        transform parameters. The file digest of the image may be passed in
+        when it is already known, to avoid hashing the file again."""
+        key = hashlib.sha256((digest or file_digest(image_path)).encode())
+        key.update(params.encode())
+        return key.hexdigest()
+
+    def _entry_path(self, key: str) -> str:
+        return os.path.join(self.cache_dir, key + self.entry_suffix)
+
+    def _read_entry(self, key: str, decode):
+        """Returns the contents of the entry passed through decode, or None if
+        there is no such entry or it cannot be decoded."""
+        path = self._entry_path(key)
+        try:
+            with open(path, 'rb') as f:
+                data = decode(f.read())
+            os.utime(path)
+        except (FileNotFoundError, ValueError):
+            with self._lock:
+                self.misses += 1
+            return None
+        with self._lock:
+            self.hits += 1
+        return data
+
+    def get(self, key: str):
+        """Returns the (channels, bins) array of counts stored under the key, or
+        None if the key is not in the cache."""
+        return self._read_entry(key, lambda data: np.frombuffer(data, dtype='<u8').reshape(3, -1).astype(np.uint64))
+
+    def put(self, key: str, hist):
+        """Stores the histograms under the key, evicting the least recently used
+        entries if the cache has grown past its size limit."""
+        self._write_entry(key, as_histogram(hist).counts.astype('<u8').tobytes())
+
+    def _write_entry(self, key: str, data: bytes):
+        """Writes the entry, then evicts the least recently used entries if the
+        cache has grown past its size limit."""
+        path = self._entry_path(key)
+        # write to a temporary file first so a concurrent reader never sees a
+        # partially written entry
+        tmp_path = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+        with open(tmp_path, 'wb') as f:
+            f.write(data)
+        os.replace(tmp_path, path)
+        with self._lock:
+            if self._size is None:
+                self._size = self.__scan_size()
+            else:
+                self._size += len(data)
+            if self._size > self.max_bytes:
+                self.__evict()
+
+    def __entries(self) -> list:
+        """Returns (mtime, size, path) for every entry in the cache."""
+        entries = []
+        suffixes = (self.entry_suffix, *self.extra_suffixes)
+        with os.scandir(self.cache_dir) as it:
+            for entry in it:
+                if entry.name.endswith(suffixes):
+                    try:
+                        st = entry.stat()
+                    except FileNotFoundError:
+                        continue
+                    entries.append((st.st_mtime, st.st_size, entry.path))
+        return entries
+
+    def __scan_size(self) -> int:
+        return sum(size for _, size, _ in self.__entries())
+
+    def __evict(self):
+        """Removes the least recently used entries until the cache is back
+        under 90% of its size limit, leaving headroom for new entries."""
+        entries = sorted(self.__entries())
+        size = sum(size for _, size, _ in entries)
+        target = self.max_bytes * 0.9
+        for _, entry_size, path in entries:
+            if size <= target:
+                break
+            if os.path.abspath(path) in _pinned:
+                continue
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+            except PermissionError:
+                # a table mapped by another process, which Windows does not
+                # allow to be removed
+                continue
+            size -= entry_size
+            self.evictions += 1
+        self._size = size
+
+    def stats(self) -> dict:
+        """Returns the hit/miss statistics for this session along with the
+        totals recorded by previous sessions."""
+        with self._lock:
+            session = {"hits": self.hits, "misses": self.misses, "evictions": self.evictions}
+        totals = self.__load_stats()
+        return {
+            "session": session,
+            "total": {k: totals.get(k, 0) + v for k, v in session.items()},
+            "size_bytes": self.__scan_size(),
+            "max_bytes": self.max_bytes,
+        }
+
+    def __load_stats(self) -> dict:
+        try:
+            with open(os.path.join(self.cache_dir, STATS_FILE)) as f:
+                return json.load(f)
+        except (FileNotFoundError, ValueError):
+            return {}
+
+    def save_stats(self):
+        """Adds the statistics for this session to the totals recorded in the
+        cache directory, then resets the session counters."""
+        with self._lock:
+            totals = self.__load_stats()
+            for name in ("hits", "misses", "evictions"):
+                totals[name] = totals.get(name, 0) + getattr(self, name)
+                setattr(self, name, 0)
+            path = os.path.join(self.cache_dir, STATS_FILE)
+            tmp_path = f"{path}.{os.getpid()}.tmp"
+            with open(tmp_path, 'w') as f:
+                json.dump(totals, f)
+            os.replace(tmp_path, path)
+
+# 100x100 PNG thumbnails are typically 10-30KB, so this holds several thousand
+DEFAULT_THUMBNAIL_MAX_BYTES = 128 * 1024 * 1024
+
+class ThumbnailCache(HistogramCache):
+    """A size-bounded directory of PNG thumbnails, keyed by the content hash of
+    the image they were made from. Kept in the thumbnails subdirectory of the
+    histogram cache directory by default."""
+
+    entry_suffix = ".png"
+    extra_suffixes = ()
+
+    def __init__(self, cache_dir: str = None, max_bytes: int = DEFAULT_THUMBNAIL_MAX_BYTES):
+        super().__init__(cache_dir or os.path.join(default_cache_dir(), "thumbnails"), max_bytes)
+
+    def get(self, digest: str):
+        """Returns the PNG data of the thumbnail of the image with the digest,
+        or None if it is not in the cache."""
+        return self._read_entry(digest, bytes)
+
+    def put(self, digest: str, png: bytes):
+        """Stores the PNG data of the thumbnail of the image with the digest."""
+        self._write_entry(digest, png)
@@ -0,0 +1,217 @@
+"""Lookup table engine for the RGB to LAB conversion. 8-bit RGB has only 2^24
+possible colors, so instead of running every pixel through LittleCMS the
+transform is applied once to every color and the results are stored in a
+table, after which images are converted with vectorized table lookups. The
+table is exact: each entry is what ImageCms.applyTransform returns for that
+color, and verify_lut checks every one of them.
+
+The table is kept as a file in the cache directory, named after the transform
+and the Pillow and LittleCMS versions, and is memory-mapped read-only, so that
+every worker process shares the same copy in the page cache. Each entry is a
+little-endian 32-bit word holding the L*, a* and b* histogram bins (the values
+Image.histogram() counts) in its first three bytes. Entries are indexed by
+R + G * 256 + B * 65536, which is how a pixel reads when PIL packs it as RGBX
+and it is viewed as a little-endian 32-bit word.
+
+Transforms to LAB relative to an illuminant other than D50 are completed by an
+adaptation table (see color.adaptation_table), which is stored the same way
+and is composed into the lookup table when it is built, so the lut engine
+still needs a single lookup per pixel.
+
+Tables count toward the size of the histogram cache and are evicted with its
+entries when they have not been used for a while. Processes that need the
+same new table at once, such as the workers of a batch, take turns through a
+lock file, so the table is only built by one of them."""
+
+from PIL import Image, ImageCms
+from contextlib import contextmanager
+from histogram import LabHistogram
+from histogram_cache import default_cache_dir, pin
+from utils import STRIP_BYTES_PER_PIXEL, image_strips
+import PIL
+import hashlib
+import numpy as np
+import os
+import profiling
+import time
+
+LUT_ENTRIES = 1 << 24
+LUT_DTYPE = np.dtype("<u4")
+
+# Number of blue values converted at a time while building or verifying the
+# table: 16 x 65536 colors, about 16MB of temporary images.
+BUILD_BLOCK = 16
+
+# Pixels looked up at a time when converting an image without a memory
+# budget, which keeps the temporary arrays small enough to stay in cache.
+STRIP_PIXELS = 1 << 19
+
+# A lock file older than this many seconds was left behind by a process that
+# died while building the table, and is ignored. Building takes a few seconds.
+BUILD_LOCK_TIMEOUT = 300
+
+# tables mapped by the current process, keyed by path
+_tables = {}
+
+def lut_path(params: str, cache_dir: str = None, prefix: str = "rgb2lab") -> str:
+    """Returns the path of the table of the transform identified by params.
+    The Pillow and LittleCMS versions are part of the name, since a different
+    LittleCMS may round some colors differently."""
+    versions = f"{params};pillow={PIL.__version__};lcms={ImageCms.core.littlecms_version}"
+    name = hashlib.sha256(versions.encode()).hexdigest()[:16]
+    return os.path.join(cache_dir or default_cache_dir(), f"{prefix}_{name}.lut")
+
+def __color_block(blue: int) -> Image.Image:
+    """Returns an RGB image of every color whose blue value is within
+    [blue, blue + BUILD_BLOCK), in table order."""
+    index = np.arange(blue << 16, (blue + BUILD_BLOCK) << 16, dtype=np.uint32)
+    rgb = np.stack([index & 0xFF, (index >> 8) & 0xFF, index >> 16], axis=-1).astype(np.uint8)
+    return Image.fromarray(rgb.reshape(BUILD_BLOCK * 256, 256, 3), "RGB")
+
+def pack_lab(lab: np.ndarray) -> np.ndarray:
+    """Returns the pixels of a LAB image, as a (..., 3) array of the bytes PIL
+    stores, packed into little-endian 32-bit words L + a * 256 + b * 65536:
+    the indices of an adaptation table."""
+    return lab[..., 0].astype(LUT_DTYPE) | (lab[..., 1].astype(LUT_DTYPE) << 8) | (lab[..., 2].astype(LUT_DTYPE) << 16)
+
+def lab_bins(lab: Image.Image, adaptation: np.ndarray = None) -> np.ndarray:
+    """Returns the histogram bins of a LAB image converted by ImageCms, as a
+    (height, width, 4) array whose last byte is unused, adapted to the
+    illuminant of the adaptation table when one is given."""
+    if adaptation is not None:
+        return adaptation[pack_lab(np.asarray(lab))].view(np.uint8).reshape(lab.height, lab.width, 4)
+    bins = np.zeros((lab.height, lab.width, 4), dtype=np.uint8)
+    bins[:, :, :3] = np.asarray(lab)
+    # PIL stores a* and b* as signed bytes, and its histogram() offsets them by
+    # 128 into the 0-255 bins
+    bins[:, :, 1:3] ^= 0x80
+    return bins
+
+def bins_histogram(bins: np.ndarray) -> LabHistogram:
+    """Returns the LAB histograms of packed bins, such as the entries of a
+    table."""
+    bins = np.ascontiguousarray(bins).view(LUT_DTYPE).ravel()
+    # PIL counts the bins of the packed entries far faster than numpy
+    packed = Image.frombuffer("RGBX", (len(bins), 1), bins, "raw", "RGBX", 0, 1)
+    return LabHistogram.from_flat(packed.histogram()[:768])
+
+def __block_entries(lab: Image.Image, adaptation: np.ndarray = None) -> np.ndarray:
+    """Returns the table entries of a converted color block."""
+    return lab_bins(lab, adaptation).view(LUT_DTYPE).ravel()
+
+@contextmanager
+def __build_lock(path: str):
+    """Holds the lock file of the table at the path, waiting for another
+    process building the table to finish."""
+    lock_path = f"{path}.lock"
+    while True:
+        try:
+            fd = os.open(lock_path, os.O_CREAT | os.O_EXCL | os.O_WRONLY)
+            break
+        except FileExistsError:
+            pass
+        try:
+            if time.time() - os.path.getmtime(lock_path) > BUILD_LOCK_TIMEOUT:
+                os.remove(lock_path)
+                continue
+        except FileNotFoundError:
+            continue
+        time.sleep(0.1)
+    try:
+        yield
+    finally:
+        os.close(fd)
+        os.remove(lock_path)
+
+def build_table(fill, path: str, stage: str = "build_lut"):
+    """Creates a table of LUT_ENTRIES entries at the path, filled in by
+    calling fill with it, unless another process has built it while this one
+    was waiting for the lock. The file is replaced atomically, so readers
+    never see a partial table."""
+    os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+    with __build_lock(path):
+        if not os.path.exists(path):
+            __write_table(fill, path, stage)
+
+def __write_table(fill, path: str, stage: str):
+    tmp_path = f"{path}.{os.getpid()}.tmp"
+    with profiling.stage(stage):
+        table = np.lib.format.open_memmap(tmp_path, mode="w+", dtype=LUT_DTYPE, shape=(LUT_ENTRIES,))
+        fill(table)
+        table.flush()
+        del table
+    os.replace(tmp_path, path)
+
+def load_table(path: str, fill, stage: str = "build_lut") -> np.ndarray:
+    """Returns the table at the path, memory-mapped read-only, building it
+    with fill (see build_table) the first time it is needed on this machine,
+    or after it has been evicted from the cache."""
+    table = _tables.get(path)
+    if table is None:
+        if not os.path.exists(path):
+            build_table(fill, path, stage)
+        table = np.load(path, mmap_mode="r")
+        if table.dtype != LUT_DTYPE or table.shape != (LUT_ENTRIES,):
+            raise ValueError(f"{path} is not a lookup table")
+        # mark the table as recently used for the eviction of the cache
+        os.utime(path)
+        pin(path)
+        _tables[path] = table
+    return table
+
+def __fill_lut(table: np.ndarray, lab_transform):
+    for blue in range(0, 256, BUILD_BLOCK):
+        lab = ImageCms.applyTransform(__color_block(blue), lab_transform.transform)
+        table[blue << 16:(blue + BUILD_BLOCK) << 16] = __block_entries(lab, lab_transform.adaptation)
+
+def build_lut(lab_transform, path: str):
+    """Applies the transform (a color.LabTransform) to every 8-bit RGB color
+    and writes the table to the path, unless another process has just
+    written it (see build_table)."""
+    build_table(lambda table: __fill_lut(table, lab_transform), path)
+
+def load_lut(lab_transform, cache_dir: str = None) -> np.ndarray:
+    """Returns the table of the transform (a color.LabTransform),
+    memory-mapped read-only. The table is built the first time it is needed
+    on this machine."""
+    return load_table(lut_path(lab_transform.name, cache_dir), lambda table: __fill_lut(table, lab_transform))
+
+def verify_lut(table: np.ndarray, lab_transform) -> int:
+    """Compares every entry of the table with the result of applying the
+    transform to its color. Returns the number of colors that differ, which
+    is 0 when the table converts any image exactly as ImageCms does."""
+    mismatches = 0
+    for blue in range(0, 256, BUILD_BLOCK):
+        lab = ImageCms.applyTransform(__color_block(blue), lab_transform.transform)
+        expected = __block_entries(lab, lab_transform.adaptation)
+        mismatches += int(np.count_nonzero(table[blue << 16:(blue + BUILD_BLOCK) << 16] != expected))
+    return mismatches
+
+def __strips(image: Image.Image, max_memory: int = None):
+    """Yields (top, size, pixels) for horizontal strips of an opened image,
+    where pixels holds the RGB values of the strip packed into 32-bit words,
+    from which the table indices are taken."""
+    if max_memory is None:
+        max_memory = STRIP_PIXELS * STRIP_BYTES_PER_PIXEL
+    for top, strip in image_strips(image, max_memory, "RGB"):
+        yield top, strip.size, np.frombuffer(strip.tobytes("raw", "RGBX"), dtype=LUT_DTYPE)
+
+def lab_histogram(image: Image.Image, table: np.ndarray, max_memory: int = None, image_path: str = None) -> LabHistogram:
+    """Returns the LAB histograms of an opened image using the table. The
+    result is identical to converting the image with ImageCms."""
+    hist = LabHistogram.zeros()
+    with profiling.stage("lut_transform", image_path):
+        for _, size, pixels in __strips(image, max_memory):
+            hist += bins_histogram(table[pixels & 0xFFFFFF])
+    return hist
+
+def lab_array(image: Image.Image, table: np.ndarray, max_memory: int = None, image_path: str = None) -> np.ndarray:
+    """Returns an opened image converted to LAB using the table, as a (height,
+    width, channels) array of histogram bins, see utils.image_to_lab_array."""
+    width, height = image.size
+    lab = np.empty((height, width, 3), dtype=np.uint8)
+    with profiling.stage("lut_transform", image_path):
+        for top, size, pixels in __strips(image, max_memory):
+            bins = table[pixels & 0xFFFFFF].view(np.uint8).reshape(size[1], width, 4)
+            lab[top:top + size[1]] = bins[:, :, :3]
+    return lab
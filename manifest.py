@@ -0,0 +1,84 @@
+"""Manifest of the images that have already been processed by the incremental
+folder-watch mode. Each image is recorded with its size, modification time and
+content hash alongside its LAB histograms, so that later passes only analyze
+images that are new or have changed."""
+
+from histogram import LabHistogram
+from histogram_cache import file_digest
+import json
+import os
+
+MANIFEST_VERSION = 1
+
+def manifest_path(output_file: str) -> str:
+    """Returns the path of the manifest kept next to the given outputs."""
+    return output_file + "_manifest.json"
+
+def load_manifest(path: str, params: str) -> dict:
+    """Loads the manifest at the path. Returns an empty manifest if there is
+    none yet, or if it was written with different analysis parameters, since
+    none of its histograms could be reused in that case."""
+    try:
+        with open(path) as f:
+            manifest = json.load(f)
+    except (FileNotFoundError, ValueError):
+        manifest = None
+    if not manifest or manifest.get("version") != MANIFEST_VERSION or manifest.get("params") != params:
+        manifest = {"version": MANIFEST_VERSION, "params": params, "files": {}}
+    return manifest
+
+def save_manifest(manifest: dict, path: str):
+    """Writes the manifest, replacing the previous one atomically."""
+    tmp_path = f"{path}.{os.getpid()}.tmp"
+    with open(tmp_path, 'w') as f:
+        json.dump(manifest, f)
+    os.replace(tmp_path, path)
+
+def stale_images(manifest: dict, image_paths: list) -> dict:
+    """Returns the images that are not in the manifest or whose contents have
+    changed since they were recorded, mapped to their content hash. An image
+    whose size and modification time are unchanged is assumed to be unchanged;
+    otherwise its contents are hashed, so images that were merely touched or
+    copied over with identical contents are not analyzed again. Images that
+    no longer exist are left out."""
+    stale = {}
+    for image_path in image_paths:
+        try:
+            st = os.stat(image_path)
+            entry = manifest["files"].get(image_path)
+            if entry and entry["size"] == st.st_size and entry["mtime"] == st.st_mtime:
+                continue
+            digest = file_digest(image_path)
+        except FileNotFoundError:
+            continue
+        if entry and entry["sha256"] == digest:
+            entry["size"], entry["mtime"] = st.st_size, st.st_mtime
+            continue
+        stale[image_path] = digest
+    return stale
+
+def record_image(manifest: dict, image_path: str, digest: str, hist: LabHistogram):
+    """Records an analyzed image, its content hash and its histograms in the
+    manifest. An image that has been removed since is not recorded."""
+    try:
+        st = os.stat(image_path)
+    except FileNotFoundError:
+        return
+    manifest["files"][image_path] = {
+        "size": st.st_size,
+        "mtime": st.st_mtime,
+        "sha256": digest,
+        "histogram": hist.tolist(),
+    }
+
+def recorded_histogram(manifest: dict, image_path: str) -> LabHistogram:
+    """Returns the histograms recorded for the image."""
+    return LabHistogram(manifest["files"][image_path]["histogram"])
+
+def forget_missing(manifest: dict, image_paths: list) -> bool:
+    """Removes the images that are no longer part of the set from the manifest.
+    Returns True if any were removed."""
+    missing = set(manifest["files"]) - set(image_paths)
+    for image_path in missing:
+        del manifest["files"][image_path]
+    return bool(missing)
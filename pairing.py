@@ -0,0 +1,70 @@
+"""Pairing of control and test images by file name, for importing a whole
+folder of image pairs at once. Each image is assigned to the control or test
+side by a file name pattern, e.g. *control* and *test*, and the control and
+test images whose names are otherwise the same form a pair: with those
+patterns, patient01_control.jpg pairs with patient01_test.jpg and
+control_patient02.png with test_patient02.png."""
+
+from utils import IMAGE_EXTENSIONS, natural_key
+import os
+import re
+
+DEFAULT_CONTROL_PATTERN = "*control*"
+DEFAULT_TEST_PATTERN = "*test*"
+
+# stripped from the ends of the part of the name two images share to make the
+# row label, e.g. patient01_ becomes patient01
+LABEL_SEPARATORS = " _-."
+
+def pattern_regex(pattern: str) -> re.Pattern:
+    """Compiles a file name pattern, in which * matches any text and ? any
+    single character, into a case-insensitive regular expression that
+    captures the text matched by each wildcard. Raises ValueError if the
+    pattern has no wildcard, since every image would then have the same
+    key."""
+    if "*" not in pattern and "?" not in pattern:
+        raise ValueError(f"pattern {pattern!r} must contain * or ?")
+    parts = ["(.*)" if c == "*" else "(.)" if c == "?" else re.escape(c) for c in pattern]
+    return re.compile("".join(parts), re.IGNORECASE | re.DOTALL)
+
+def pair_key(name: str, regex: re.Pattern):
+    """Returns the key of a file name (without extension) for the pattern: the
+    text matched by its wildcards, or None if the name does not match."""
+    match = regex.fullmatch(name)
+    return tuple(x.lower() for x in match.groups()) if match else None
+
+def pair_label(key: tuple) -> str:
+    """Returns a row label for the key of a pair."""
+    return "".join(key).strip(LABEL_SEPARATORS) or "".join(key)
+
+def pair_images(folder: str, control_pattern: str = DEFAULT_CONTROL_PATTERN, test_pattern: str = DEFAULT_TEST_PATTERN) -> tuple:
+    """Pairs the control and test images in the folder. The patterns are
+    matched against the file names without their extension, so a control
+    JPEG may pair with a test PNG. Returns (pairs, skipped): pairs is a list
+    of (label, control, test) in natural order of the labels, where control
+    or test is None for an image without a counterpart, and skipped lists the
+    images that match both patterns, or match one of them with the key of
+    another image of the same side. Raises ValueError if a pattern is not valid."""
+    control_regex, test_regex = pattern_regex(control_pattern), pattern_regex(test_pattern)
+    sides = ({}, {})
+    skipped = []
+    for name in sorted(os.listdir(folder)):
+        image_path = os.path.join(folder, name)
+        if not name.lower().endswith(IMAGE_EXTENSIONS) or not os.path.isfile(image_path):
+            continue
+        stem = os.path.splitext(name)[0]
+        keys = pair_key(stem, control_regex), pair_key(stem, test_regex)
+        if all(key is not None for key in keys):
+            skipped.append(image_path)
+            continue
+        for side, key in zip(sides, keys):
+            if key is None:
+                continue
+            if key in side:
+                skipped.append(image_path)
+            else:
+                side[key] = image_path
+    control, test = sides
+    pairs = [(pair_label(key), control.get(key), test.get(key)) for key in set(control) | set(test)]
+    pairs.sort(key=lambda pair: (natural_key(pair[0]), pair[1] or "", pair[2] or ""))
+    return pairs, skipped
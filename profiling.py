@@ -0,0 +1,139 @@
+"""Per-stage profiling of the analysis pipeline. When profiling is enabled,
+either with the CLI's --profile flag or by setting the
+IMAGE_COLOR_CLASSIFIER_PROFILE environment variable, every stage wrapped in
+stage() records its wall time, CPU time and the bytes allocated while it ran.
+The records are written to a JSON and a CSV report next to the normal outputs.
+
+CPU time is measured per thread, so stages running concurrently on the GUI's
+worker threads do not count each other's work. Allocated bytes are the peak
+growth of memory traced by tracemalloc (Python objects and NumPy arrays) during
+the stage; Pillow allocates image buffers outside of tracemalloc, so for stages
+that produce an image its buffer size is recorded separately as image_bytes.
+tracemalloc only traces the process as a whole, so the allocated bytes of a
+stage that overlaps another one, running on another thread or nested within
+it, cannot be told apart and are recorded as None.
+"""
+
+from contextlib import contextmanager
+import csv
+import json
+import os
+import threading
+import time
+import tracemalloc
+
+ENV_VAR = "IMAGE_COLOR_CLASSIFIER_PROFILE"
+
+CSV_FIELDS = ["image", "stage", "wall_s", "cpu_s", "alloc_bytes", "image_bytes", "pid", "thread"]
+
+_enabled = os.environ.get(ENV_VAR, "") not in ("", "0")
+_records = []
+_lock = threading.Lock()
+# the stages running at the moment in any thread, keyed by the id of their
+# record, mapped to whether another stage has overlapped them
+_active = {}
+
+if _enabled and not tracemalloc.is_tracing():
+    tracemalloc.start()
+
+def enable():
+    """Turns profiling on for this process and any worker processes it starts
+    afterwards."""
+    global _enabled
+    _enabled = True
+    os.environ[ENV_VAR] = "1"
+    if not tracemalloc.is_tracing():
+        tracemalloc.start()
+
+def enabled() -> bool:
+    """Returns True if profiling is turned on."""
+    return _enabled
+
+@contextmanager
+def stage(name: str, image: str = None):
+    """Records the wall time, CPU time and allocated bytes of the enclosed
+    block as a stage of the specified image; the allocated bytes are None if
+    another stage ran at the same time. Yields the record so the caller
+    may add fields such as image_bytes; when profiling is off the record is a
+    throwaway dict. An image given as a file object is recorded by its name,
+    if it has one."""
+    if not _enabled:
+        yield {}
+        return
+    if image is not None and not isinstance(image, str):
+        image = getattr(image, "name", None)
+    record = {"image": image, "stage": name, "image_bytes": None, "pid": os.getpid(), "thread": threading.current_thread().name}
+    key = id(record)
+    traced_start = 0
+    with _lock:
+        overlapped = bool(_active)
+        for other in _active:
+            _active[other] = True
+        _active[key] = overlapped
+        if not overlapped:
+            traced_start = tracemalloc.get_traced_memory()[0]
+            tracemalloc.reset_peak()
+    wall_start = time.perf_counter()
+    cpu_start = time.thread_time()
+    try:
+        yield record
+    finally:
+        record["wall_s"] = time.perf_counter() - wall_start
+        record["cpu_s"] = time.thread_time() - cpu_start
+        with _lock:
+            overlapped = _active.pop(key)
+            record["alloc_bytes"] = None if overlapped else max(0, tracemalloc.get_traced_memory()[1] - traced_start)
+            _records.append(record)
+
+def image_bytes(image) -> int:
+    """Returns the size of the pixel buffer of a PIL image. Pillow stores
+    multi-band images with 4 bytes per pixel."""
+    if image.mode in ("1", "L", "P"):
+        pixel_size = 1
+    elif image.mode.startswith("I;16"):
+        pixel_size = 2
+    else:
+        pixel_size = 4
+    return image.width * image.height * pixel_size
+
+def drain() -> list:
+    """Removes and returns the records collected so far. Used to send the
+    records of a worker process back to the parent."""
+    global _records
+    with _lock:
+        records, _records = _records, []
+    return records
+
+def extend(records: list):
+    """Adds records collected elsewhere, e.g. in a worker process."""
+    with _lock:
+        _records.extend(records)
+
+def summarize(records: list) -> dict:
+    """Returns the total wall time, CPU time and allocated bytes of each stage
+    over all images, along with the number of times it ran. The allocated
+    bytes only add up the runs that did not overlap another stage."""
+    totals = {}
+    for record in records:
+        total = totals.setdefault(record["stage"], {"count": 0, "wall_s": 0.0, "cpu_s": 0.0, "alloc_bytes": 0})
+        total["count"] += 1
+        total["wall_s"] += record["wall_s"]
+        total["cpu_s"] += record["cpu_s"]
+        total["alloc_bytes"] += record["alloc_bytes"] or 0
+    return totals
+
+def write_report(output_file: str):
+    """Writes the records collected so far to <output_file>_profile.json, with
+    a per-stage summary, and to <output_file>_profile.csv with one row per
+    stage of each image. Does nothing when profiling is off."""
+    if not _enabled:
+        return
+    with _lock:
+        records = list(_records)
+    with open(output_file + "_profile.json", 'w') as f:
+        json.dump({"stages": summarize(records), "records": records}, f, indent=2)
+    csv_file = open(output_file + "_profile.csv", 'w')
+    writer = csv.DictWriter(csv_file, CSV_FIELDS)
+    writer.writeheader()
+    writer.writerows(records)
+    csv_file.close()
@@ -0,0 +1,280 @@
+"""Regions of interest (ROIs) within an image, and histograms of them. An ROI
+is a rectangle, a polygon or a bitmap mask, given in pixel coordinates of the
+image file. RegionHistograms precomputes a tiled integral histogram of an
+image that has already been converted to LAB, after which the histogram of any
+ROI is assembled from a handful of tile lookups plus the pixels along its edge,
+without running the color transform again."""
+
+from histogram import BINS, LabHistogram
+from histogram_cache import file_digest
+import math
+import numpy as np
+import profiling
+
+# Upper bound on the number of tiles of the integral histogram, which holds
+# 3 x 256 32-bit counts per tile: 8192 tiles take about 25MB.
+MAX_TILES = 8192
+MIN_TILE_SIZE = 16
+
+class RectRoi:
+    """A rectangle with its top left corner at x, y."""
+
+    def __init__(self, x: float, y: float, width: float, height: float):
+        if width <= 0 or height <= 0:
+            raise ValueError("the width and height of a rectangle must be positive")
+        self.x, self.y, self.width, self.height = x, y, width, height
+
+    def __repr__(self):
+        return f"RectRoi({self.x}, {self.y}, {self.width}, {self.height})"
+
+    def spec(self) -> str:
+        return f"rect:{self.x:g},{self.y:g},{self.width:g},{self.height:g}"
+
+    def params(self) -> str:
+        return self.spec()
+
+class PolygonRoi:
+    """A polygon given by the x, y coordinates of its vertices."""
+
+    def __init__(self, points: list):
+        if len(points) < 3:
+            raise ValueError("a polygon needs at least 3 points")
+        self.points = [(float(x), float(y)) for x, y in points]
+
+    def __repr__(self):
+        return f"PolygonRoi({self.points})"
+
+    def spec(self) -> str:
+        return "poly:" + ",".join(f"{x:g},{y:g}" for x, y in self.points)
+
+    def params(self) -> str:
+        return self.spec()
+
+    def mask(self, size: tuple, scale: tuple):
+        """Returns (left, top, mask) for the polygon rasterized onto an image of
+        the specified size, with its coordinates multiplied by scale and
+        rounded to whole pixels. The mask only covers the bounding box of the
+        polygon, so that it is the same as if it had been drawn onto the whole
+        image."""
+        points = [(round(x * scale[0]), round(y * scale[1])) for x, y in self.points]
+        left = max(0, min(x for x, _ in points))
+        top = max(0, min(y for _, y in points))
+        right = min(size[0], max(x for x, _ in points) + 1)
+        bottom = min(size[1], max(y for _, y in points) + 1)
+        if right <= left or bottom <= top:
+            return left, top, np.zeros((0, 0), dtype=bool)
+        from PIL import Image, ImageDraw
+        # PIL's scanline fill rounds the edges differently when the polygon is
+        # shifted horizontally, so only the rows are offset
+        canvas = Image.new("L", (right, bottom - top))
+        ImageDraw.Draw(canvas).polygon([(x, y - top) for x, y in points], fill=255)
+        return left, top, np.asarray(canvas)[:, left:] > 0
+
+class MaskRoi:
+    """A bitmap mask, read from an image file of the same size as the analyzed
+    image. Non-zero pixels are part of the region."""
+
+    def __init__(self, path: str):
+        self.path = path
+        self._bitmap = None
+
+    def __repr__(self):
+        return f"MaskRoi({self.path!r})"
+
+    def __getstate__(self):
+        # the bitmap is re-read by each worker process rather than pickled
+        return {"path": self.path, "_bitmap": None}
+
+    def spec(self) -> str:
+        return "mask:" + self.path
+
+    def params(self) -> str:
+        # keyed by the contents of the mask so that editing it invalidates
+        # cached histograms
+        return "mask:" + file_digest(self.path)
+
+    def mask(self, size: tuple, scale: tuple):
+        """Returns (left, top, mask) for the bitmap resized to the specified
+        size, cropped to the bounding box of the region."""
+        from PIL import Image
+        if self._bitmap is None:
+            with Image.open(self.path) as bitmap:
+                self._bitmap = bitmap.convert("L")
+        bitmap = self._bitmap
+        if bitmap.size != size:
+            bitmap = bitmap.resize(size, Image.NEAREST)
+        box = bitmap.getbbox()
+        if box is None:
+            return 0, 0, np.zeros((0, 0), dtype=bool)
+        return box[0], box[1], np.asarray(bitmap.crop(box)) > 0
+
+def parse_roi(spec: str):
+    """Parses an ROI from its textual form: rect:X,Y,WIDTH,HEIGHT,
+    poly:X1,Y1,X2,Y2,X3,Y3[,...] or mask:PATH."""
+    kind, _, value = spec.partition(":")
+    kind = kind.strip().lower()
+    if kind == "mask":
+        if not value:
+            raise ValueError("mask ROI requires the path of a mask image")
+        return MaskRoi(value)
+    try:
+        numbers = [float(v) for v in value.split(",")]
+    except ValueError:
+        raise ValueError(f"invalid ROI coordinates: {value}")
+    if kind == "rect":
+        if len(numbers) != 4:
+            raise ValueError("rect ROI requires X,Y,WIDTH,HEIGHT")
+        return RectRoi(*numbers)
+    if kind == "poly":
+        if len(numbers) % 2:
+            raise ValueError("poly ROI requires pairs of X,Y coordinates")
+        return PolygonRoi(list(zip(numbers[0::2], numbers[1::2])))
+    raise ValueError(f"unknown ROI type {kind!r}; expected rect, poly or mask")
+
+def pixels_histogram(pixels: np.ndarray) -> np.ndarray:
+    """Returns the (channels, bins) counts of an array of LAB pixels of any
+    shape whose last axis holds the channels."""
+    pixels = pixels.reshape(-1, pixels.shape[-1])
+    return np.stack([np.bincount(pixels[:, c], minlength=BINS) for c in range(pixels.shape[1])]).astype(np.int64)
+
+def default_tile_size(width: int, height: int) -> int:
+    """Returns the smallest tile size that keeps the number of tiles within
+    MAX_TILES."""
+    return max(MIN_TILE_SIZE, math.ceil(math.sqrt(width * height / MAX_TILES)))
+
+class RegionHistograms:
+    """Tiled integral histogram of an image converted to LAB. The image is
+    divided into square tiles, and the entry for tile row i and column j holds
+    the combined histograms of all tiles above and to the left of it, so the
+    histogram of any block of whole tiles takes four lookups. An ROI's
+    histogram adds up the blocks of tiles it fully covers and counts only the
+    remaining pixels, those in tiles along its edge, directly.
+
+    ROI coordinates are in pixels of the source image; when the LAB image is a
+    reduced copy (the fast mode), source_size is the size of the original so
+    that the coordinates are scaled to match."""
+
+    def __init__(self, lab: np.ndarray, source_size: tuple = None, tile_size: int = None):
+        self.lab = lab
+        height, width = lab.shape[:2]
+        self.size = (width, height)
+        source_size = source_size or self.size
+        self.scale = (width / source_size[0], height / source_size[1])
+        self.tile_size = tile_size or default_tile_size(width, height)
+        self.tiles = (math.ceil(width / self.tile_size), math.ceil(height / self.tile_size))
+        with profiling.stage("integral_histogram"):
+            self.integral = self.__build_integral()
+
+    def __build_integral(self) -> np.ndarray:
+        """Returns the (rows + 1, columns + 1, channels, bins) integral of the
+        tile histograms. One band of tiles is counted at a time, so the
+        temporary arrays stay small."""
+        t = self.tile_size
+        columns, rows = self.tiles
+        channels = self.lab.shape[2]
+        tiles = np.zeros((rows, columns, channels, BINS), dtype=np.uint32)
+        column_offsets = (np.arange(self.size[0]) // t * BINS)[None, :]
+        for row in range(rows):
+            band = self.lab[row * t:(row + 1) * t]
+            for c in range(channels):
+                counts = np.bincount((column_offsets + band[:, :, c]).ravel(), minlength=columns * BINS)
+                tiles[row, :, c] = counts.reshape(columns, BINS)
+        integral = np.zeros((rows + 1, columns + 1, channels, BINS), dtype=np.uint32)
+        np.cumsum(tiles, axis=0, out=integral[1:, 1:])
+        np.cumsum(integral[1:, 1:], axis=1, out=integral[1:, 1:])
+        return integral
+
+    def __tile_block(self, row0: int, column0: int, row1: int, column1: int) -> np.ndarray:
+        """Returns the counts of the tiles in rows row0..row1-1 and columns
+        column0..column1-1."""
+        i = self.integral
+        return (i[row1, column1].astype(np.int64) - i[row0, column1] - i[row1, column0] + i[row0, column0])
+
+    def __tile_edge(self, index: int, axis: int) -> int:
+        return min(index * self.tile_size, self.size[axis])
+
+    def rect_counts(self, left: int, top: int, right: int, bottom: int) -> np.ndarray:
+        """Returns the counts of the pixels of the LAB image within the
+        rectangle, whose right and bottom edges are exclusive."""
+        left, right = max(0, left), min(self.size[0], right)
+        top, bottom = max(0, top), min(self.size[1], bottom)
+        counts = np.zeros((self.lab.shape[2], BINS), dtype=np.int64)
+        if right <= left or bottom <= top:
+            return counts
+        t = self.tile_size
+        # the whole tiles inside the rectangle; a partial tile at the right or
+        # bottom edge of the image counts as whole when the rectangle reaches
+        # the edge
+        column0, row0 = -(-left // t), -(-top // t)
+        column1 = self.tiles[0] if right == self.size[0] else right // t
+        row1 = self.tiles[1] if bottom == self.size[1] else bottom // t
+        if column1 <= column0 or row1 <= row0:
+            return pixels_histogram(self.lab[top:bottom, left:right])
+        counts += self.__tile_block(row0, column0, row1, column1)
+        inner_left, inner_right = self.__tile_edge(column0, 0), self.__tile_edge(column1, 0)
+        inner_top, inner_bottom = self.__tile_edge(row0, 1), self.__tile_edge(row1, 1)
+        for block in (self.lab[top:inner_top, left:right], self.lab[inner_bottom:bottom, left:right],
+                self.lab[inner_top:inner_bottom, left:inner_left], self.lab[inner_top:inner_bottom, inner_right:right]):
+            if block.size:
+                counts += pixels_histogram(block)
+        return counts
+
+    def mask_counts(self, left: int, top: int, mask: np.ndarray) -> np.ndarray:
+        """Returns the counts of the pixels of the LAB image where the mask,
+        placed with its top left corner at left, top, is set."""
+        counts = np.zeros((self.lab.shape[2], BINS), dtype=np.int64)
+        height, width = mask.shape
+        width, height = min(width, self.size[0] - left), min(height, self.size[1] - top)
+        if width <= 0 or height <= 0:
+            return counts
+        t = self.tile_size
+        # widen the mask to whole tiles so coverage can be counted per tile
+        column0, row0 = left // t, top // t
+        column1, row1 = -(-(left + width) // t), -(-(top + height) // t)
+        grid = np.zeros(((row1 - row0) * t, (column1 - column0) * t), dtype=bool)
+        grid[top - row0 * t:top - row0 * t + height, left - column0 * t:left - column0 * t + width] = mask[:height, :width]
+        covered = np.count_nonzero(grid.reshape(row1 - row0, t, column1 - column0, t), axis=(1, 3))
+        tile_widths = np.diff([self.__tile_edge(c, 0) for c in range(column0, column1 + 1)])
+        tile_heights = np.diff([self.__tile_edge(r, 1) for r in range(row0, row1 + 1)])
+        full = covered == np.outer(tile_heights, tile_widths)
+        # runs of fully covered tiles in each row of tiles are looked up in the
+        # integral histogram
+        for r in range(full.shape[0]):
+            run_start = None
+            for c in range(full.shape[1] + 1):
+                if c < full.shape[1] and full[r, c]:
+                    if run_start is None:
+                        run_start = c
+                elif run_start is not None:
+                    counts += self.__tile_block(row0 + r, column0 + run_start, row0 + r + 1, column0 + c)
+                    run_start = None
+        # the pixels of partially covered tiles are counted directly
+        partial = (covered > 0) & ~full
+        if partial.any():
+            rows, columns = covered.shape
+            block = self.lab[row0 * t:(row0 + rows) * t, column0 * t:(column0 + columns) * t]
+            if block.shape[:2] != grid.shape:
+                # tiles at the right or bottom edge of the image are short;
+                # the padding lies outside the mask
+                block = np.pad(block, ((0, grid.shape[0] - block.shape[0]), (0, grid.shape[1] - block.shape[1]), (0, 0)))
+            tiles = block.reshape(rows, t, columns, t, -1).transpose(0, 2, 1, 3, 4)[partial]
+            tile_masks = grid.reshape(rows, t, columns, t).transpose(0, 2, 1, 3)[partial]
+            counts += pixels_histogram(tiles[tile_masks])
+        return counts
+
+    def histogram(self, roi=None) -> LabHistogram:
+        """Returns the LAB histograms of the pixels within the ROI, or of the
+        whole image if roi is None. Raises ValueError if the ROI does not
+        overlap the image."""
+        with profiling.stage("roi_histogram"):
+            if roi is None:
+                counts = self.__tile_block(0, 0, self.tiles[1], self.tiles[0])
+            elif isinstance(roi, RectRoi):
+                sx, sy = self.scale
+                counts = self.rect_counts(round(roi.x * sx), round(roi.y * sy),
+                    round((roi.x + roi.width) * sx), round((roi.y + roi.height) * sy))
+            else:
+                counts = self.mask_counts(*roi.mask(self.size, self.scale))
+        if not counts[0].any():
+            raise ValueError(f"the region {roi.spec()} does not overlap the image")
+        return LabHistogram(counts)
@@ -0,0 +1,447 @@
+"""Local HTTP service for analyzing images, for tools that would otherwise run
+the CLI once per image and pay for starting the interpreter, importing Pillow
+and building the LAB transform every time. The service keeps a pool of worker
+processes that have already built the transform, and answers requests with the
+LAB histograms and averages of an image as JSON.
+
+    POST /analyze   {"path": "photo.jpg"} as JSON, or the image file itself as
+                    the request body. Options: fast (reduction factor), roi
+                    (see the roi module) and histogram (false to leave the
+                    histograms out), as JSON fields or query parameters.
+    GET  /metrics   request counts, throughput, latency and queue depth as
+                    JSON, or in the Prometheus text format with
+                    ?format=prometheus
+    GET  /health    {"status": "ok"}
+
+The service listens on localhost only by default; it reads any image path it
+is given, so it should not be exposed to other machines.
+"""
+
+import asyncio
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from functools import partial
+from histogram import LabHistogram
+from histogram_cache import HistogramCache, file_digest
+from roi import parse_roi
+from urllib.parse import parse_qs, urlsplit
+import hashlib
+import io
+import json
+import math
+import os
+import signal
+import sys
+import time
+import profiling
+import utils
+
+DEFAULT_HOST = "127.0.0.1"
+DEFAULT_PORT = 8765
+
+# Uploads larger than this are refused; a 100 megapixel TIFF is about 300MB.
+MAX_BODY_BYTES = 512 * 1024 * 1024
+
+# Requests waiting for a worker beyond this many are refused with 503, so that
+# a flood of requests fails fast instead of piling up without bound.
+MAX_QUEUE_DEPTH = 256
+
+# Throughput is reported over the completions of this many recent seconds, and
+# latency percentiles over this many recent requests.
+THROUGHPUT_WINDOW = 60
+LATENCY_SAMPLES = 1000
+
+STATUS_TEXT = {200: "OK", 400: "Bad Request", 404: "Not Found", 405: "Method Not Allowed",
+    411: "Length Required", 413: "Payload Too Large", 422: "Unprocessable Entity",
+    500: "Internal Server Error", 503: "Service Unavailable"}
+
+def _analyze_upload(data: bytes, options: dict):
+    """Worker process entry point for an uploaded image. Returns its LAB
+    histograms along with the profiling records collected while analyzing it."""
+    hist = utils.image_to_lab_histogram(io.BytesIO(data), **options)
+    return hist, profiling.drain()
+
+def _warm_up():
+    """Keeps a worker busy briefly, so that warming up the pool starts every
+    worker process rather than reusing the first one."""
+    time.sleep(0.1)
+    return os.getpid()
+
+class HttpError(Exception):
+    """An error reported to the client with the given HTTP status."""
+
+    def __init__(self, status: int, message: str):
+        super().__init__(message)
+        self.status = status
+
+class ServiceMetrics:
+    """Request counters of the service. Requests waiting for or being analyzed
+    by a worker are pending; those beyond the number of workers are queued."""
+
+    def __init__(self, workers: int):
+        self.workers = workers
+        self.started = time.monotonic()
+        self.requests = 0
+        self.completed = 0
+        self.failed = 0
+        self.rejected = 0
+        self.cache_hits = 0
+        self.coalesced = 0
+        self.pool_restarts = 0
+        self.pending = 0
+        self.completions = deque()
+        self.latencies = deque(maxlen=LATENCY_SAMPLES)
+
+    def queue_depth(self) -> int:
+        return max(0, self.pending - self.workers)
+
+    def record_completion(self, started: float):
+        now = time.monotonic()
+        self.completed += 1
+        self.completions.append(now)
+        self.latencies.append(now - started)
+
+    def snapshot(self) -> dict:
+        """Returns the current metrics."""
+        now = time.monotonic()
+        while self.completions and self.completions[0] < now - THROUGHPUT_WINDOW:
+            self.completions.popleft()
+        uptime = now - self.started
+        latencies = sorted(self.latencies)
+        def percentile(q):
+            if not latencies:
+                return None
+            return round(latencies[min(len(latencies) - 1, math.ceil(q / 100 * len(latencies)) - 1)] * 1000, 2)
+        return {
+            "uptime_s": round(uptime, 1),
+            "workers": self.workers,
+            "requests": self.requests,
+            "completed": self.completed,
+            "failed": self.failed,
+            "rejected": self.rejected,
+            "cache_hits": self.cache_hits,
+            "coalesced": self.coalesced,
+            "pool_restarts": self.pool_restarts,
+            "in_flight": min(self.pending, self.workers),
+            "queue_depth": self.queue_depth(),
+            "throughput_per_s": round(len(self.completions) / max(1e-9, min(uptime, THROUGHPUT_WINDOW)), 3),
+            "overall_throughput_per_s": round(self.completed / max(1e-9, uptime), 3),
+            "latency_ms": {"p50": percentile(50), "p90": percentile(90), "p99": percentile(99)},
+        }
+
+def prometheus_text(metrics: dict) -> str:
+    """Returns the metrics in the Prometheus text exposition format."""
+    lines = []
+    for name, value in metrics.items():
+        if isinstance(value, dict):
+            for quantile, v in value.items():
+                if v is not None:
+                    lines.append(f'image_color_classifier_{name}{{quantile="0.{quantile[1:]}"}} {v}')
+        else:
+            lines.append(f"image_color_classifier_{name} {value}")
+    return "\n".join(lines) + "\n"
+
+class AnalysisService:
+    """Answers analysis requests using a pool of warm worker processes. The
+    options (max_memory, reduce, engine, color) are the defaults for every request; requests
+    may override reduce and give an roi. When a cache is given, results are
+    read from and added to it, as in batch_lab_histograms."""
+
+    def __init__(self, workers: int = None, cache: HistogramCache = None, **options):
+        self.workers = workers or os.cpu_count() or 1
+        self.cache = cache
+        self.options, self.initargs = utils._prepare_batch_workers(self.workers, options)
+        self.pool = None
+        self.pool_lock = asyncio.Lock()
+        self.in_progress = {}
+        self.metrics = ServiceMetrics(self.workers)
+
+    def __new_pool(self) -> ProcessPoolExecutor:
+        """Returns a new pool of worker processes once each has built the LAB
+        transform, or mapped the lookup table of the lut engine."""
+        pool = ProcessPoolExecutor(max_workers=self.workers, initializer=utils._init_batch_worker, initargs=self.initargs)
+        try:
+            for future in [pool.submit(_warm_up) for _ in range(self.workers)]:
+                future.result()
+        except BaseException:
+            pool.shutdown(wait=False, cancel_futures=True)
+            raise
+        return pool
+
+    def start_pool(self):
+        """Starts the worker processes and waits until they are warmed up."""
+        self.pool = self.__new_pool()
+
+    async def restart_pool(self, broken: ProcessPoolExecutor) -> bool:
+        """Replaces a pool that broke because a worker process died, e.g. of a
+        crash in a decoder, with a new warmed up one. The broken pool stays in
+        place until the new one is ready, so requests arriving meanwhile find
+        it broken and wait here for the restart; requests that find the same
+        broken pool restart it only once. Returns False if the new pool could
+        not be started."""
+        async with self.pool_lock:
+            if self.pool is not broken:
+                return self.pool is not None
+            try:
+                # warming up waits for the workers, so it is kept off the event loop
+                self.pool = await asyncio.get_running_loop().run_in_executor(None, self.__new_pool)
+            except Exception as e:
+                print(f"unable to restart the worker processes: {e}", file=sys.stderr, flush=True)
+                return False
+            broken.shutdown(wait=False, cancel_futures=True)
+            self.metrics.pool_restarts += 1
+            return True
+
+    def close(self):
+        if self.pool is not None:
+            self.pool.shutdown(cancel_futures=True)
+            self.pool = None
+
+    def request_options(self, fields: dict) -> tuple:
+        """Returns the analysis options of a request and whether the
+        histograms are to be included in the response."""
+        options = dict(self.options)
+        try:
+            if fields.get("fast") not in (None, ""):
+                if not isinstance(fields["fast"], (int, str)) or isinstance(fields["fast"], bool):
+                    raise ValueError("fast must be an integer")
+                options["reduce"] = int(fields["fast"])
+                if options["reduce"] < 1:
+                    raise ValueError("fast must be at least 1")
+            if fields.get("roi"):
+                if not isinstance(fields["roi"], str):
+                    raise ValueError("roi must be a string")
+                options["roi"] = parse_roi(fields["roi"])
+        except (ValueError, TypeError) as e:
+            raise HttpError(400, str(e))
+        try:
+            # identifying the options reads the mask of a mask ROI
+            utils.transform_params(**options)
+        except OSError as e:
+            raise HttpError(422, f"unable to read the region of interest: {e}")
+        include_histogram = str(fields.get("histogram", "true")).lower() not in ("0", "false", "no")
+        return options, include_histogram
+
+    async def analyze(self, source, upload: bool, fields: dict) -> dict:
+        """Analyzes an image, given as a path or as the bytes of an upload."""
+        options, include_histogram = self.request_options(fields)
+        if not upload and not os.path.isfile(source):
+            raise HttpError(404, f"no such image: {source}")
+        started = time.monotonic()
+        loop = asyncio.get_running_loop()
+        hist, key = None, None
+        if self.cache is not None:
+            # hashing reads the whole image, so it is kept off the event loop
+            if upload:
+                digest = await loop.run_in_executor(None, lambda: hashlib.sha256(source).hexdigest())
+            else:
+                digest = await loop.run_in_executor(None, file_digest, source)
+            key = self.cache.key(None, utils.transform_params(**options), digest)
+            counts = await loop.run_in_executor(None, self.cache.get, key)
+            if counts is not None:
+                hist = LabHistogram(counts)
+                self.metrics.cache_hits += 1
+        cached = hist is not None
+        if hist is None:
+            # requests for an image that is already being analyzed with the
+            # same options wait for that analysis instead of repeating it
+            task = self.in_progress.get(key) if key is not None else None
+            if task is None:
+                task = asyncio.ensure_future(self.__compute(source, upload, options, key))
+                if key is not None:
+                    self.in_progress[key] = task
+                    task.add_done_callback(lambda _: self.in_progress.pop(key, None))
+            else:
+                self.metrics.coalesced += 1
+            hist = await asyncio.shield(task)
+        l, a, b = utils.lab_hist_weighed_average(hist)
+        result = {
+            "image": None if upload else source,
+            "averages": {"L": l, "a": a, "b": b},
+            "errors": None,
+            "pixels": int(hist.pixel_count()[0]),
+            "cached": cached,
+        }
+        if options.get("reduce", 1) > 1:
+            el, ea, eb = utils.estimate_average_error(hist)
+            result["errors"] = {"L": el, "a": ea, "b": eb}
+        if include_histogram:
+            result["histogram"] = {"L": hist[0].tolist(), "a": hist[1].tolist(), "b": hist[2].tolist()}
+        self.metrics.record_completion(started)
+        result["elapsed_ms"] = round((time.monotonic() - started) * 1000, 2)
+        return result
+
+    async def __compute(self, source, upload: bool, options: dict, key: str) -> LabHistogram:
+        """Analyzes an image in a worker process and adds the result to the
+        cache."""
+        if self.metrics.queue_depth() >= MAX_QUEUE_DEPTH:
+            self.metrics.rejected += 1
+            raise HttpError(503, "too many requests are queued, try again later")
+        analyze = _analyze_upload if upload else utils._analyze_in_worker
+        loop = asyncio.get_running_loop()
+        self.metrics.pending += 1
+        try:
+            # a request whose worker died is retried once on a new pool; if
+            # that worker dies too, the image itself is likely the cause
+            for attempt in range(2):
+                pool = self.pool
+                if pool is None:
+                    # never analyzed in-process, where a crash would take the
+                    # whole service down
+                    raise HttpError(503, "no worker processes are available")
+                try:
+                    hist, records = await loop.run_in_executor(pool, partial(analyze, options=options), source)
+                    break
+                except BrokenProcessPool:
+                    if not await self.restart_pool(pool):
+                        raise HttpError(503, "the worker processes could not be restarted")
+                    if attempt:
+                        raise HttpError(500, "a worker process died while analyzing the image")
+                except Exception as e:
+                    raise HttpError(422, f"unable to analyze the image: {e}")
+        finally:
+            self.metrics.pending -= 1
+        profiling.extend(records)
+        if self.cache is not None:
+            await loop.run_in_executor(None, self.cache.put, key, hist)
+        return hist
+
+    async def dispatch(self, method: str, target: str, headers: dict, body: bytes) -> tuple:
+        """Returns the (status, content type, body) of the response to a
+        request."""
+        url = urlsplit(target)
+        query = {k: v[-1] for k, v in parse_qs(url.query).items()}
+        if url.path == "/health":
+            return 200, "application/json", {"status": "ok"}
+        if url.path == "/metrics":
+            metrics = self.metrics.snapshot()
+            if query.get("format") == "prometheus":
+                return 200, "text/plain; version=0.0.4", prometheus_text(metrics)
+            return 200, "application/json", metrics
+        if url.path != "/analyze":
+            raise HttpError(404, f"unknown endpoint {url.path}")
+        if method != "POST":
+            raise HttpError(405, "use POST to analyze an image")
+        self.metrics.requests += 1
+        try:
+            if headers.get("content-type", "").split(";")[0].strip() == "application/json":
+                try:
+                    fields = json.loads(body or b"{}")
+                except ValueError as e:
+                    raise HttpError(400, f"invalid JSON: {e}")
+                if not isinstance(fields, dict) or not fields.get("path") or not isinstance(fields["path"], str):
+                    raise HttpError(400, "expected a JSON object with the path of the image")
+                return 200, "application/json", await self.analyze(os.path.abspath(fields["path"]), False, {**query, **fields})
+            if not body:
+                raise HttpError(400, "expected the image file as the request body, or a JSON object with its path")
+            return 200, "application/json", await self.analyze(body, True, query)
+        except HttpError:
+            self.metrics.failed += 1
+            raise
+        except Exception as e:
+            self.metrics.failed += 1
+            raise HttpError(500, f"internal error: {type(e).__name__}: {e}")
+
+    async def handle_connection(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        """Serves the requests of a connection, which is kept open between
+        requests unless the client asks for it to be closed."""
+        try:
+            while True:
+                try:
+                    request = await read_request(reader)
+                    if request is None:
+                        break
+                    method, target, headers, body = request
+                    keep_alive = headers.get("connection", "").lower() != "close"
+                    status, content_type, payload = await self.dispatch(method, target, headers, body)
+                except HttpError as e:
+                    keep_alive = e.status < 500 and e.status not in (400, 411, 413)
+                    status, content_type, payload = e.status, "application/json", {"error": str(e)}
+                except (ConnectionError, asyncio.IncompleteReadError):
+                    raise
+                except Exception as e:
+                    # a response is still owed to the client, even for a bug
+                    keep_alive = False
+                    status, content_type, payload = 500, "application/json", {"error": f"internal error: {type(e).__name__}: {e}"}
+                write_response(writer, status, content_type, payload, keep_alive)
+                await writer.drain()
+                if not keep_alive:
+                    break
+        except (ConnectionError, asyncio.IncompleteReadError):
+            pass
+        finally:
+            writer.close()
+
+    async def run(self, host: str, port: int):
+        """Serves requests until interrupted."""
+        stop = asyncio.Event()
+        loop = asyncio.get_running_loop()
+        for sig in (signal.SIGINT, signal.SIGTERM):
+            try:
+                loop.add_signal_handler(sig, stop.set)
+            except (NotImplementedError, AttributeError):
+                # not available on Windows, where Ctrl+C raises KeyboardInterrupt
+                pass
+        server = await asyncio.start_server(self.handle_connection, host, port)
+        print(f"Serving on http://{host}:{port} with {self.workers} worker(s)", flush=True)
+        async with server:
+            await stop.wait()
+
+async def read_request(reader: asyncio.StreamReader):
+    """Reads an HTTP/1.1 request. Returns (method, target, headers, body), or
+    None if the connection was closed before a request started."""
+    line = await reader.readline()
+    if not line.strip():
+        return None
+    try:
+        method, target, _ = line.decode("latin-1").split()
+    except ValueError:
+        raise HttpError(400, "malformed request line")
+    headers = {}
+    while True:
+        line = await reader.readline()
+        if line in (b"\r\n", b"\n", b""):
+            break
+        name, _, value = line.decode("latin-1").partition(":")
+        headers[name.strip().lower()] = value.strip()
+    if "chunked" in headers.get("transfer-encoding", "").lower():
+        raise HttpError(411, "chunked uploads are not supported; send a Content-Length")
+    try:
+        length = int(headers.get("content-length", 0))
+    except ValueError:
+        raise HttpError(400, "invalid Content-Length")
+    if length < 0:
+        raise HttpError(400, "invalid Content-Length")
+    if length > MAX_BODY_BYTES:
+        raise HttpError(413, f"the request body is limited to {MAX_BODY_BYTES // (1024 * 1024)}MB")
+    body = await reader.readexactly(length) if length else b""
+    return method.upper(), target, headers, body
+
+def write_response(writer: asyncio.StreamWriter, status: int, content_type: str, payload, keep_alive: bool):
+    """Writes an HTTP/1.1 response with a JSON or text body."""
+    body = (payload if isinstance(payload, str) else json.dumps(payload)).encode()
+    head = (f"HTTP/1.1 {status} {STATUS_TEXT.get(status, '')}\r\n"
+        f"Content-Type: {content_type}\r\n"
+        f"Content-Length: {len(body)}\r\n"
+        f"Connection: {'keep-alive' if keep_alive else 'close'}\r\n\r\n")
+    writer.write(head.encode("latin-1") + body)
+
+def serve(host: str = DEFAULT_HOST, port: int = DEFAULT_PORT, workers: int = None, cache: HistogramCache = None, output: str = None, **options):
+    """Runs the analysis service until interrupted. The worker processes are
+    started and warmed up before the first request is accepted. On exit the
+    cache statistics are saved and, when profiling, the profile report is
+    written to <output>_profile.json/.csv."""
+    service = AnalysisService(workers, cache, **options)
+    print(f"Starting {service.workers} worker(s)...", flush=True)
+    service.start_pool()
+    try:
+        asyncio.run(service.run(host, port))
+    except KeyboardInterrupt:
+        pass
+    finally:
+        service.close()
+        if cache is not None:
+            cache.save_stats()
+        if output:
+            profiling.write_report(output)
@@ -0,0 +1,157 @@
+"""Batch manifests and sharded processing. A batch manifest lists the image
+sets of any number of patients, so that a whole clinic can be reprocessed in a
+single run. The images of a manifest may be split into shards that are
+analyzed independently, e.g. on different machines, each shard writing its
+histograms to a partial file. Merging the partial files of every shard gives
+exactly the histograms a single run would have calculated."""
+
+from histogram import LabHistogram, as_histogram
+import json
+import numpy as np
+import os
+
+SHARD_VERSION = 1
+
+# Keys of each patient in a batch manifest, matching the CLI arguments.
+CASE_KEYS = ("output", "preop_left", "preop_right", "postop_left", "postop_right")
+
+def load_batch_manifest(path: str) -> list:
+    """Loads a batch manifest: a JSON list with one object per patient, holding
+    the name of its outputs and its images under the same names as the CLI
+    arguments (output, preop_left, preop_right, postop_left, postop_right).
+    Returns the patients with missing optional keys filled in. Raises
+    ValueError if the manifest is not valid."""
+    try:
+        with open(path) as f:
+            cases = json.load(f)
+    except json.JSONDecodeError as e:
+        raise ValueError(f"{path} is not valid JSON: {e}")
+    return normalize_cases(cases, path)
+
+def normalize_cases(cases, source: str = "manifest") -> list:
+    """Checks the patients of a batch manifest, returning them with missing
+    optional keys filled in."""
+    if not isinstance(cases, list) or not cases:
+        raise ValueError(f"{source} must be a non-empty list of patients")
+    normalized = []
+    for i, case in enumerate(cases):
+        if not isinstance(case, dict):
+            raise ValueError(f"{source}: patient {i + 1} is not an object")
+        unknown = set(case) - set(CASE_KEYS)
+        if unknown:
+            raise ValueError(f"{source}: patient {i + 1} has unknown keys {', '.join(sorted(unknown))}")
+        if not case.get("output") or not case.get("preop_left"):
+            raise ValueError(f"{source}: patient {i + 1} requires output and preop_left")
+        if (case.get("postop_left") or case.get("postop_right")) and not case.get("preop_right"):
+            # the differences of the summary are taken against the pre-op
+            # averages, which requires both pre-op photographs
+            raise ValueError(f"{source}: patient {i + 1} has post-op photographs and requires preop_right")
+        normalized.append({
+            "output": case["output"],
+            "preop_left": case["preop_left"],
+            "preop_right": case.get("preop_right") or None,
+            "postop_left": list(case.get("postop_left") or []),
+            "postop_right": list(case.get("postop_right") or []),
+        })
+    outputs = [case["output"] for case in normalized]
+    if len(set(outputs)) != len(outputs):
+        raise ValueError(f"{source}: every patient requires a different output")
+    return normalized
+
+def case_images(case: dict) -> list:
+    """Returns the images of a patient in the order of the raw output."""
+    return [case["preop_left"]] + ([case["preop_right"]] if case["preop_right"] else []) + case["postop_left"] + case["postop_right"]
+
+def manifest_images(cases: list) -> list:
+    """Returns every image of the manifest once, in the order they are first
+    listed. An image shared by several patients is only analyzed once."""
+    return list(dict.fromkeys(x for case in cases for x in case_images(case)))
+
+def parse_shard(spec: str) -> tuple:
+    """Parses a shard specification of the form i/N, where i counts from 1.
+    Returns (i, N). Raises ValueError if the specification is not valid."""
+    try:
+        index, count = (int(x) for x in spec.split("/"))
+    except ValueError:
+        raise ValueError(f"invalid shard {spec!r}, expected i/N")
+    if count < 1 or not 1 <= index <= count:
+        raise ValueError(f"invalid shard {spec!r}, i must be between 1 and N")
+    return index, count
+
+def shard_indices(image_count: int, index: int, count: int) -> list:
+    """Returns the positions of the images that belong to shard index of count.
+    Images are dealt out in turn, so every shard gets a similar mix of images
+    and the assignment only depends on the manifest."""
+    return list(range(index - 1, image_count, count))
+
+def shard_path(output_file: str, index: int, count: int) -> str:
+    """Returns the path of the partial histogram file of a shard."""
+    return f"{output_file}_shard_{index}_of_{count}.npz"
+
+def save_shard(path: str, cases: list, index: int, count: int, indices: list, hists: list, params: str, reduce: int = 1):
+    """Writes the histograms of the images of a shard, along with the manifest
+    and the analysis parameters so that shards of different runs are never
+    merged together. The file is replaced atomically, so an interrupted run
+    never leaves a partial file behind."""
+    images = manifest_images(cases)
+    histograms = np.stack([as_histogram(hist, LabHistogram).counts for hist in hists]) if hists else np.zeros((0, 3, 256), dtype=np.uint64)
+    tmp_path = f"{path}.{os.getpid()}.tmp"
+    with open(tmp_path, 'wb') as f:
+        np.savez_compressed(f,
+            version=SHARD_VERSION,
+            manifest=json.dumps(cases),
+            params=params,
+            reduce=reduce,
+            shard=np.array([index, count]),
+            indices=np.array(indices, dtype=np.int64),
+            images=np.array([images[i] for i in indices], dtype=str),
+            histograms=histograms)
+    os.replace(tmp_path, path)
+
+def load_shard(path: str) -> dict:
+    """Loads a partial histogram file written by save_shard."""
+    with np.load(path) as data:
+        if int(data["version"]) != SHARD_VERSION:
+            raise ValueError(f"{path} was written by an unsupported version")
+        return {
+            "manifest": str(data["manifest"]),
+            "params": str(data["params"]),
+            "reduce": int(data["reduce"]),
+            "shard": tuple(int(x) for x in data["shard"]),
+            "indices": data["indices"].tolist(),
+            "histograms": [LabHistogram(counts) for counts in data["histograms"]],
+        }
+
+def merge_shards(paths: list) -> tuple:
+    """Combines the partial files of every shard of a run. Returns the patients
+    of the manifest, the histograms of every image keyed by path, and the
+    reduction factor of the run. Raises ValueError if the files are from
+    different runs, or if any shard or image is missing or duplicated."""
+    shards = [load_shard(path) for path in paths]
+    first = shards[0]
+    for path, shard in zip(paths, shards):
+        if shard["manifest"] != first["manifest"] or shard["params"] != first["params"]:
+            raise ValueError(f"{path} is from a different manifest or was analyzed with different options than {paths[0]}")
+        if shard["shard"][1] != first["shard"][1]:
+            raise ValueError(f"{path} is shard {shard['shard'][0]}/{shard['shard'][1]}, expected one of {first['shard'][1]} shards")
+    count = first["shard"][1]
+    found = sorted(shard["shard"][0] for shard in shards)
+    if found != list(range(1, count + 1)):
+        missing = sorted(set(range(1, count + 1)) - set(found))
+        duplicated = sorted({x for x in found if found.count(x) > 1})
+        problems = ([f"missing shard(s) {', '.join(map(str, missing))}"] if missing else []) + \
+            ([f"duplicated shard(s) {', '.join(map(str, duplicated))}"] if duplicated else [])
+        raise ValueError(f"cannot merge {count} shards: {'; '.join(problems)}")
+
+    cases = json.loads(first["manifest"])
+    images = manifest_images(cases)
+    hists = [None] * len(images)
+    for shard in shards:
+        for i, hist in zip(shard["indices"], shard["histograms"]):
+            if hists[i] is not None:
+                raise ValueError(f"{images[i]} is part of more than one shard")
+            hists[i] = hist
+    missing = [image for image, hist in zip(images, hists) if hist is None]
+    if missing:
+        raise ValueError(f"no histograms for {len(missing)} image(s), e.g. {missing[0]}")
+    return cases, dict(zip(images, hists)), first["reduce"]
@@ -5,91 +5,519 @@ of the images. The histograms are then saved to a CSV file for further analysis.
 The program also generates a summary CSV file that contains the average LAB
 values of the images and the difference between the pre-op and post-op images."""
 
-from PIL import Image, ImageCms
-from argparse import ArgumentParser
+from __future__ import annotations
+from argparse import ArgumentParser, ArgumentTypeError
+from functools import partial
+import time
+from histogram import Histogram, LabHistogram, as_histogram
+from histogram_cache import HistogramCache, ThumbnailCache, DEFAULT_MAX_BYTES, file_digest, set_default_cache_dir
+from fnmatch import fnmatch
 import csv
+import io
+import manifest
+import profiling
+import shards
+from roi import RegionHistograms, parse_roi
+from color import ColorSettings, LabTransform, DEFAULT_COLOR, RENDERING_INTENTS, get_transform, parse_illuminant
+import numpy as np
+import os
+import re
+import sys
+from typing import TYPE_CHECKING
+
+# Pillow is imported by the functions that use it rather than here, so that
+# the CLI starts without it when no image has to be decoded, e.g. when every
+# histogram comes from the cache or when merging shards.
+if TYPE_CHECKING:
+    from PIL import Image
+
+# Rough number of bytes held per pixel of a strip while it is being analyzed:
+# the cropped strip, its RGB conversion and the LAB result, each of which PIL
+# stores with up to 4 bytes per pixel, with headroom for 16-bit sources. The
+# lut engine holds about as much: the strip, its packed copy, the table
+# indices and the looked up bins.
+STRIP_BYTES_PER_PIXEL = 16
+
+# Default reduction factor for the fast approximate mode: the images are
+# analyzed at a quarter of their width and height.
+DEFAULT_FAST_REDUCE = 4
+
+IMAGE_EXTENSIONS = (".png", ".jpg", ".jpeg", ".bmp", ".tif", ".tiff")
+
+# Engines converting RGB to LAB: LittleCMS applied to every pixel, or a lookup
+# table built from the same transform (see lab_lut), which gives identical
+# results.
+ENGINES = ("lcms", "lut")
+
+# Thumbnails fit within a square of this many pixels.
+THUMBNAIL_SIZE = 100
+
+# Images modified more recently than this many seconds ago are assumed to still
+# be being copied into a watched folder, and are left for the next pass.
+WATCH_SETTLE_SECONDS = 2
 
 def average_value_from_histogram(hist: list):
     """Returns the average value of the colors in the histogram."""
-    num_pixels = float(sum(hist))
-    weighted_sum = float(sum(i * hist[i] for i in range(len(hist))))
-    weighted_avg = weighted_sum / num_pixels
-    return weighted_avg
+    return float(Histogram([hist]).mean()[0])
 
 def lab_hist_weighed_average(hist, ndigits=2):
     """Returns the weighed average of the LAB values in the histogram. Accounts
     for different representations of the different channels. L is 0-100, a and b
     are -128 to 127."""
-    l_hist = hist[0]
-    a_hist = hist[1]
-    b_hist = hist[2]
-    l_weighed_average = average_value_from_histogram(l_hist) / 2.55
     # The a and b channels should range from -128 to 127, but the histogram
-    # values are from 0 to 255. We need to adjust the values to be centered
-    a_weighed_average = average_value_from_histogram(a_hist) - 128
-    b_weighed_average = average_value_from_histogram(b_hist) - 128
-
-    return round(l_weighed_average, ndigits), round(a_weighed_average, ndigits), round(b_weighed_average, ndigits)
+    # values are from 0 to 255. lab_mean adjusts the values to be centered
+    l, a, b = as_histogram(hist, LabHistogram).lab_mean()
+    return round(float(l), ndigits), round(float(a), ndigits), round(float(b), ndigits)
 
 def rgb_hist_weighed_average(hist, ndigits=2):
     """Returns the weighed average of the RGB values in the histogram."""
-    r_hist = hist[0]
-    g_hist = hist[1]
-    b_hist = hist[2]
-    r_weighed_average = average_value_from_histogram(r_hist)
-    g_weighed_average = average_value_from_histogram(g_hist)
-    b_weighed_average = average_value_from_histogram(b_hist)
-    return round(r_weighed_average, ndigits), round(g_weighed_average, ndigits), round(b_weighed_average, ndigits)
-
-def image_to_rgb_histogram(image_path:str) -> list:
-    """Opens the specified image and returns a list of histograms for each
-    channel in the RGB color space."""
-    image = Image.open(image_path).convert('RGB')
-    return [x.histogram() for x in image.split()]
-
-def image_to_lab_histogram(image_path:str) -> list:
+    r, g, b = as_histogram(hist).mean()
+    return round(float(r), ndigits), round(float(g), ndigits), round(float(b), ndigits)
+
+def open_image(image_path: str, reduce: int = 1) -> Image.Image:
+    """Opens the specified image, reduced by the factor when it is greater than
+    1 (see reduce_image). The image may also be given as a file object, e.g.
+    the BytesIO of an upload. When profiling, the file is read and decoded up
+    front so that the two are recorded as separate stages; otherwise the image
+    is decoded lazily by whatever first needs its pixels."""
+    from PIL import Image
+    if not profiling.enabled():
+        image = Image.open(image_path)
+        return reduce_image(image, reduce) if reduce > 1 else image
+    with profiling.stage("read", image_path):
+        if hasattr(image_path, "read"):
+            data = image_path
+        else:
+            with open(image_path, 'rb') as f:
+                data = io.BytesIO(f.read())
+    with profiling.stage("decode", image_path) as record:
+        image = Image.open(data)
+        if reduce > 1:
+            image = reduce_image(image, reduce)
+        image.load()
+        record["image_bytes"] = profiling.image_bytes(image)
+    return image
+
+def convert_image(image: Image.Image, mode: str, image_path: str = None) -> Image.Image:
+    """Returns the image converted to the mode, recorded as the convert
+    stage."""
+    with profiling.stage("convert", image_path) as record:
+        image = image.convert(mode)
+        record["image_bytes"] = profiling.image_bytes(image)
+    return image
+
+def to_rgb(image: Image.Image, image_path: str = None) -> Image.Image:
+    """Returns the image converted to RGB, recorded as the convert stage."""
+    return convert_image(image, 'RGB', image_path)
+
+def image_to_rgb_histogram(image_path:str) -> Histogram:
+    """Opens the specified image and returns the histograms of each channel in
+    the RGB color space."""
+    image = to_rgb(open_image(image_path), image_path)
+    with profiling.stage("histogram", image_path):
+        return Histogram.from_flat(image.histogram())
+
+def get_rgb2lab_transform():
+    """Returns the sRGB to LAB (D50) transform, building it the first time it is
+    requested in the current process. See color.get_transform for the
+    transforms of other profiles and illuminants."""
+    return get_transform().transform
+
+def get_lab_lut(lab_transform: LabTransform = None):
+    """Returns the lookup table of an RGB to LAB transform (by default sRGB to
+    LAB with D50) for the lut engine, mapping it the first time it is
+    requested in the current process and building it the first time it is
+    requested on this machine."""
+    import lab_lut
+    return lab_lut.load_lut(lab_transform or get_transform())
+
+def reduce_image(image: Image.Image, factor: int) -> Image.Image:
+    """Returns the opened image reduced by the factor in each dimension. JPEG
+    images are decoded directly at a reduced scale; other formats are decoded
+    in full and then subsampled, keeping every factor-th pixel."""
+    from PIL import Image
+    size = (max(1, image.width // factor), max(1, image.height // factor))
+    # draft is a no-op for formats that cannot decode at a reduced scale. For
+    # JPEG it picks the smallest DCT scale that is at least the requested size.
+    image.draft('RGB', size)
+    if image.size != size:
+        image = image.resize(size, Image.NEAREST)
+    return image
+
+def image_to_lab_histogram(image_path:str, max_memory: int = None, reduce: int = 1, roi=None, engine: str = "lcms",
+        color: ColorSettings = None) -> LabHistogram:
     """Opens the specified image and converts it to the LAB color space. Returns
-    a list of histograms for each channel."""
-    image = Image.open(image_path).convert('RGB')
-    srgb_prof = ImageCms.createProfile('sRGB')
-    lab_prof = ImageCms.createProfile('LAB', 6500)
-    rgb2lab = ImageCms.buildTransformFromOpenProfiles(srgb_prof, lab_prof, "RGB", "LAB")
-    lab = ImageCms.applyTransform(image, rgb2lab)
-    return [x.histogram() for x in lab.split()]
-
-def __generate_raw_output(prl: list, prr: list, pol: list, por: list, output_file: str) -> list:
-    """Generates a CSV of the LAB histograms"""
-    header = ["pre_left_L", "pre_left_a", "pre_left_b"]
-    rows=[]
+    the histograms of each channel. When max_memory (in bytes) is given, the
+    image is converted in horizontal strips sized to fit within it rather than
+    all at once; the result is identical either way. A reduce factor greater
+    than 1 analyzes a reduced-resolution copy of the image instead, which is
+    faster but only approximates the full histograms, see
+    estimate_average_error. When an roi (see the roi module) is given, only
+    the pixels within it are counted. The engine (see ENGINES) selects how the
+    pixels are converted; the result is the same with either. The color
+    settings (see the color module) select the illuminant and rendering
+    intent and whether the ICC profile embedded in the image is used; by
+    default it is, with D50."""
+    return lab_histogram_of_image(open_image(image_path, reduce), max_memory, image_path, roi, engine, color)
+
+def lab_histogram_of_image(image: Image.Image, max_memory: int = None, image_path: str = None, roi=None, engine: str = "lcms",
+        color: ColorSettings = None) -> LabHistogram:
+    """Returns the LAB histograms of an opened image, see
+    image_to_lab_histogram."""
+    from PIL import ImageCms
+    if roi is not None:
+        return lab_regions_of_image(image, max_memory, image_path, engine, color).histogram(roi)
+    lab_transform = (color or DEFAULT_COLOR).transform_for(image)
+    # the lookup table is indexed by RGB, so images with a gray or CMYK
+    # profile are always converted by LittleCMS
+    if engine == "lut" and lab_transform.mode == "RGB":
+        import lab_lut
+        return lab_lut.lab_histogram(image, get_lab_lut(lab_transform), max_memory, image_path)
+    if max_memory is not None:
+        return lab_histogram_in_strips(image, max_memory, image_path, lab_transform)
+    converted = convert_image(image, lab_transform.mode, image_path)
+    with profiling.stage("apply_transform", image_path) as record:
+        lab = ImageCms.applyTransform(converted, lab_transform.transform)
+        record["image_bytes"] = profiling.image_bytes(lab)
+    with profiling.stage("histogram", image_path):
+        return __lab_image_histogram(lab, lab_transform)
+
+def __lab_image_histogram(lab: Image.Image, lab_transform: LabTransform) -> LabHistogram:
+    """Returns the histograms of a LAB image converted by ImageCms, adapted to
+    the illuminant of the transform."""
+    if lab_transform.adaptation is not None:
+        import lab_lut
+        return lab_lut.bins_histogram(lab_lut.lab_bins(lab, lab_transform.adaptation))
+    # histogram() of a multi-band image is the concatenation of the per-band
+    # histograms, which avoids splitting the image into separate bands
+    return LabHistogram.from_flat(lab.histogram())
+
+def image_strips(image: Image.Image, max_memory: int, mode: str = None):
+    """Yields (top, strip) for the horizontal strips of an opened image, each
+    converted to mode when one is given. The strip height is chosen so that
+    the copies made of a strip while it is analyzed stay within max_memory
+    bytes."""
+    width, height = image.size
+    rows = max(1, max_memory // (max(width, 1) * STRIP_BYTES_PER_PIXEL))
+    for top in range(0, height, rows):
+        strip = image.crop((0, top, width, min(top + rows, height)))
+        if mode is not None and strip.mode != mode:
+            strip = strip.convert(mode)
+        yield top, strip
+
+def lab_histogram_in_strips(image: Image.Image, max_memory: int, image_path: str = None, lab_transform: LabTransform = None) -> LabHistogram:
+    """Returns the LAB histograms of an opened image, converting it one
+    horizontal strip at a time. The strip height is chosen so that the RGB and
+    LAB copies of a strip stay within max_memory bytes; only the decoded source
+    image is held at full resolution. The transform and the histogram are both
+    per-pixel, so adding up the histograms of the strips gives exactly the
+    histogram of the whole image. The transform defaults to sRGB to LAB."""
+    from PIL import ImageCms
+    lab_transform = lab_transform or get_transform()
+    hist = LabHistogram.zeros()
+    # the strips are recorded as a single stage rather than one per strip
+    with profiling.stage("strips", image_path):
+        for _, strip in image_strips(image, max_memory, lab_transform.mode):
+            lab = ImageCms.applyTransform(strip, lab_transform.transform)
+            hist += __lab_image_histogram(lab, lab_transform)
+    return hist
+
+def image_to_lab_array(image: Image.Image, max_memory: int = None, image_path: str = None, engine: str = "lcms",
+        color: ColorSettings = None) -> np.ndarray:
+    """Returns an opened image converted to LAB as a (height, width, channels)
+    array of histogram bins, i.e. with the same values Image.histogram() counts.
+    When max_memory is given the image is converted in strips, as in
+    lab_histogram_in_strips, directly into the array."""
+    from PIL import ImageCms
+    lab_transform = (color or DEFAULT_COLOR).transform_for(image)
+    if engine == "lut" and lab_transform.mode == "RGB":
+        import lab_lut
+        return lab_lut.lab_array(image, get_lab_lut(lab_transform), max_memory, image_path)
+    transform = lab_transform.transform
+    if max_memory is None:
+        converted = convert_image(image, lab_transform.mode, image_path)
+        with profiling.stage("apply_transform", image_path):
+            lab = __lab_image_bins(ImageCms.applyTransform(converted, transform), lab_transform)
+    else:
+        width, height = image.size
+        lab = np.empty((height, width, 3), dtype=np.uint8)
+        with profiling.stage("strips", image_path):
+            for top, strip in image_strips(image, max_memory, lab_transform.mode):
+                lab[top:top + strip.height] = __lab_image_bins(ImageCms.applyTransform(strip, transform), lab_transform)
+    return lab
+
+def __lab_image_bins(lab: Image.Image, lab_transform: LabTransform) -> np.ndarray:
+    """Returns a LAB image converted by ImageCms as a (height, width, channels)
+    array of histogram bins, adapted to the illuminant of the transform."""
+    if lab_transform.adaptation is not None:
+        import lab_lut
+        return lab_lut.lab_bins(lab, lab_transform.adaptation)[:, :, :3]
+    bins = np.array(lab)
+    # PIL stores a* and b* as signed bytes, and its histogram() offsets them by
+    # 128 into the 0-255 bins
+    bins[:, :, 1:] ^= 0x80
+    return bins
+
+def lab_regions_of_image(image: Image.Image, max_memory: int = None, image_path: str = None, engine: str = "lcms",
+        color: ColorSettings = None) -> RegionHistograms:
+    """Converts an opened image to LAB and precomputes the RegionHistograms of
+    it, from which the histograms of any number of ROIs are then calculated
+    without converting the image again. ROI coordinates refer to pixels of
+    the image file even when the image was opened reduced."""
+    from PIL import Image
+    lab = image_to_lab_array(image, max_memory, image_path, engine, color)
+    source_size = image.size
+    if image_path is not None:
+        # the image has been decoded by now, so rewinding a file object it was
+        # opened from is safe
+        if hasattr(image_path, "seek"):
+            image_path.seek(0)
+        with Image.open(image_path) as source:
+            source_size = source.size
+    return RegionHistograms(lab, source_size)
+
+def lab_regions(image_path: str, max_memory: int = None, reduce: int = 1, engine: str = "lcms", color: ColorSettings = None) -> RegionHistograms:
+    """Opens the specified image and returns its RegionHistograms, see
+    lab_regions_of_image."""
+    return lab_regions_of_image(open_image(image_path, reduce), max_memory, image_path, engine, color)
+
+def make_thumbnail(image: Image.Image, size: int = THUMBNAIL_SIZE, image_path: str = None) -> bytes:
+    """Returns a PNG thumbnail of an opened image that fits within size x size
+    pixels. The image is resized directly rather than copied first, so if it
+    has not been decoded yet it is decoded once here and stays decoded for
+    whatever uses it next."""
+    from PIL import Image
+    with profiling.stage("thumbnail", image_path):
+        if image.mode not in ("1", "L", "P", "RGB", "RGBA"):
+            image = image.convert("RGB")
+        scale = size / max(image.size)
+        thumb_size = (max(1, round(image.width * scale)), max(1, round(image.height * scale)))
+        thumb = image.resize(thumb_size, Image.BILINEAR, reducing_gap=2.0)
+        png = io.BytesIO()
+        thumb.save(png, "PNG")
+    return png.getvalue()
+
+def analyze_image(image_path: str, max_memory: int = None, reduce: int = 1, roi=None, thumbnail_size: int = THUMBNAIL_SIZE, engine: str = "lcms",
+        color: ColorSettings = None) -> tuple:
+    """Decodes the image once and returns both its LAB histograms, as
+    image_to_lab_histogram would, and a PNG thumbnail made from the same
+    decoded image (see make_thumbnail)."""
+    image = open_image(image_path, reduce)
+    thumbnail = make_thumbnail(image, thumbnail_size, image_path)
+    return lab_histogram_of_image(image, max_memory, image_path, roi, engine, color), thumbnail
+
+def estimate_average_error(hist, ndigits=2):
+    """Returns the estimated error of the L*, a* and b* averages of a histogram
+    calculated from a reduced image, relative to the full image. Estimated as
+    the standard error of the mean of the sampled pixels."""
+    hist = as_histogram(hist, LabHistogram)
+    errors = hist.lab_std() / np.sqrt(hist.pixel_count().astype(np.float64))
+    return tuple(round(float(e), ndigits) for e in errors)
+
+def transform_params(reduce: int = 1, roi=None, color: ColorSettings = None, **options) -> str:
+    """Returns the parameters identifying how histograms were calculated with
+    the specified analysis options, for use in histogram cache keys. Options
+    that do not change the result, such as max_memory and the engine, are
+    left out."""
+    params = (color or DEFAULT_COLOR).params()
+    if reduce > 1:
+        params += f";reduce={reduce}"
+    if roi is not None:
+        params += f";roi={roi.params()}"
+    return params
+
+def _init_batch_worker(engine: str = "lcms", color: ColorSettings = None):
+    """Process pool initializer. Builds the LAB transform of sRGB images with
+    the color settings, or maps the lookup table of the lut engine, up front
+    so that every image handled by the worker reuses it. Transforms of
+    embedded profiles are built as images using them arrive."""
+    # a forked worker starts with a copy of the parent's profiling records,
+    # which the parent already has; only the worker's own are sent back
+    profiling.drain()
+    lab_transform = (color or DEFAULT_COLOR).srgb_transform()
+    if engine == "lut":
+        get_lab_lut(lab_transform)
+
+def _prepare_batch_workers(workers: int, options: dict) -> tuple:
+    """Prepares the analysis of images with the options by a pool of worker
+    processes. Returns the options of each worker, and the initargs of
+    _init_batch_worker."""
+    options = dict(options)
+    if options.get("max_memory") is not None:
+        # the budget applies to the strips of every worker combined
+        options["max_memory"] //= workers
+    engine, color = options.get("engine", "lcms"), options.get("color")
+    # built here so that the workers do not all build the tables at once
+    lab_transform = (color or DEFAULT_COLOR).srgb_transform()
+    if engine == "lut":
+        get_lab_lut(lab_transform)
+    return options, (engine, color)
+
+def _analyze_in_worker(image_path: str, options: dict):
+    """Worker process entry point. Returns the LAB histograms of the image along
+    with the profiling records collected while analyzing it, so that they can
+    be added to the parent's report."""
+    hist = image_to_lab_histogram(image_path, **options)
+    return hist, profiling.drain()
+
+def __analyze_or_record_error(analyze, image_path: str, errors: dict):
+    """Returns the result of analyze, or when errors is given, None after
+    storing the exception it raised there under the image path."""
+    if errors is None:
+        return analyze()
+    try:
+        return analyze()
+    except Exception as e:
+        errors[image_path] = e
+        return None
+
+def __compute_lab_histograms(image_paths: list, workers: int = None, errors: dict = None, **options) -> list:
+    """Computes the LAB histograms of the images, spreading them across a pool
+    of worker processes. The options are passed on to image_to_lab_histogram.
+    See batch_lab_histograms for errors."""
+    if workers is None:
+        workers = os.cpu_count() or 1
+    workers = min(workers, len(image_paths))
+    if workers <= 1:
+        return [__analyze_or_record_error(partial(image_to_lab_histogram, x, **options), x, errors) for x in image_paths]
+    from concurrent.futures import ProcessPoolExecutor
+    options, initargs = _prepare_batch_workers(workers, options)
+    analyze = partial(_analyze_in_worker, options=options)
+    hists = []
+    with ProcessPoolExecutor(max_workers=workers, initializer=_init_batch_worker, initargs=initargs) as pool:
+        # the results are collected in submission order, regardless of which
+        # worker finishes first
+        futures = [pool.submit(analyze, x) for x in image_paths]
+        for image_path, future in zip(image_paths, futures):
+            hist, records = __analyze_or_record_error(future.result, image_path, errors) or (None, [])
+            hists.append(hist)
+            profiling.extend(records)
+    return hists
+
+def batch_lab_histograms(image_paths: list, workers: int = None, cache: HistogramCache = None, errors: dict = None, **options) -> list:
+    """Returns the LAB histograms for each of the specified images, in the same
+    order as the paths were given. The images are spread across a pool of
+    worker processes; when workers is None the pool uses one process per CPU.
+    With a single worker, or a single image, the work is done in-process.
+    When a cache is given, only the images missing from it are decoded and the
+    new results are added to it. When errors is given, an image that cannot be
+    analyzed does not stop the others: the exception is stored in errors under
+    its path and its histograms are None. The remaining options (max_memory,
+    reduce, roi, engine) are passed on to image_to_lab_histogram."""
+    hists = [None] * len(image_paths)
+    keys = [None] * len(image_paths)
+    if cache is not None:
+        for i, image_path in enumerate(image_paths):
+            with profiling.stage("cache_lookup", image_path):
+                keys[i] = cache.key(image_path, transform_params(**options))
+                counts = cache.get(keys[i])
+            if counts is not None:
+                hists[i] = LabHistogram(counts)
+    missing = [i for i, hist in enumerate(hists) if hist is None]
+    if missing:
+        computed = __compute_lab_histograms([image_paths[i] for i in missing], workers, errors, **options)
+        for i, hist in zip(missing, computed):
+            hists[i] = hist
+            if cache is not None and hist is not None:
+                cache.put(keys[i], hist)
+    return hists
+
+def lab_histogram(image_path: str, cache: HistogramCache = None, **options) -> LabHistogram:
+    """Returns the LAB histograms of a single image, using the cache when one
+    is given."""
+    return batch_lab_histograms([image_path], 1, cache, **options)[0]
+
+def lab_histogram_with_thumbnail(image_path: str, cache: HistogramCache = None, thumbnail_cache: ThumbnailCache = None, **options) -> tuple:
+    """Returns the LAB histograms and a PNG thumbnail of a single image. The
+    file is hashed once for both caches. When the histograms have to be
+    calculated the thumbnail is made from the same decode; when only the
+    thumbnail is missing the image is decoded at (or near) thumbnail size,
+    which JPEG decoders do far faster than a full decode."""
+    from PIL import Image
+    digest = file_digest(image_path) if cache is not None or thumbnail_cache is not None else None
+    hist, thumbnail, key = None, None, None
+    if cache is not None:
+        with profiling.stage("cache_lookup", image_path):
+            key = cache.key(image_path, transform_params(**options), digest)
+            counts = cache.get(key)
+        if counts is not None:
+            hist = LabHistogram(counts)
+    if thumbnail_cache is not None:
+        thumbnail = thumbnail_cache.get(digest)
+    if hist is None:
+        hist, new_thumbnail = analyze_image(image_path, **options)
+        if cache is not None:
+            cache.put(key, hist)
+    elif thumbnail is None:
+        image = Image.open(image_path)
+        image.draft(None, (THUMBNAIL_SIZE, THUMBNAIL_SIZE))
+        new_thumbnail = make_thumbnail(image, THUMBNAIL_SIZE, image_path)
+    if thumbnail is None:
+        thumbnail = new_thumbnail
+        if thumbnail_cache is not None:
+            thumbnail_cache.put(digest, thumbnail)
+    return hist, thumbnail
+
+RAW_FORMATS = ("csv", "npz", "both")
+
+def __raw_images(prl: list, prr: list, pol: list, por: list) -> list:
+    """Returns (label, histogram) for every image of the raw output, in the
+    order of its columns."""
+    images = [("pre_left", prl)]
     if prr and len(prr) > 0:
-        header += ["pre_right_L", "pre_right_a", "pre_right_b"]
+        images.append(("pre_right", prr))
     if pol and len(pol) > 0:
-        for i in range(len(pol)):
-            header += [f"post_left_{i}_L", f"post_left_{i}_a", f"post_left_{i}_b"]
+        images += [(f"post_left_{i}", pol_img) for i, pol_img in enumerate(pol)]
     if por and len(por) > 0:
-        for i in range(len(por)):
-            header += [f"post_right_{i}_L", f"post_right_{i}_a", f"post_right_{i}_b"]
-    for i in range(len(prl[0])):
-        row=[prl[0][i], prl[1][i], prl[2][i]]
-        if prr and len(prr) > 0:
-            row += [prr[0][i], prr[1][i], prr[2][i]]
-        if pol and len(pol) > 0:
-            for pol_img in pol:
-                row += [pol_img[0][i], pol_img[1][i], pol_img[2][i]]
-        if por and len(por) > 0:
-            for por_img in por:
-                row += [por_img[0][i], por_img[1][i], por_img[2][i]]
-        rows.append(row)
-    csv_file = open(output_file + ".csv", 'w')
-    writer = csv.writer(csv_file)
-    writer.writerow(header)
-    writer.writerows(rows)
-    csv_file.close()
+        images += [(f"post_right_{i}", por_img) for i, por_img in enumerate(por)]
+    return images
 
-def __generate_final_report(prl: list, prr: list, pol: list, por: list, output_file: str) -> list:
-    """Creates the averages output for usage in analysis"""
-    fname=output_file+"_summary.csv"
-    headers=["id", "desc", "avgL", "avgA", "avgB"]
+def __generate_raw_output(prl: list, prr: list, pol: list, por: list, output_file: str, raw_format: str = "csv") -> list:
+    """Generates the raw LAB histograms output: a CSV with one column per
+    channel of each image and one row per bin, an NPZ file of dense arrays, or
+    both (see RAW_FORMATS)."""
+    images = __raw_images(prl, prr, pol, por)
+    labels = [label for label, _ in images]
+    # one (channels, bins) array per image, stacked into (images, channels, bins)
+    histograms = np.stack([as_histogram(hist, LabHistogram).counts for _, hist in images])
+    if raw_format in ("csv", "both"):
+        __write_raw_csv(labels, histograms, output_file + ".csv")
+    if raw_format in ("npz", "both"):
+        __write_raw_npz(labels, histograms, output_file + ".npz")
+
+def __write_raw_csv(labels: list, histograms: np.ndarray, fname: str):
+    """Writes the histograms as a CSV, streaming it one bin at a time rather
+    than building the transposed table in memory first."""
+    header = [f"{label}_{channel}" for label in labels for channel in ("L", "a", "b")]
+    # columns are the channels of each image in turn; each row is a single bin
+    columns = histograms.reshape(-1, histograms.shape[-1])
+    with profiling.stage("write_raw_csv"):
+        csv_file = open(fname, 'w')
+        writer = csv.writer(csv_file)
+        writer.writerow(header)
+        for i in range(columns.shape[1]):
+            writer.writerow(columns[:, i].tolist())
+        csv_file.close()
+
+def __write_raw_npz(labels: list, histograms: np.ndarray, fname: str):
+    """Writes the histograms as a compressed NPZ file containing a
+    (images, channels, bins) uint64 'histograms' array and the matching
+    'labels'. See load_raw_npz."""
+    with profiling.stage("write_raw_npz"):
+        np.savez_compressed(fname, histograms=histograms, labels=np.array(labels), channels=np.array(["L", "a", "b"]))
+
+def load_raw_npz(fname: str) -> dict:
+    """Loads a raw output written in the NPZ format. Returns the histograms of
+    each image keyed by label (pre_left, pre_right, post_left_0, ...), in
+    column order."""
+    with np.load(fname) as data:
+        return {str(label): LabHistogram(hist) for label, hist in zip(data["labels"], data["histograms"])}
+
+SUMMARY_HEADERS = ["id", "desc", "avgL", "avgA", "avgB"]
+
+def __final_report_rows(prl: list, prr: list, pol: list, por: list) -> list:
+    """Returns the rows of the averages output: one for each image and one for
+    the difference between each post-op image and its pre-op image."""
     rows=[]
     id=1
     l, a, b = lab_hist_weighed_average(prl)
@@ -118,33 +546,322 @@ def __generate_final_report(prl: list, prr: list, pol: list, por: list, output_f
             id+=1
             rows.append([id, f"Difference Post-op {i + 1} right-side vs Pre-op right side", l-prel, a-prea, b-preb])
             id+=1
-    csv_file = open(fname, 'w')
+    return rows
+
+def __generate_final_report(prl: list, prr: list, pol: list, por: list, output_file: str) -> list:
+    """Creates the averages output for usage in analysis"""
+    fname=output_file+"_summary.csv"
+    rows = __final_report_rows(prl, prr, pol, por)
+    with profiling.stage("write_summary_csv"):
+        csv_file = open(fname, 'w')
+        writer = csv.writer(csv_file)
+        writer.writerow(SUMMARY_HEADERS)
+        writer.writerows(rows)
+        csv_file.close()
+
+def __generate_error_report(image_paths: list, hists: list, output_file: str):
+    """Creates a CSV of the estimated error of the averages of each image, for
+    histograms calculated in the fast approximate mode."""
+    csv_file = open(output_file + "_error.csv", 'w')
     writer = csv.writer(csv_file)
-    writer.writerow(headers)
-    writer.writerows(rows)
+    writer.writerow(["image", "errL", "errA", "errB"])
+    for image_path, hist in zip(image_paths, hists):
+        writer.writerow([image_path, *estimate_average_error(hist)])
     csv_file.close()
 
-def __cli_main(pre_l: str, pre_r: str, post_l: list, post_r: list, output: str):
-    """Entry point for the CLI"""
+def validate_fast_mode(folder: str, reduce: int = DEFAULT_FAST_REDUCE) -> list:
+    """Analyzes every image in the folder both in full and in the fast
+    approximate mode. Returns a row per image with the actual and estimated
+    error of the fast averages and the speedup over the full decode."""
+    rows = []
+    get_rgb2lab_transform()
+    for name in sorted(os.listdir(folder)):
+        if not name.lower().endswith(IMAGE_EXTENSIONS):
+            continue
+        image_path = os.path.join(folder, name)
+        start = time.perf_counter()
+        full = lab_hist_weighed_average(image_to_lab_histogram(image_path), ndigits=4)
+        full_time = time.perf_counter() - start
+        start = time.perf_counter()
+        fast_hist = image_to_lab_histogram(image_path, reduce=reduce)
+        fast = lab_hist_weighed_average(fast_hist, ndigits=4)
+        fast_time = time.perf_counter() - start
+        actual = [round(abs(f - a), 4) for f, a in zip(fast, full)]
+        estimated = estimate_average_error(fast_hist, ndigits=4)
+        rows.append([name, *actual, *estimated, round(full_time, 4), round(fast_time, 4), round(full_time / fast_time, 2)])
+    return rows
+
+def __validate_fast_cli(folder: str, reduce: int, output: str):
+    """Runs validate_fast_mode and reports the results."""
+    headers = ["image", "errL", "errA", "errB", "estErrL", "estErrA", "estErrB", "full_s", "fast_s", "speedup"]
+    rows = validate_fast_mode(folder, reduce)
+    if output:
+        csv_file = open(output + "_fast_validation.csv", 'w')
+        writer = csv.writer(csv_file)
+        writer.writerow(headers)
+        writer.writerows(rows)
+        csv_file.close()
+    else:
+        print(",".join(headers))
+        for row in rows:
+            print(",".join(str(x) for x in row))
+    if rows:
+        max_error = max(max(row[1:4]) for row in rows)
+        speedup = sum(row[-1] for row in rows) / len(rows)
+        print(f"{len(rows)} images, reduce={reduce}: max error {max_error}, mean speedup {speedup:.2f}x")
+
+def __write_outputs(pre_l: str, pre_r: str, post_l: list, post_r: list, hists: list, output: str, raw_format: str = "csv", reduce: int = 1):
+    """Writes the outputs of a set of images from their histograms, given in
+    the same order as the paths."""
+    image_paths = [pre_l] + ([pre_r] if pre_r else []) + post_l + post_r
+    hists = list(hists)
     pre_l_hist, pre_r_hist, post_l_hist, post_r_hist = [], [], [], []
-    pre_l_hist = image_to_lab_histogram(pre_l)
+    if reduce > 1:
+        __generate_error_report(image_paths, hists, output)
+    pre_l_hist = hists.pop(0)
     if pre_r:
-        pre_r_hist = image_to_lab_histogram(pre_r)
+        pre_r_hist = hists.pop(0)
     if post_l:
-        post_l_hist = [image_to_lab_histogram(x) for x in post_l]
+        post_l_hist = hists[:len(post_l)]
     if post_r:
-        post_r_hist = [image_to_lab_histogram(x) for x in post_r]
-    __generate_raw_output(pre_l_hist, pre_r_hist, post_l_hist, post_r_hist, output)
+        post_r_hist = hists[len(post_l):]
+    __generate_raw_output(pre_l_hist, pre_r_hist, post_l_hist, post_r_hist, output, raw_format)
+    __generate_final_report(pre_l_hist, pre_r_hist, post_l_hist, post_r_hist, output)
+
+def verify_lut_engine(folder: str = None, max_memory: int = None, color: ColorSettings = None) -> tuple:
+    """Checks that the lut engine gives exactly the results of ImageCms.
+    Compares every entry of the lookup table with the transform applied to its
+    color, which covers every possible 8-bit image, then, when a folder is
+    given, the histograms of every image in it calculated with both engines
+    and the color settings. Returns the number of colors that differ and a row per image with whether
+    its histograms are identical and the time each engine took to convert
+    it."""
+    import lab_lut
+    lab_transform = (color or DEFAULT_COLOR).srgb_transform()
+    mismatches = lab_lut.verify_lut(get_lab_lut(lab_transform), lab_transform)
+    rows = []
+    for name in sorted(os.listdir(folder)) if folder else []:
+        if not name.lower().endswith(IMAGE_EXTENSIONS):
+            continue
+        image_path = os.path.join(folder, name)
+        # decoded once up front so that only the conversions are timed
+        image = open_image(image_path)
+        image.load()
+        start = time.perf_counter()
+        lcms = lab_histogram_of_image(image, max_memory, image_path, engine="lcms", color=color)
+        lcms_time = time.perf_counter() - start
+        start = time.perf_counter()
+        lut = lab_histogram_of_image(image, max_memory, image_path, engine="lut", color=color)
+        lut_time = time.perf_counter() - start
+        rows.append([name, lcms == lut, round(lcms_time, 4), round(lut_time, 4), round(lcms_time / lut_time, 2)])
+    return mismatches, rows
+
+def __verify_lut_cli(folder: str, max_memory: int, output: str, color: ColorSettings = None) -> bool:
+    """Runs verify_lut_engine and reports the results. Returns True if the
+    lut engine matched ImageCms everywhere."""
+    headers = ["image", "identical", "lcms_s", "lut_s", "speedup"]
+    mismatches, rows = verify_lut_engine(folder, max_memory, color)
+    if output and rows:
+        csv_file = open(output + "_lut_verification.csv", 'w')
+        writer = csv.writer(csv_file)
+        writer.writerow(headers)
+        writer.writerows(rows)
+        csv_file.close()
+    elif rows:
+        print(",".join(headers))
+        for row in rows:
+            print(",".join(str(x) for x in row))
+    print(f"lookup table: {mismatches} of {1 << 24} colors differ from ImageCms")
+    if rows:
+        identical = sum(1 for row in rows if row[1])
+        speedup = sum(row[-1] for row in rows) / len(rows)
+        print(f"{len(rows)} images: {identical} with identical histograms, mean speedup {speedup:.2f}x")
+    return mismatches == 0 and all(row[1] for row in rows)
+
+def __cli_main(pre_l: str, pre_r: str, post_l: list, post_r: list, output: str, workers: int = None, cache: HistogramCache = None,
+        raw_format: str = "csv", **options):
+    """Entry point for the CLI"""
+    post_l = post_l or []
+    post_r = post_r or []
+    # process every image as a single batch, then split the results back up in
+    # the same order the paths were passed in
+    image_paths = [pre_l] + ([pre_r] if pre_r else []) + post_l + post_r
+    hists = batch_lab_histograms(image_paths, workers, cache, **options)
+    __write_outputs(pre_l, pre_r, post_l, post_r, hists, output, raw_format, options.get("reduce", 1))
+
+def __write_manifest_outputs(cases: list, hists: dict, raw_format: str = "csv", reduce: int = 1):
+    """Writes the outputs of every patient of a batch manifest, given the
+    histograms of its images keyed by path."""
+    for case in cases:
+        __write_outputs(case["preop_left"], case["preop_right"], case["postop_left"], case["postop_right"],
+            [hists[x] for x in shards.case_images(case)], case["output"], raw_format, reduce)
+
+def __batch_main(cases: list, workers: int = None, cache: HistogramCache = None, raw_format: str = "csv", **options):
+    """Analyzes every image of a batch manifest in a single run and writes the
+    outputs of each patient."""
+    images = shards.manifest_images(cases)
+    hists = batch_lab_histograms(images, workers, cache, **options)
+    __write_manifest_outputs(cases, dict(zip(images, hists)), raw_format, options.get("reduce", 1))
+
+def __shard_main(cases: list, shard: tuple, output: str, workers: int = None, cache: HistogramCache = None, **options):
+    """Analyzes the images of a single shard of a batch manifest. Writes their
+    histograms to the partial file of the shard, to be combined with the other
+    shards by __merge_main, and their averages to the partial summary
+    <output>_shard_<i>_of_<N>_summary.csv."""
+    index, count = shard
+    images = shards.manifest_images(cases)
+    indices = shards.shard_indices(len(images), index, count)
+    hists = batch_lab_histograms([images[i] for i in indices], workers, cache, **options)
+    path = shards.shard_path(output, index, count)
+    shards.save_shard(path, cases, index, count, indices, hists, transform_params(**options), options.get("reduce", 1))
+    csv_file = open(path[:-len(".npz")] + "_summary.csv", 'w')
+    writer = csv.writer(csv_file)
+    writer.writerow(["image", "avgL", "avgA", "avgB"])
+    for i, hist in zip(indices, hists):
+        writer.writerow([images[i], *lab_hist_weighed_average(hist)])
+    csv_file.close()
+    print(f"shard {index}/{count}: analyzed {len(indices)} of {len(images)} image(s), wrote {path}")
+
+def __merge_main(paths: list, raw_format: str = "csv"):
+    """Combines the partial files of every shard of a batch manifest and writes
+    the outputs of each patient, identical to those of a single run."""
+    cases, hists, reduce = shards.merge_shards(paths)
+    __write_manifest_outputs(cases, hists, raw_format, reduce)
+    print(f"merged {len(paths)} shard(s): wrote the outputs of {len(cases)} patient(s)")
+
+def natural_key(text: str) -> list:
+    """Sort key ordering the numbers within text by value, so that patient2
+    comes before patient10."""
+    return [int(x) if x.isdigit() else x for x in re.split(r"(\d+)", text.lower())]
+
+def __watched_images(folder: str, pattern: str) -> list:
+    """Returns the images in the folder whose (lower case) file name matches
+    the pattern, in natural order of their file names (day7 before day10)."""
+    now = time.time()
+    images = []
+    for name in sorted(os.listdir(folder), key=natural_key):
+        image_path = os.path.join(folder, name)
+        if not name.lower().endswith(IMAGE_EXTENSIONS) or not fnmatch(name.lower(), pattern.lower()):
+            continue
+        try:
+            if now - os.path.getmtime(image_path) < WATCH_SETTLE_SECONDS:
+                continue
+        except FileNotFoundError:
+            # removed since the folder was listed
+            continue
+        images.append(image_path)
+    return images
+
+def __file_state(image_path: str):
+    """Returns the size and modification time of the file, or None if it does
+    not exist."""
+    try:
+        st = os.stat(image_path)
+    except FileNotFoundError:
+        return None
+    return st.st_size, st.st_mtime
+
+def __watch_pass(folder: str, pre_l: str, pre_r: str, output: str, left_pattern: str, right_pattern: str,
+        workers: int = None, cache: HistogramCache = None, raw_format: str = "csv", failed: dict = None, **options) -> int:
+    """Runs a single pass of the folder-watch mode. Only images that are new or
+    have changed since the previous pass are analyzed; the histograms of the
+    others come from the manifest. A post-op image that cannot be analyzed is
+    reported and left out of the outputs and the manifest, and is only tried
+    again once it changes: failed maps such images to their size and
+    modification time across passes. Images removed during the pass are
+    treated as not present. Returns the number of images analyzed."""
+    failed = {} if failed is None else failed
+    manifest_file = manifest.manifest_path(output)
+    recorded = manifest.load_manifest(manifest_file, transform_params(**options))
+    post_l = [x for x in __watched_images(folder, left_pattern) if x not in failed or failed[x] != __file_state(x)]
+    post_r = [x for x in __watched_images(folder, right_pattern) if x not in post_l and (x not in failed or failed[x] != __file_state(x))]
+    pre_images = [pre_l] + ([pre_r] if pre_r else [])
+
+    stale = manifest.stale_images(recorded, pre_images + post_l + post_r)
+    errors = {}
+    if stale:
+        hists = batch_lab_histograms(list(stale), workers, cache, errors, **options)
+        for (image_path, digest), hist in zip(stale.items(), hists):
+            if hist is not None:
+                manifest.record_image(recorded, image_path, digest, hist)
+    for image_path, error in errors.items():
+        if image_path in pre_images:
+            raise error
+        print(f"skipping {image_path}: {error}", file=sys.stderr)
+        failed[image_path] = __file_state(image_path)
+    for image_path in pre_images:
+        if image_path not in recorded["files"]:
+            raise FileNotFoundError(f"pre-op photograph {image_path} not found")
+    # images that could not be analyzed, or were removed during the pass, are
+    # left out
+    post_l = [x for x in post_l if x in recorded["files"] and x not in errors]
+    post_r = [x for x in post_r if x in recorded["files"] and x not in errors]
+    removed = manifest.forget_missing(recorded, pre_images + post_l + post_r)
+    if not stale and not removed and os.path.exists(output + "_summary.csv"):
+        manifest.save_manifest(recorded, manifest_file)
+        return 0
+
+    pre_l_hist = manifest.recorded_histogram(recorded, pre_l)
+    pre_r_hist = manifest.recorded_histogram(recorded, pre_r) if pre_r else []
+    post_l_hist = [manifest.recorded_histogram(recorded, x) for x in post_l]
+    post_r_hist = [manifest.recorded_histogram(recorded, x) for x in post_r]
+    __generate_raw_output(pre_l_hist, pre_r_hist, post_l_hist, post_r_hist, output, raw_format)
+    # rewritten as a whole, so that an image sorting before those already
+    # reported moves the later ones down rather than taking over their rows
     __generate_final_report(pre_l_hist, pre_r_hist, post_l_hist, post_r_hist, output)
+    manifest.save_manifest(recorded, manifest_file)
+    return len(stale) - len(errors)
 
-def handle_cli():
+def watch_folder(folder: str, pre_l: str, pre_r: str, output: str, left_pattern: str = "*left*", right_pattern: str = "*right*",
+        interval: float = 30, once: bool = False, workers: int = None, cache: HistogramCache = None, raw_format: str = "csv", **options):
+    """Incremental batch mode. Watches the folder for post-op images, assigning
+    them to the left or right side by file name pattern and ordering them by
+    file name. Each time new or changed images appear, only those images are
+    analyzed and the outputs are updated. Runs until interrupted, or for a
+    single pass when once is True. Images that cannot be analyzed are
+    reported and skipped until they change."""
+    failed = {}
+    while True:
+        analyzed = __watch_pass(folder, pre_l, pre_r, output, left_pattern, right_pattern, workers, cache, raw_format, failed, **options)
+        if analyzed:
+            print(f"{time.strftime('%Y-%m-%d %H:%M:%S')}: analyzed {analyzed} new or changed image(s)")
+        if cache is not None:
+            cache.save_stats()
+        profiling.write_report(output)
+        if once:
+            return
+        try:
+            time.sleep(interval)
+        except KeyboardInterrupt:
+            return
+
+def __roi_argument(spec: str):
+    """argparse type of --roi, reporting why a spec is invalid."""
+    try:
+        return parse_roi(spec)
+    except ValueError as e:
+        raise ArgumentTypeError(str(e))
+
+def __illuminant_argument(spec: str) -> str:
+    """argparse type of --illuminant, reporting why a spec is invalid."""
+    try:
+        return parse_illuminant(spec)
+    except ValueError as e:
+        raise ArgumentTypeError(str(e))
+
+def __shard_argument(spec: str) -> tuple:
+    """argparse type of --shard, reporting why a spec is invalid."""
+    try:
+        return shards.parse_shard(spec)
+    except ValueError as e:
+        raise ArgumentTypeError(str(e))
+
+def handle_cli(argv: list = None):
     parser = ArgumentParser(description="Generates histograms and average values in the CIELAB color space for a set of images. Intended to be used for pre-op and post-op images of patients undergoing surgery, the average values specifically may be compared to quantify differences in bilateral bruising. May be used with a single photograph or with a complete set of pre and post-op photographs.")
     parser.add_argument("--preop-left", "-p",
-        help="Left-side pre-op photograph",
-        required=True)
+        help="Left-side pre-op photograph. Required unless --validate-fast, --verify-lut, --serve, --batch-manifest or --merge is used.")
     parser.add_argument("--output", "-o",
-        help="Name to use for the output files. Should not include a file extension",
-        required=True)
+        help="Name to use for the output files. Should not include a file extension. Required unless --validate-fast, --verify-lut, --serve, --batch-manifest or --merge is used. With --shard, the name of the partial files.")
     parser.add_argument("--preop-right",
         help="Right-side pre-op photograph")
     parser.add_argument("--postop-left",
@@ -153,9 +870,169 @@ def handle_cli():
     parser.add_argument("--postop-right",
         nargs="+",
         help="Right-side post-op photographs. When using more than one, ensure that the images are in the correct order in both this and the --postop-left argument.")
+    parser.add_argument("--workers", "-j",
+        type=int,
+        help="Number of worker processes used to analyze the images. Defaults to the number of CPUs.")
+    parser.add_argument("--cache-dir",
+        help="Directory of the histogram cache and the lookup tables of the lut engine. Defaults to the per-user cache directory.")
+    parser.add_argument("--cache-size",
+        type=int,
+        default=DEFAULT_MAX_BYTES // (1024 * 1024),
+        help="Maximum size of the histogram cache in megabytes, including the lookup tables of the lut engine. The least recently used entries are removed first.")
+    parser.add_argument("--no-cache",
+        action="store_true",
+        help="Always analyze the images, without reading or writing the histogram cache.")
+    parser.add_argument("--max-memory",
+        type=int,
+        help="Memory budget in megabytes for converting the images. Large images are converted in strips that fit within the budget instead of all at once. The results are identical.")
+    parser.add_argument("--fast",
+        type=int,
+        nargs="?",
+        const=DEFAULT_FAST_REDUCE,
+        default=1,
+        metavar="FACTOR",
+        help=f"Fast approximate mode. Analyzes the images at 1/FACTOR of their width and height (default {DEFAULT_FAST_REDUCE}) and writes the estimated error of the averages to <output>_error.csv.")
+    parser.add_argument("--validate-fast",
+        metavar="FOLDER",
+        help="Measures the actual error and speedup of the fast mode on every image in the folder, compared to a full decode. Writes <output>_fast_validation.csv when --output is given, otherwise prints the results.")
+    parser.add_argument("--engine",
+        choices=ENGINES,
+        default="lcms",
+        help="How the images are converted to LAB: lcms applies LittleCMS to every pixel (the default), lut looks every pixel up in a table of all 16.7 million RGB colors built once from the same transform and kept in the cache directory. Both give identical results; lut analyzes images about twice as fast.")
+    parser.add_argument("--illuminant",
+        type=__illuminant_argument,
+        default=DEFAULT_COLOR.illuminant,
+        metavar="ILLUMINANT",
+        help="White point the LAB values are relative to: D50 (the default, the white of ICC color management), D55, D65 or D75, or a color temperature in kelvin such as 5000K. Other white points than D50 are reached by Bradford chromatic adaptation.")
+    parser.add_argument("--intent",
+        choices=list(RENDERING_INTENTS),
+        default=DEFAULT_COLOR.intent,
+        help="Rendering intent of the conversion to LAB (default: perceptual).")
+    parser.add_argument("--ignore-embedded-profiles",
+        action="store_true",
+        help="Treat every image as sRGB, ignoring the ICC profiles (e.g. Adobe RGB or Display P3) embedded in them. Images without a profile are always treated as sRGB.")
+    parser.add_argument("--verify-lut",
+        nargs="?",
+        const="",
+        metavar="FOLDER",
+        help="Checks that the lut engine gives exactly the same results as lcms: every color of the lookup table, and the histograms of every image in the folder when one is given. Writes <output>_lut_verification.csv when --output is given, otherwise prints the results. Exits with status 1 on any difference.")
+    parser.add_argument("--watch",
+        metavar="FOLDER",
+        help="Incremental mode. Watches the folder for post-op photographs and updates the outputs whenever images are added or changed, analyzing only those images. Replaces --postop-left and --postop-right.")
+    parser.add_argument("--left-pattern",
+        default="*left*",
+        help="File name pattern of left-side post-op photographs in the watched folder (default: *left*). Matching is case-insensitive.")
+    parser.add_argument("--right-pattern",
+        default="*right*",
+        help="File name pattern of right-side post-op photographs in the watched folder (default: *right*). Matching is case-insensitive.")
+    parser.add_argument("--interval",
+        type=float,
+        default=30,
+        help="Seconds between checks of the watched folder (default: 30).")
+    parser.add_argument("--once",
+        action="store_true",
+        help="Check the watched folder a single time and exit, e.g. when run from a scheduled job.")
+    parser.add_argument("--raw-format",
+        choices=RAW_FORMATS,
+        default="csv",
+        help="Format of the raw histogram output: <output>.csv (the default), <output>.npz holding the histograms as dense arrays for fast loading with numpy, or both.")
+    parser.add_argument("--roi",
+        type=__roi_argument,
+        metavar="SPEC",
+        help="Only analyze a region of interest of every image: rect:X,Y,WIDTH,HEIGHT, poly:X1,Y1,X2,Y2,X3,Y3[,...] or mask:PATH to a mask image the size of the photographs whose non-zero pixels are part of the region. Coordinates are in pixels of the images.")
+    parser.add_argument("--batch-manifest",
+        metavar="FILE",
+        help="Batch mode. Analyzes the photographs of every patient listed in the JSON manifest and writes the outputs of each patient, instead of a single patient given by --preop-left and the other arguments.")
+    parser.add_argument("--shard",
+        type=__shard_argument,
+        metavar="i/N",
+        help="Only analyze shard i of N (counting from 1) of the images of the --batch-manifest, e.g. on one of N machines. Writes their histograms to <output>_shard_<i>_of_<N>.npz and their averages to <output>_shard_<i>_of_<N>_summary.csv, to be combined with --merge.")
+    parser.add_argument("--merge",
+        nargs="+",
+        metavar="PARTIAL",
+        help="Combines the partial files written by every --shard of a batch manifest, writing the outputs of each patient exactly as a single run would.")
+    parser.add_argument("--serve",
+        type=int,
+        nargs="?",
+        const=8765,
+        metavar="PORT",
+        help="Service mode. Runs a local HTTP service on the port (default 8765) that analyzes images posted to /analyze, by path or as uploads, and returns their histograms and averages as JSON, using a pool of warm worker processes. Metrics are served at /metrics.")
+    parser.add_argument("--host",
+        default="127.0.0.1",
+        help="Address the service listens on (default: 127.0.0.1, i.e. this machine only).")
+    parser.add_argument("--profile",
+        action="store_true",
+        help=f"Record the time and memory spent in each stage of the analysis of each image, and write them to <output>_profile.json and <output>_profile.csv. May also be turned on by setting the {profiling.ENV_VAR} environment variable.")
 
-    args = parser.parse_args()
-    __cli_main(args.preop_left, args.preop_right, args.postop_left, args.postop_right, args.output)
+    args = parser.parse_args(argv)
+    if args.profile:
+        profiling.enable()
+    if args.validate_fast:
+        __validate_fast_cli(args.validate_fast, args.fast if args.fast > 1 else DEFAULT_FAST_REDUCE, args.output)
+        if args.output:
+            profiling.write_report(args.output)
+        return
+    max_memory = args.max_memory * 1024 * 1024 if args.max_memory else None
+    color = ColorSettings(args.illuminant, args.intent, not args.ignore_embedded_profiles)
+    if args.verify_lut is not None:
+        identical = __verify_lut_cli(args.verify_lut, max_memory, args.output, color)
+        if args.output:
+            profiling.write_report(args.output)
+        if not identical:
+            sys.exit(1)
+        return
+    if args.merge:
+        try:
+            __merge_main(args.merge, args.raw_format)
+        except (OSError, ValueError) as e:
+            parser.error(str(e))
+        return
+    cases = None
+    if args.batch_manifest:
+        try:
+            cases = shards.load_batch_manifest(args.batch_manifest)
+        except (OSError, ValueError) as e:
+            parser.error(str(e))
+        if args.shard and not args.output:
+            parser.error("--shard requires --output/-o to name the partial files")
+    elif args.shard:
+        parser.error("--shard requires --batch-manifest")
+    elif args.serve is None and (not args.preop_left or not args.output):
+        parser.error("the following arguments are required: --preop-left/-p, --output/-o")
+    elif args.serve is None and (args.watch or args.postop_left or args.postop_right) and not args.preop_right:
+        # the differences of the summary are taken against the pre-op
+        # averages, which requires both pre-op photographs
+        parser.error("post-op photographs (--postop-left/--postop-right or --watch) require --preop-right")
+    if args.cache_dir:
+        set_default_cache_dir(args.cache_dir)
+    cache = None
+    if not args.no_cache:
+        cache = HistogramCache(args.cache_dir, args.cache_size * 1024 * 1024)
+    options = dict(max_memory=max_memory, reduce=args.fast, roi=args.roi, engine=args.engine, color=color)
+    if args.serve is not None:
+        # imported here since only the service needs asyncio and the HTTP code
+        from server import serve
+        serve(args.host, args.serve, args.workers, cache, args.output, **options)
+        return
+    if cases is not None:
+        if args.shard:
+            __shard_main(cases, args.shard, args.output, args.workers, cache, **options)
+        else:
+            __batch_main(cases, args.workers, cache, args.raw_format, **options)
+        if args.output:
+            profiling.write_report(args.output)
+        if cache is not None:
+            cache.save_stats()
+        return
+    if args.watch:
+        watch_folder(args.watch, args.preop_left, args.preop_right, args.output, args.left_pattern, args.right_pattern,
+            args.interval, args.once, args.workers, cache, args.raw_format, **options)
+        return
+    __cli_main(args.preop_left, args.preop_right, args.postop_left, args.postop_right, args.output, args.workers, cache, args.raw_format,
+        **options)
+    profiling.write_report(args.output)
+    if cache is not None:
+        cache.save_stats()
 
 if __name__ == "__main__":
     handle_cli()